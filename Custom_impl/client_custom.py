@@ -5,67 +5,91 @@ import sys
 from protocol_custom import (
     CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_READ, CMD_DELETE_MSG,
     CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_CHAT, CMD_LIST, CMD_READ_ACK,
-    encode_message, decode_message,
-    pack_short_string, pack_long_string,
-    unpack_short_string, unpack_long_string
+    CMD_CHAT, CMD_LIST, CMD_READ_ACK, CMD_BATCH, CMD_HELLO, CMD_HISTORY,
+    PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_VERSION,
+    encode_message, decode_message, encode_batch, unpack_batch,
+    pack_short_string, pack_long_string, pack_list, pack_uint, pack_varint, unpack_history, unpack_history_error,
+    unpack_short_string, unpack_long_string, unpack_uint
 )
 
+# Messages fetched per conversation page
+CONV_PAGE_SIZE = 50
+# Usernames fetched per list page
+USER_PAGE_SIZE = 200
+
 # Helper functions for packing data for each command
-def pack_login(username, password):
+def pack_login(username, password, version=PROTOCOL_V1):
     # Pack username and password into a login payload
-    return pack_short_string(username) + pack_short_string(password)
+    return pack_short_string(username, version) + pack_short_string(password, version)
 
-def pack_create(username, password):
+def pack_create(username, password, version=PROTOCOL_V1):
     # Pack username and password for account creation
-    return pack_short_string(username) + pack_short_string(password)
+    return pack_short_string(username, version) + pack_short_string(password, version)
 
-def pack_send(sender, recipient, message):
+def pack_send(sender, recipient, message, version=PROTOCOL_V1):
     # Pack sender recipient and message into a payload
-    return pack_short_string(sender) + pack_short_string(recipient) + pack_long_string(message)
+    return pack_short_string(sender, version) + pack_short_string(recipient, version) + pack_long_string(message, version)
 
-def pack_read(username, limit):
+def pack_read(username, limit, version=PROTOCOL_V1):
     # Pack username and a 1 byte limit 0 means read all messages
-    return pack_short_string(username) + struct.pack("!B", limit)
+    return pack_short_string(username, version) + pack_uint(limit, version)
 
-def pack_delete_msg(username, indices):
+def pack_delete_msg(username, indices, version=PROTOCOL_V1):
     # Pack username and a list of indices of messages to delete
-    data = pack_short_string(username)
-    data += struct.pack("!B", len(indices))
+    data = pack_short_string(username, version)
+    data += pack_uint(len(indices), version)
     for idx in indices:
-        data += struct.pack("!B", idx)
+        data += pack_uint(idx, version)
+    return data
+
+def pack_view_conv(username, other_user, version=PROTOCOL_V1, before=0, after=0, limit=0):
+    # Pack username and the other user to view conversation; v2 adds the page cursors (0 means unset)
+    data = pack_short_string(username, version) + pack_short_string(other_user, version)
+    if version >= PROTOCOL_V2:
+        data += pack_uint(before, version) + pack_uint(after, version) + pack_uint(limit, version)
     return data
 
-def pack_view_conv(username, other_user):
-    # Pack username and the other user to view conversation
-    return pack_short_string(username) + pack_short_string(other_user)
+def pack_history_request(username, other_user, before=0, after=0, limit=0, version=PROTOCOL_V1):
+    # Pack the two users and the page cursors; cursors are varints in every protocol version
+    return (pack_short_string(username, version) + pack_short_string(other_user, version) +
+            pack_varint(before) + pack_varint(after) + pack_varint(limit))
 
-def pack_delete_acc(username):
+def pack_delete_acc(username, version=PROTOCOL_V1):
     # Pack username for account deletion
-    return pack_short_string(username)
+    return pack_short_string(username, version)
 
-def pack_logoff(username):
+def pack_logoff(username, version=PROTOCOL_V1):
     # Pack username for logging off
-    return pack_short_string(username)
+    return pack_short_string(username, version)
 
-def pack_close(username):
+def pack_close(username, version=PROTOCOL_V1):
     # Pack username for closing the connection
-    return pack_short_string(username)
+    return pack_short_string(username, version)
 
 # Chatclient class handles client server communication
 class ChatClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, version=PROTOCOL_VERSION):
         # Create and connect the socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((host, port))
         self.username = None 
+        self.version = PROTOCOL_V1
+        if version > PROTOCOL_V1:
+            self.negotiate(version)
+
+    def negotiate(self, version):
+        # Offer a newer protocol version; the server answers (in v1 framing) with the one it agrees to
+        self.sock.sendall(encode_message(CMD_HELLO, struct.pack("!B", version)))
+        cmd, data = decode_message(self.sock)
+        if cmd == CMD_HELLO and data:
+            self.version = data[0]
 
     def login(self, username, password):
         # build and send the login payload
-        payload = pack_login(username, password)
-        self.sock.sendall(encode_message(CMD_LOGIN, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_login(username, password, self.version)
+        self.sock.sendall(encode_message(CMD_LOGIN, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         # Update username if login is successful
         if "successful" in resp:
             self.username = username
@@ -73,49 +97,83 @@ class ChatClient:
 
     def create_account(self, username, password):
         # Build and send the account creation payload
-        payload = pack_create(username, password)
-        self.sock.sendall(encode_message(CMD_CREATE, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_create(username, password, self.version)
+        self.sock.sendall(encode_message(CMD_CREATE, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         print("create account response", resp)
 
     def list_accounts(self, wildcard="*"):
-        # Use a helper function to pack the wildcard
-        payload = pack_list(wildcard)
-        self.sock.sendall(encode_message(CMD_LIST, payload))
-        cmd, data = decode_message(self.sock)
-        # If the server returned a long string response for the list unpack and display matching accounts
-        if cmd == CMD_LIST:
-            resp, _ = unpack_long_string(data, 0)
+        # Page through the matching accounts, following each reply's continuation token until it is empty
+        after = ""
+        while True:
+            payload = pack_list(wildcard, self.version, USER_PAGE_SIZE, after)
+            self.sock.sendall(encode_message(CMD_LIST, payload, self.version))
+            cmd, data = decode_message(self.sock, self.version)
+            # If the server returned a long string response for the list unpack and display matching accounts
+            if cmd != CMD_LIST:
+                resp, _ = unpack_short_string(data, 0, self.version)
+                print("list error", resp)
+                return
+            resp, offset = unpack_long_string(data, 0, self.version)
+            after, _ = unpack_short_string(data, offset, self.version)
             print("matching accounts", resp)
-        else:
-            resp, _ = unpack_short_string(data, 0)
-            print("list error", resp)
+            if not after:
+                return
 
     def send_message(self, recipient, message):
         # Check if user is logged in before sending a message
         if not self.username:
             print("please login first")
             return
-        payload = pack_send(self.username, recipient, message)
-        self.sock.sendall(encode_message(CMD_SEND, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_send(self.username, recipient, message, self.version)
+        self.sock.sendall(encode_message(CMD_SEND, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         print("send message response", resp)
 
+    def send_batch(self, requests):
+        # Send a list of (cmd, payload) requests as CMD_BATCH frames in one write and
+        # return every reply as (cmd, payload), in order
+        frames = encode_batch([encode_message(cmd, payload, self.version) for cmd, payload in requests], self.version)
+        self.sock.sendall(b"".join(frames))
+        replies = []
+        # Each batch frame is answered by one aggregated reply, split over frames flagged "more" if it is large
+        for _ in frames:
+            while True:
+                cmd, data = decode_message(self.sock, self.version)
+                if cmd != CMD_BATCH:
+                    replies.append((cmd, data))
+                    break
+                more, sub_frames = unpack_batch(data, self.version)
+                replies.extend(sub_frames)
+                if not more:
+                    break
+        return replies
+
+    def send_messages(self, messages):
+        # Send a list of (recipient, message) pairs in one batch instead of one round trip each
+        if not self.username:
+            print("please login first")
+            return
+        requests = [(CMD_SEND, pack_send(self.username, recipient, message, self.version)) for recipient, message in messages]
+        for cmd, data in self.send_batch(requests):
+            resp, _ = unpack_short_string(data, 0, self.version)
+            print("send message response", resp)
+
     def read_messages(self, limit=0):
         # Check if user is logged in before reading messages
         if not self.username:
             print("please login first")
             return
-        payload = pack_read(self.username, limit)
-        self.sock.sendall(encode_message(CMD_READ, payload))
+        payload = pack_read(self.username, limit, self.version)
+        self.sock.sendall(encode_message(CMD_READ, payload, self.version))
         print("reading messages")
         # Loop until a non read message is received
         while True:
-            cmd, data = decode_message(self.sock)
+            cmd, data = decode_message(self.sock, self.version)
             if cmd != CMD_READ:
-                msg_text, _ = unpack_long_string(data, 0)
+                msg_text, _ = unpack_long_string(data, 0, self.version)
                 if msg_text == "NO_MESSAGES":
                     print("no new messages")
                 elif msg_text == "END_OF_MESSAGES":
@@ -124,48 +182,72 @@ class ChatClient:
                     print("unexpected code  message", msg_text)
                 break
             offset = 0
-            sender, offset = unpack_short_string(data, offset)
-            msg_text, offset = unpack_long_string(data, offset)
+            sender, offset = unpack_short_string(data, offset, self.version)
+            msg_text, offset = unpack_long_string(data, offset, self.version)
             print("from", sender, ":", msg_text)
         # Send an acknowledgement after finishing reading messages
-        ack_payload = pack_short_string("DONE")
-        self.sock.sendall(encode_message(CMD_READ_ACK, ack_payload))
+        ack_payload = pack_short_string("DONE", self.version)
+        self.sock.sendall(encode_message(CMD_READ_ACK, ack_payload, self.version))
 
     def delete_messages(self, indices):
         # Check if user is logged in before deleting messages
         if not self.username:
             print("please login first")
             return
-        payload = pack_delete_msg(self.username, indices)
-        self.sock.sendall(encode_message(CMD_DELETE_MSG, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_delete_msg(self.username, indices, self.version)
+        self.sock.sendall(encode_message(CMD_DELETE_MSG, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         print("delete messages response", resp)
 
-    def view_conversation(self, other_user):
+    def view_conversation(self, other_user, before=0, limit=CONV_PAGE_SIZE):
         # Check if the user is logged in before viewing a conversation
         if not self.username:
             print("please login first")
             return
-        payload = pack_view_conv(self.username, other_user)
-        self.sock.sendall(encode_message(CMD_VIEW_CONV, payload))
-        cmd, data = decode_message(self.sock)
+        # Over v2 only one page is fetched: the newest messages, or those before the given id
+        payload = pack_view_conv(self.username, other_user, self.version, before=before, limit=limit)
+        self.sock.sendall(encode_message(CMD_VIEW_CONV, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
         if cmd == CMD_VIEW_CONV:
-            conv_str, _ = unpack_long_string(data, 0)
+            conv_str, offset = unpack_long_string(data, 0, self.version)
             print("conversation", conv_str)
+            if self.version >= PROTOCOL_V2 and offset < len(data):
+                more, offset = unpack_uint(data, offset, self.version)
+                first_id, offset = unpack_uint(data, offset, self.version)
+                if more:
+                    print("older messages exist before id", first_id)
         else:
-            resp, _ = unpack_short_string(data, 0)
+            resp, _ = unpack_short_string(data, 0, self.version)
             print("view conversation response", resp)
 
+    def get_history(self, other_user, before=0, after=0, limit=CONV_PAGE_SIZE):
+        # Fetch one page of history as records (id, timestamp_us, sender, message), oldest first, and a more flag
+        if not self.username:
+            print("please login first")
+            return [], False
+        payload = pack_history_request(self.username, other_user, before, after, limit, self.version)
+        self.sock.sendall(encode_message(CMD_HISTORY, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        if cmd != CMD_HISTORY:
+            resp, _ = unpack_short_string(data, 0, self.version)
+            print("history response", resp)
+            return [], False
+        error = unpack_history_error(data, self.version)
+        if error is not None:
+            print("history response", error)
+            return [], False
+        return unpack_history(data, self.version)
+
     def delete_account(self):
         # Delete the currently logged in account
         if not self.username:
             print("please login first")
             return
-        payload = pack_delete_acc(self.username)
-        self.sock.sendall(encode_message(CMD_DELETE_ACC, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_delete_acc(self.username, self.version)
+        self.sock.sendall(encode_message(CMD_DELETE_ACC, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         print("delete account response", resp)
         if "deleted" in resp.lower():
             self.username = None
@@ -175,18 +257,18 @@ class ChatClient:
         if not self.username:
             print("not logged in")
             return
-        payload = pack_logoff(self.username)
-        self.sock.sendall(encode_message(CMD_LOGOFF, payload))
-        cmd, data = decode_message(self.sock)
-        resp, _ = unpack_short_string(data, 0)
+        payload = pack_logoff(self.username, self.version)
+        self.sock.sendall(encode_message(CMD_LOGOFF, payload, self.version))
+        cmd, data = decode_message(self.sock, self.version)
+        resp, _ = unpack_short_string(data, 0, self.version)
         print("log off response", resp)
         self.username = None
 
     def close(self):
         # Close the connection to the server
         uname = self.username if self.username else ""
-        payload = pack_close(uname)
-        self.sock.sendall(encode_message(CMD_CLOSE, payload))
+        payload = pack_close(uname, self.version)
+        self.sock.sendall(encode_message(CMD_CLOSE, payload, self.version))
         self.sock.close()
 
 def client_main():
@@ -246,7 +328,8 @@ def client_main():
                 client.delete_messages(idx_list)
             elif choice == "5":
                 ou = input("enter other user's name ")
-                client.view_conversation(ou)
+                before = input("show messages before id blank for newest ").strip()
+                client.view_conversation(ou, int(before) if before.isdigit() else 0)
             elif choice == "6":
                 client.delete_account()
             elif choice == "7":
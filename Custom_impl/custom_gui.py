@@ -5,9 +5,19 @@ import socket
 import sys
 import struct
 import ast 
+import bisect
+# Framing and string helpers are shared with the command-line client so both speak every protocol version
+from protocol_custom import (
+    FrameReader, encode_message, decode_message, encode_batch, unpack_batch,
+    pack_short_string, pack_long_string, unpack_short_string, unpack_long_string,
+    pack_uint, pack_varint, pack_list, unpack_history, unpack_history_error, micros_to_datetime, PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_VERSION,
+    pack_directory_request, unpack_directory_reply, unpack_name_list, unpack_varint, unpack_presence_events
+)
 
 PORT = 56789 
 MSGLEN = 409600               
+CONV_PAGE_SIZE = 50  # Messages fetched per conversation page
+USER_PAGE_SIZE = 200  # Usernames fetched per list request
 
 CMD_LOGIN      = 1
 CMD_CREATE     = 2
@@ -20,113 +30,80 @@ CMD_LOGOFF     = 8
 CMD_CLOSE      = 9
 CMD_CHAT       = 10
 CMD_LIST       = 11
-
-HEADER_FORMAT = "!BH" 
-HEADER_SIZE = struct.calcsize(HEADER_FORMAT) 
-
-def encode_message(cmd, payload_bytes):
-    # Pack the command and length of the payload into a header
-    header = struct.pack(HEADER_FORMAT, cmd, len(payload_bytes))
-    # Return header concatenated with payload
-    return header + payload_bytes
-
-def decode_message(sock):
-    # Read the header first
-    header = b""
-    while len(header) < HEADER_SIZE:
-        chunk = sock.recv(HEADER_SIZE - len(header))
-        if not chunk:
-            # Connection closed unexpectedly
-            raise Exception("Connection closed while reading header")
-        header += chunk
-    # Unpack header to get command and payload length
-    cmd, payload_len = struct.unpack(HEADER_FORMAT, header)
-    payload = b""
-    # Read the payload based on length specified in header
-    while len(payload) < payload_len:
-        chunk = sock.recv(payload_len - len(payload))
-        if not chunk:
-            raise Exception("Connection closed while reading payload")
-        payload += chunk
-    return cmd, payload
-
-def pack_short_string(s):
-    # Convert string to bytes using UTF-8 encoding
-    b = s.encode('utf-8')
-    # Check that the string is not too long to pack in 1 byte length
-    if len(b) > 255:
-        raise ValueError("String too long for short string (exceeds 255 bytes).")
-    # Pack length (1 byte) and then the actual string bytes
-    return struct.pack("!B", len(b)) + b
-
-def unpack_short_string(data, offset):
-    # Unpack the length of the short string (1 byte)
-    length = struct.unpack_from("!B", data, offset)[0]
-    offset += 1
-    # Extract the string bytes based on the length and decode to UTF-8
-    s = data[offset:offset+length].decode('utf-8')
-    offset += length
-    return s, offset
-
-def pack_long_string(s):
-    # Convert string to bytes using UTF-8 encoding
-    b = s.encode('utf-8')
-    # Ensure string length fits within 2 bytes length (max 65535)
-    if len(b) > 65535:
-        raise ValueError("String too long for long string (exceeds 65535 bytes).")
-    # Pack length (2 bytes) and then the string bytes
-    return struct.pack("!H", len(b)) + b
-
-def unpack_long_string(data, offset):
-    # Unpack the length of the long string (2 bytes)
-    length = struct.unpack_from("!H", data, offset)[0]
-    offset += 2
-    # Extract and decode the string
-    s = data[offset:offset+length].decode('utf-8')
-    offset += length
-    return s, offset
-
-def decode_response(cmd, payload):
+CMD_BATCH      = 13
+CMD_HELLO      = 14
+CMD_HISTORY    = 15
+CMD_DIRECTORY  = 16
+CMD_PRESENCE   = 17
+CMD_PRESENCE_EVENTS = 18
+
+def decode_response(cmd, payload, version=PROTOCOL_V1):
     # For commands that expect a short response
     if cmd in (CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_DELETE_MSG, CMD_LOGOFF, CMD_DELETE, CMD_CLOSE):
         try:
             # Try unpacking as a short string first
-            resp, _ = unpack_short_string(payload, 0)
+            resp, _ = unpack_short_string(payload, 0, version)
         except Exception:
             # If that fails, try unpacking as a long string
-            resp, _ = unpack_long_string(payload, 0)
+            resp, _ = unpack_long_string(payload, 0, version)
         return resp
     elif cmd in (CMD_LIST, CMD_VIEW_CONV):
         # For listing users or viewing conversations, unpack as a long string
-        resp, _ = unpack_long_string(payload, 0)
+        resp, offset = unpack_long_string(payload, 0, version)
+        if cmd == CMD_LIST and offset < len(payload):
+            # A paged listing ends with the continuation token, empty on the last page
+            next_token, _ = unpack_short_string(payload, offset, version)
+            return {"accounts": resp, "next": next_token}
         return resp
+    elif cmd == CMD_DIRECTORY:
+        # Directory changes (or a page of a re-listing) as a dict
+        return unpack_directory_reply(payload, version)
+    elif cmd == CMD_PRESENCE:
+        # Subscription flag, then who is online now
+        _, offset = unpack_varint(payload, 0)
+        online, _ = unpack_name_list(payload, offset, version)
+        return online
+    elif cmd == CMD_PRESENCE_EVENTS:
+        return unpack_presence_events(payload, version)
+    elif cmd == CMD_HISTORY:
+        # A page of history records, oldest first, or the reason there is none
+        error = unpack_history_error(payload, version)
+        if error is not None:
+            return error
+        records, more = unpack_history(payload, version)
+        return {"records": records, "more": more}
     elif cmd == CMD_READ:
+        # In v2 a marker is a single long string filling the payload
+        if version >= PROTOCOL_V2:
+            marker, end = unpack_long_string(payload, 0, version)
+            if end == len(payload):
+                return "" if marker in ("END_OF_MESSAGES", "NO_MESSAGES") else marker
         # For reading messages, check if payload starts with a marker (first byte = 0)
-        if payload[0] == 0:
+        elif payload[0] == 0:
             marker_length = struct.unpack_from("!H", payload, 0)[0]
             if len(payload) == 2 + marker_length:
-                marker, _ = unpack_long_string(payload, 0)
+                marker, _ = unpack_long_string(payload, 0, version)
                 # Recognize special markers for end or absence of messages
                 if marker in ("END_OF_MESSAGES", "NO_MESSAGES"):
                     return ""
                 else:
                     return marker
         # Otherwise, unpack a sender and a long message
-        sender, offset = unpack_short_string(payload, 0)
-        message, _ = unpack_long_string(payload, offset)
+        sender, offset = unpack_short_string(payload, 0, version)
+        message, _ = unpack_long_string(payload, offset, version)
         return {"sender": sender, "message": message}
     elif cmd == CMD_CHAT:
         try:
             # For chat messages, try unpacking sender and message
-            sender, offset = unpack_short_string(payload, 0)
-            message, _ = unpack_long_string(payload, offset)
+            sender, offset = unpack_short_string(payload, 0, version)
+            message, _ = unpack_long_string(payload, offset, version)
             return {"sender": sender, "message": message}
         except Exception:
             # Fallback: decode as plain UTF-8 text
-            return payload.decode('utf-8', errors='replace')
+            return str(payload, 'utf-8', errors='replace')
     else:
         # For any unknown command, decode the payload as UTF-8
-        return payload.decode('utf-8', errors='replace')
+        return str(payload, 'utf-8', errors='replace')
 
 class ChatClient:
     def __init__(self, server_host, server_port):
@@ -139,24 +116,39 @@ class ChatClient:
         self.sock.connect((server_host, server_port))
         self.username = None
         self.running = True
+        # Agree on the newest protocol version before the receive loop starts reading frames
+        self.sock.sendall(encode_message(CMD_HELLO, struct.pack("!B", PROTOCOL_VERSION)))
+        cmd, data = decode_message(self.sock)
+        self.version = data[0] if cmd == CMD_HELLO and data else PROTOCOL_V1
 
     def send_message(self, cmd, data):
+        # Encode the complete message (header + payload) and send it
+        if cmd == CMD_BATCH:
+            # data is a list of (cmd, data) requests; they go out in one write and are answered together
+            frames = encode_batch([encode_message(sub_cmd, self.build_payload(sub_cmd, sub_data), self.version)
+                                   for sub_cmd, sub_data in data], self.version)
+            self.sock.sendall(b"".join(frames))
+            return
+        msg = encode_message(cmd, self.build_payload(cmd, data), self.version)
+        self.sock.sendall(msg)
+
+    def build_payload(self, cmd, data):
         # Build payloads based on the command type
         if cmd in (CMD_LOGIN, CMD_CREATE):
             username = data.get("from", "")
             password = data.get("password", "")
             # For login or account creation, pack username and password as short strings
-            payload = pack_short_string(username) + pack_short_string(password)
+            payload = pack_short_string(username, self.version) + pack_short_string(password, self.version)
         elif cmd == CMD_SEND:
             sender = data.get("from", "")
             recipient = data.get("to", "")
             message = data.get("body", "")
             # For sending messages, pack sender, recipient and message (as a long string)
-            payload = pack_short_string(sender) + pack_short_string(recipient) + pack_long_string(message)
+            payload = pack_short_string(sender, self.version) + pack_short_string(recipient, self.version) + pack_long_string(message, self.version)
         elif cmd == CMD_LIST:
             wildcard = data.get("body", "*")
-            # Use a wildcard to list matching accounts; pack as a short string
-            payload = pack_short_string(wildcard)
+            # Use a wildcard to list matching accounts, one page at a time
+            payload = pack_list(wildcard, self.version, data.get("limit", 0), data.get("after", ""))
         elif cmd == CMD_READ:
             username = data.get("from", "")
             try:
@@ -165,7 +157,7 @@ class ChatClient:
             except:
                 limit = 0
             # Pack username and limit (1 byte)
-            payload = pack_short_string(username) + struct.pack("!B", limit)
+            payload = pack_short_string(username, self.version) + pack_uint(limit, self.version)
         elif cmd == CMD_DELETE_MSG:
             username = data.get("from", "")
             indices_str = data.get("body", "")
@@ -176,24 +168,35 @@ class ChatClient:
                 if part.isdigit():
                     indices.append(int(part))
             count = len(indices)
-            payload = pack_short_string(username) + struct.pack("!B", count)
+            payload = pack_short_string(username, self.version) + pack_uint(count, self.version)
             # Append each index as a byte
             for idx in indices:
-                payload += struct.pack("!B", idx)
+                payload += pack_uint(idx, self.version)
         elif cmd == CMD_VIEW_CONV:
             username = data.get("from", "")
             other = data.get("to", "")
             # Pack usernames to view conversation between two users
-            payload = pack_short_string(username) + pack_short_string(other)
+            payload = pack_short_string(username, self.version) + pack_short_string(other, self.version)
+        elif cmd == CMD_HISTORY:
+            username = data.get("from", "")
+            other = data.get("to", "")
+            # Usernames, then the page cursors as varints: before id, after id and page size, 0 meaning unset
+            payload = (pack_short_string(username, self.version) + pack_short_string(other, self.version) +
+                       pack_varint(data.get("before", 0)) + pack_varint(0) +
+                       pack_varint(data.get("limit", CONV_PAGE_SIZE)))
+        elif cmd == CMD_DIRECTORY:
+            # Our directory version, the page size and the token of a re-listing in progress
+            payload = pack_directory_request(data.get("since", 0), data.get("limit", 0), data.get("after", ""), self.version)
+        elif cmd == CMD_PRESENCE:
+            # 1 subscribes to presence events, 0 unsubscribes
+            payload = pack_varint(data.get("subscribe", 1))
         elif cmd in (CMD_DELETE, CMD_LOGOFF, CMD_CLOSE):
             username = data.get("from", "")
             # For account deletion, logoff, or closing, only the username is needed
-            payload = pack_short_string(username)
+            payload = pack_short_string(username, self.version)
         else:
             payload = b""
-        # Encode the complete message (header + payload) and send it
-        msg = encode_message(cmd, payload)
-        self.sock.sendall(msg)
+        return payload
 
     def close(self):
         # Stop the receive loop and close the socket connection
@@ -201,18 +204,25 @@ class ChatClient:
         self.sock.close()
 
     def receive_loop(self, callback):
-        # Continuously listen for incoming messages from the server
+        # Continuously listen for incoming messages from the server; one recv can carry several frames
+        reader = FrameReader(self.sock, version=self.version)
         while self.running:
             try:
-                cmd, payload = decode_message(self.sock)
+                cmd, payload = reader.read_frame()
             except Exception as e:
                 # Print error to stderr if connection is lost or an error occurs
                 print("Error receiving message:", e, file=sys.stderr)
                 break
-            # Decode the received payload and wrap it in a dictionary
-            data = {"cmd": cmd, "body": decode_response(cmd, payload)}
-            # Use the provided callback to handle the message (usually updating the UI)
-            callback(data)
+            if cmd == CMD_BATCH:
+                # A batch reply is handed to the UI one sub-frame at a time, as if each had arrived alone
+                frames = unpack_batch(payload, self.version)[1]
+            else:
+                frames = [(cmd, payload)]
+            for cmd, payload in frames:
+                # Decode the received payload and wrap it in a dictionary
+                data = {"cmd": cmd, "body": decode_response(cmd, payload, self.version)}
+                # Use the provided callback to handle the message (usually updating the UI)
+                callback(data)
         # Ensure the socket is closed when loop ends
         self.close()
 
@@ -222,7 +232,15 @@ class ChatGUI:
         self.master = master
         self.master.title("Custom Protocol Chat Client")
         self.client = None           # Will hold the ChatClient instance
-        self.user_list = []          # List of users available on the server
+        self.user_list = []          # Sorted list of the other users on the server
+        # Directory version the user list is in sync with, and the version a re-listing started from while one runs
+        self.directory_version = 0
+        self.relist_version = None
+        # Users the presence feed reports as online; their menu entries are marked
+        self.online = set()
+        # Conversation being paged through and the oldest message id shown from it
+        self.conv_user = None
+        self.conv_oldest_id = None
         self.username = ""           # Current logged-in user's name
 
         # Create frames for different parts of the interface
@@ -305,6 +323,10 @@ class ChatGUI:
         self.view_conv_button = tk.Button(self.command_frame, text="View", command=self.view_conversation)
         self.view_conv_button.grid(row=1, column=2, padx=5, pady=5)
 
+        # Button to page back through the conversation being viewed
+        self.older_button = tk.Button(self.command_frame, text="Older Messages", command=self.view_older)
+        self.older_button.grid(row=2, column=2, padx=5, pady=5)
+
         # Button to delete the user account
         self.delete_acc_button = tk.Button(self.command_frame, text="Delete Account", command=self.delete_account)
         self.delete_acc_button.grid(row=0, column=2, padx=5, pady=5)
@@ -347,11 +369,73 @@ class ChatGUI:
             menu.add_command(label=option, command=lambda value=option: self.view_conv_var.set(value))
         self.view_conv_var.set(options[0] if options else "Select User")
 
-    def refresh_users(self):
-        # Send a request to the server to list all user accounts
+    def refresh_users(self, after=""):
+        # Ask the server for the accounts added and removed since the directory version we already have
         if self.client:
-            list_msg = {"from": self.username, "body": "*"}
-            self.client.send_message(CMD_LIST, list_msg)
+            sync_msg = {"since": self.directory_version, "after": after, "limit": USER_PAGE_SIZE}
+            self.client.send_message(CMD_DIRECTORY, sync_msg)
+
+    def apply_directory(self, added, removed):
+        # Insert or delete only the changed names, in the sorted user list and in both menus
+        current = self.username if self.username else self.username_entry.get().strip()
+        menus = [(self.recipient_menu["menu"], self.recipient_var), (self.view_conv_menu["menu"], self.view_conv_var)]
+        for name in removed:
+            i = bisect.bisect_left(self.user_list, name)
+            if i < len(self.user_list) and self.user_list[i] == name:
+                del self.user_list[i]
+                # Index 0 of each menu is its "All" / "Select User" entry
+                for menu, _ in menus:
+                    menu.delete(i + 1)
+        for name in added:
+            i = bisect.bisect_left(self.user_list, name)
+            if name == current or (i < len(self.user_list) and self.user_list[i] == name):
+                continue
+            self.user_list.insert(i, name)
+            for menu, var in menus:
+                menu.insert_command(i + 1, label=self.user_label(name), command=lambda value=name, var=var: var.set(value))
+
+    def user_label(self, name):
+        return f"{name} (online)" if name in self.online else name
+
+    def relabel_user(self, name):
+        i = bisect.bisect_left(self.user_list, name)
+        if i < len(self.user_list) and self.user_list[i] == name:
+            for menu in (self.recipient_menu["menu"], self.view_conv_menu["menu"]):
+                menu.entryconfigure(i + 1, label=self.user_label(name))
+
+    def handle_presence(self, events):
+        # Pushed account and session changes, already coalesced to each user's latest event
+        for name, event in events:
+            if event == "deleted":
+                self.online.discard(name)
+                self.apply_directory([], [name])
+                continue
+            if event == "online":
+                self.online.add(name)
+            else:
+                self.online.discard(name)
+            self.apply_directory([name], [])
+            self.relabel_user(name)
+
+    def handle_directory(self, sync):
+        if sync["reset"]:
+            # The server no longer has our changes: start over from an empty list and page through every account
+            if self.relist_version is None:
+                self.relist_version = sync["version"]
+                self.user_list = []
+                self.update_recipient_menu()
+                self.update_view_conv_menu()
+            self.apply_directory(sync["added"], [])
+            if sync["more"]:
+                self.refresh_users(sync["next"])
+            else:
+                self.directory_version = self.relist_version
+                self.relist_version = None
+        else:
+            self.apply_directory(sync["added"], sync["removed"])
+            self.directory_version = sync["version"]
+            if sync["more"]:
+                self.refresh_users()
 
     def login(self):
         # Retrieve server IP, username, and password from the login fields
@@ -412,7 +496,7 @@ class ChatGUI:
         wildcard = simpledialog.askstring("List Accounts", "Enter wildcard (leave blank for all):", parent=self.master)
         if wildcard is None:
             return
-        list_msg = {"from": self.username, "body": wildcard}
+        list_msg = {"from": self.username, "body": wildcard, "limit": USER_PAGE_SIZE}
         self.client.send_message(CMD_LIST, list_msg)
 
     def delete_messages(self):
@@ -429,8 +513,18 @@ class ChatGUI:
         if other_user == "Select User":
             messagebox.showerror("Error", "Please select a valid user.")
             return
+        # Only the newest page is fetched; "Older Messages" walks back from there
+        self.conv_user = other_user
+        self.conv_oldest_id = None
         view_msg = {"from": self.username, "to": other_user}
-        self.client.send_message(CMD_VIEW_CONV, view_msg)
+        self.client.send_message(CMD_HISTORY, view_msg)
+
+    def view_older(self):
+        if self.conv_user is None or self.conv_oldest_id is None:
+            messagebox.showinfo("Conversation", "No older messages to load.")
+            return
+        view_msg = {"from": self.username, "to": self.conv_user, "before": self.conv_oldest_id}
+        self.client.send_message(CMD_HISTORY, view_msg)
 
     def read_messages(self):
         # Ask the user for the number of unread messages to retrieve
@@ -484,12 +578,19 @@ class ChatGUI:
         cmd = msg.get("cmd", "")
         body = msg.get("body", "")
         if cmd == CMD_LIST:
-            # When a list of accounts is received, update the UI and user list
-            self.append_text("Matching accounts:\n" + body)
-            accounts = [x.strip() for x in body.split(",") if x.strip()]
-            self.user_list = accounts
-            self.update_recipient_menu()
-            self.update_view_conv_menu()
+            # A listing from the List Accounts dialog is only shown; the menus follow the directory sync
+            text = "Matching accounts:\n" + body["accounts"]
+            if body["next"]:
+                text += f"\n(Showing the first {USER_PAGE_SIZE}; narrow the wildcard to find others)"
+            self.append_text(text)
+        elif cmd == CMD_DIRECTORY:
+            self.handle_directory(body)
+        elif cmd == CMD_PRESENCE:
+            self.online = set(body)
+            for name in self.online:
+                self.relabel_user(name)
+        elif cmd == CMD_PRESENCE_EVENTS:
+            self.handle_presence(body)
         elif cmd == CMD_LOGIN:
             # On successful login, switch to chat view and clear the chat display
             self.chat_display.configure(state="normal")
@@ -499,6 +600,15 @@ class ChatGUI:
             self.chat_frame.pack()
             self.command_frame.pack()
             self.append_text(body)
+            # The user list leaves out whoever is logged in, so a new login syncs it from scratch
+            self.user_list = []
+            self.directory_version = 0
+            self.relist_version = None
+            self.online = set()
+            self.update_recipient_menu()
+            self.update_view_conv_menu()
+            # Presence pushes keep the menus current from here on; the sync fills them in once
+            self.client.send_message(CMD_PRESENCE, {"subscribe": 1})
             self.refresh_users()
         elif cmd == CMD_CREATE:
             # Inform the user that the account was created
@@ -524,6 +634,21 @@ class ChatGUI:
             self.append_text(body)
         elif cmd == CMD_DELETE_MSG:
             self.append_text(body)
+        elif cmd == CMD_HISTORY and isinstance(body, str):
+            self.append_text(body)
+        elif cmd == CMD_HISTORY:
+            # One page of history records; remember where it starts so the next page can continue from there
+            records = body["records"]
+            text = "Conversation:\n"
+            for record in records:
+                timestamp = micros_to_datetime(record["timestamp_us"]).strftime("%Y-%m-%d %H:%M:%S")
+                text += f"[ID {record['id']}] [{timestamp}] {record['sender']}: {record['message']}\n"
+            if body["more"] and records:
+                self.conv_oldest_id = records[0]["id"]
+                text += "(Press Older Messages for earlier history)"
+            else:
+                self.conv_oldest_id = None
+            self.append_text(text)
         elif cmd == CMD_VIEW_CONV:
             # Try to pretty-print the conversation
             try:
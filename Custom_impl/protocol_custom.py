@@ -1,4 +1,5 @@
 import struct
+import datetime
 
 HEADER_FORMAT = "!BH"  
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  
@@ -15,63 +16,410 @@ CMD_CLOSE        = 9
 CMD_CHAT         = 10
 CMD_LIST         = 11
 CMD_READ_ACK     = 12  
+CMD_BATCH        = 13
+CMD_HELLO        = 14
+CMD_HISTORY      = 15
+CMD_DIRECTORY    = 16
+CMD_PRESENCE     = 17
+CMD_PRESENCE_EVENTS = 18
+
+# Protocol versions. v1 is the original fixed-width framing; v2 encodes every payload length, string
+# length, count and message id as a varint, so frames and ids have no 16/8-bit ceiling. A connection
+# speaks v1 until a CMD_HELLO exchange (itself always in v1 framing) agrees on a newer version.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_VERSION = PROTOCOL_V2
+# A v1 payload length is a 16-bit field
+MAX_PAYLOAD_V1 = 65535
+# Largest v2 payload a reader will accept, and the longest varint that can describe it
+MAX_PAYLOAD_V2 = 64 * 1024 * 1024
+MAX_VARINT_LEN = 10
+
+# Batch payload header: a "more" flag (another batch frame continues this reply) and a sub-frame count
+BATCH_HEADER_FORMAT = "!BH"
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER_FORMAT)
+# Room left for sub-frames once the batch header is in a frame
+MAX_BATCH_BODY = 65535 - BATCH_HEADER_SIZE
+
+# Variable-length unsigned integers (LEB128): 7 bits per byte, high bit set on all but the last byte
+
+def pack_varint(n):
+    if n < 0:
+        raise ValueError("Varints cannot be negative.")
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def unpack_varint(data, offset):
+    result = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint.")
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+        if shift >= 7 * MAX_VARINT_LEN:
+            raise ValueError("Varint too long.")
+
+# Counts, limits and message ids: one byte in v1, a varint in v2
+
+def pack_uint(n, version=PROTOCOL_V1):
+    if version >= PROTOCOL_V2:
+        return pack_varint(n)
+    return struct.pack("!B", n)
+
+def unpack_uint(data, offset, version=PROTOCOL_V1):
+    if version >= PROTOCOL_V2:
+        return unpack_varint(data, offset)
+    return struct.unpack_from("!B", data, offset)[0], offset + 1
 
 # Helper functions for packing and unpacking strings
 
-def pack_short_string(s):
+def pack_short_string(s, version=PROTOCOL_V1):
     b = s.encode('utf-8')  # Convert the string to bytes using UTF-8 encoding
     if len(b) > 255:
         raise ValueError("String too long for short string (exceeds 255 bytes).")
+    if version >= PROTOCOL_V2:
+        return pack_varint(len(b)) + b
     # Pack the length as one byte followed by the actual bytes of the string
     return struct.pack("!B", len(b)) + b
 
-def pack_list(wildcard="*"):
-    return pack_short_string(wildcard)
+def pack_list(wildcard="*", version=PROTOCOL_V1, limit=0, after=""):
+    # A paged listing appends the page size as a varint and the previous page's continuation token
+    data = pack_short_string(wildcard, version)
+    if limit or after:
+        data += pack_varint(limit) + pack_short_string(after, version)
+    return data
 
-def unpack_short_string(data, offset):
+def unpack_short_string(data, offset, version=PROTOCOL_V1):
+    if version >= PROTOCOL_V2:
+        return unpack_long_string(data, offset, version)
     length = struct.unpack_from("!B", data, offset)[0]
     offset += 1
-    s = data[offset:offset+length].decode('utf-8') 
+    # str() decodes bytes, bytearrays and memoryviews alike
+    s = str(data[offset:offset+length], 'utf-8')
     # Update offset past the string bytes
     offset += length  
     return s, offset
 
-def pack_long_string(s):
+def pack_long_string(s, version=PROTOCOL_V1):
     b = s.encode('utf-8')  
+    if version >= PROTOCOL_V2:
+        return pack_varint(len(b)) + b
     if len(b) > 65535:
         raise ValueError("String too long for long string (exceeds 65535 bytes).")
     # Pack the length as two bytes followed by the string bytes
     return struct.pack("!H", len(b)) + b
 
-def unpack_long_string(data, offset):
-    length = struct.unpack_from("!H", data, offset)[0]
-    offset += 2  
-    s = data[offset:offset+length].decode('utf-8') 
+def chat_fits(sender, text, version=PROTOCOL_V1, limit=MAX_PAYLOAD_V1):
+    # Whether a sender and text, as CMD_CHAT pushes and CMD_READ records carry them, fit in limit payload
+    # bytes. Only v1 has a ceiling: any message a client could send fits a v2 frame.
+    if version >= PROTOCOL_V2:
+        return True
+    return 3 + len(sender.encode('utf-8')) + len(text.encode('utf-8')) <= limit
+
+def unpack_long_string(data, offset, version=PROTOCOL_V1):
+    if version >= PROTOCOL_V2:
+        length, offset = unpack_varint(data, offset)
+        if offset + length > len(data):
+            raise ValueError("Truncated string.")
+    else:
+        length = struct.unpack_from("!H", data, offset)[0]
+        offset += 2  
+    s = str(data[offset:offset+length], 'utf-8')
     offset += length
     return s, offset
 
-def encode_message(cmd, payload_bytes):
+# History records (CMD_HISTORY replies): varint id, int64 timestamp in microseconds since the Unix epoch,
+# sender as a short string and body as a long string. A reply is a flags varint (more, error), then either a
+# varint record count and the records, oldest first, or with the error flag the reason as a short string.
+
+HISTORY_MORE = 1
+HISTORY_ERROR = 2
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# Room for records in a v1 CMD_HISTORY reply once the flag and count varints are in
+MAX_HISTORY_BODY_V1 = 65535 - 2 * MAX_VARINT_LEN
+
+def timestamp_to_micros(timestamp):
+    # ISO timestamps as text replies carry them (naive local time) to integer epoch microseconds
+    moment = datetime.datetime.fromisoformat(timestamp).astimezone(datetime.timezone.utc)
+    return (moment - EPOCH) // datetime.timedelta(microseconds=1)
+
+def micros_to_datetime(micros):
+    # Back to a naive local datetime for display
+    return (EPOCH + datetime.timedelta(microseconds=micros)).astimezone().replace(tzinfo=None)
+
+def pack_history_record(msg_id, micros, sender, text, version=PROTOCOL_V1):
+    return pack_varint(msg_id) + struct.pack("!q", micros) + pack_short_string(sender, version) + pack_long_string(text, version)
+
+def pack_history(records, more, version=PROTOCOL_V1):
+    # records are already packed with pack_history_record
+    return pack_varint(HISTORY_MORE if more else 0) + pack_varint(len(records)) + b"".join(records)
+
+def pack_history_error(reason, version=PROTOCOL_V1):
+    return pack_varint(HISTORY_ERROR) + pack_short_string(reason, version)
+
+def unpack_history_error(data, version=PROTOCOL_V1):
+    # The reason a CMD_HISTORY request failed, or None for a page of records
+    flags, offset = unpack_varint(data, 0)
+    if not flags & HISTORY_ERROR:
+        return None
+    return unpack_short_string(data, offset, version)[0]
+
+def unpack_history(data, version=PROTOCOL_V1):
+    # Returns (list of record dicts oldest first, more)
+    flags, offset = unpack_varint(data, 0)
+    count, offset = unpack_varint(data, offset)
+    records = []
+    for _ in range(count):
+        msg_id, offset = unpack_varint(data, offset)
+        micros = struct.unpack_from("!q", data, offset)[0]
+        offset += 8
+        sender, offset = unpack_short_string(data, offset, version)
+        text, offset = unpack_long_string(data, offset, version)
+        records.append({"id": msg_id, "timestamp_us": micros, "sender": sender, "message": text})
+    return records, bool(flags & HISTORY_MORE)
+
+# Directory sync (CMD_DIRECTORY). The request is the client's directory version, a page size and the token of
+# a re-listing in progress. The reply is the directory version reached, a flags varint (reset, more), the added
+# and removed usernames as counted lists of short strings and the next re-listing token.
+
+DIRECTORY_RESET = 1
+DIRECTORY_MORE = 2
+# Most names one v1 reply may carry, each a short string of at most 256 bytes
+DIRECTORY_PAGE_V1 = (65535 - 4 * MAX_VARINT_LEN - 256) // 256
+
+def pack_directory_request(since, limit=0, after="", version=PROTOCOL_V1):
+    return pack_varint(since) + pack_varint(limit) + pack_short_string(after, version)
+
+def pack_name_list(names, version=PROTOCOL_V1):
+    return pack_varint(len(names)) + b"".join(pack_short_string(name, version) for name in names)
+
+def unpack_name_list(data, offset, version=PROTOCOL_V1):
+    count, offset = unpack_varint(data, offset)
+    names = []
+    for _ in range(count):
+        name, offset = unpack_short_string(data, offset, version)
+        names.append(name)
+    return names, offset
+
+def pack_directory_reply(directory_version, reset, more, added, removed, next_token="", version=PROTOCOL_V1):
+    flags = (DIRECTORY_RESET if reset else 0) | (DIRECTORY_MORE if more else 0)
+    return (pack_varint(directory_version) + pack_varint(flags) + pack_name_list(added, version) +
+            pack_name_list(removed, version) + pack_short_string(next_token, version))
+
+def unpack_directory_reply(data, version=PROTOCOL_V1):
+    # Returns a dict with version, reset, more, added, removed and next
+    directory_version, offset = unpack_varint(data, 0)
+    flags, offset = unpack_varint(data, offset)
+    added, offset = unpack_name_list(data, offset, version)
+    removed, offset = unpack_name_list(data, offset, version)
+    next_token, offset = unpack_short_string(data, offset, version)
+    return {"version": directory_version, "reset": bool(flags & DIRECTORY_RESET), "more": bool(flags & DIRECTORY_MORE),
+            "added": added, "removed": removed, "next": next_token}
+
+# Presence (CMD_PRESENCE): the request is a varint, 1 to subscribe and 0 to unsubscribe, and the reply is the same
+# flag followed by the counted list of users online now. Subscribers are then pushed CMD_PRESENCE_EVENTS frames:
+# a varint count of (username short string, varint event code) pairs.
+
+PRESENCE_EVENTS = ("created", "online", "offline", "deleted")
+
+def encode_presence_events(events, version=PROTOCOL_V1):
+    # (username, event) pairs as one or more CMD_PRESENCE_EVENTS frames; v1 frames stay under 64 KB
+    step = DIRECTORY_PAGE_V1 if version < PROTOCOL_V2 else max(len(events), 1)
+    frames = []
+    for start in range(0, len(events), step):
+        chunk = events[start:start + step]
+        payload = pack_varint(len(chunk)) + b"".join(
+            pack_short_string(name, version) + pack_varint(PRESENCE_EVENTS.index(event) + 1) for name, event in chunk)
+        frames.append(encode_message(CMD_PRESENCE_EVENTS, payload, version))
+    return frames
+
+def unpack_presence_events(data, version=PROTOCOL_V1):
+    count, offset = unpack_varint(data, 0)
+    events = []
+    for _ in range(count):
+        name, offset = unpack_short_string(data, offset, version)
+        code, offset = unpack_varint(data, offset)
+        events.append((name, PRESENCE_EVENTS[code - 1]))
+    return events
+
+def encode_message(cmd, payload_bytes, version=PROTOCOL_V1):
     # Build the header by packing the command and the length of the payload
-    header = struct.pack(HEADER_FORMAT, cmd, len(payload_bytes))
+    if version >= PROTOCOL_V2:
+        header = struct.pack("!B", cmd) + pack_varint(len(payload_bytes))
+    else:
+        header = struct.pack(HEADER_FORMAT, cmd, len(payload_bytes))
     return header + payload_bytes
 
-def decode_message(sock):
-    # Read the header from the socket
-    header = b""
-    while len(header) < HEADER_SIZE:
-        chunk = sock.recv(HEADER_SIZE - len(header))
-        if not chunk:
-            raise Exception("Connection closed while reading header.")
-        header += chunk
-
-    cmd, payload_len = struct.unpack(HEADER_FORMAT, header)
-    
+def unpack_header(data, offset, end, version=PROTOCOL_V1):
+    # Parse the frame header at data[offset:end]; returns (cmd, payload_len, header_len), or None if incomplete
+    if version < PROTOCOL_V2:
+        if end - offset < HEADER_SIZE:
+            return None
+        cmd, payload_len = struct.unpack_from(HEADER_FORMAT, data, offset)
+        return cmd, payload_len, HEADER_SIZE
+    pos = offset + 1
+    while pos < end and data[pos] & 0x80:
+        pos += 1
+    if pos >= end:
+        if pos - offset > MAX_VARINT_LEN:
+            raise ValueError("Frame length varint too long.")
+        return None
+    payload_len, pos = unpack_varint(data, offset + 1)
+    if payload_len > MAX_PAYLOAD_V2:
+        raise ValueError("Frame too large.")
+    return data[offset], payload_len, pos - offset
+
+def encode_batch(frames, version=PROTOCOL_V1):
+    # Wrap already-encoded frames into as few CMD_BATCH frames as fit the 16-bit length (always one in v2).
+    # Every frame but the last sets the "more" flag, so a reader knows when the reply is complete.
+    if version >= PROTOCOL_V2:
+        payload = struct.pack("!B", 0) + pack_varint(len(frames)) + b"".join(frames)
+        return [encode_message(CMD_BATCH, payload, version)]
+    batches = []
+    body, count = [], 0
+    size = 0
+    for frame in frames:
+        if len(frame) > MAX_BATCH_BODY:
+            raise ValueError("Frame too long to fit in a batch.")
+        if size + len(frame) > MAX_BATCH_BODY:
+            batches.append((body, count))
+            body, count, size = [], 0, 0
+        body.append(frame)
+        count += 1
+        size += len(frame)
+    batches.append((body, count))
+    out = []
+    for i, (body, count) in enumerate(batches):
+        more = 1 if i < len(batches) - 1 else 0
+        out.append(encode_message(CMD_BATCH, struct.pack(BATCH_HEADER_FORMAT, more, count) + b"".join(body)))
+    return out
+
+def unpack_batch(data, version=PROTOCOL_V1):
+    # Split a CMD_BATCH payload into (more, [(cmd, payload), ...]); payloads are slices of data
+    if version >= PROTOCOL_V2:
+        more = data[0]
+        count, offset = unpack_varint(data, 1)
+    else:
+        more, count = struct.unpack_from(BATCH_HEADER_FORMAT, data, 0)
+        offset = BATCH_HEADER_SIZE
+    frames = []
+    for _ in range(count):
+        header = unpack_header(data, offset, len(data), version)
+        if header is None:
+            raise ValueError("Truncated frame in batch.")
+        cmd, payload_len, header_len = header
+        offset += header_len
+        if len(data) - offset < payload_len:
+            raise ValueError("Truncated frame in batch.")
+        frames.append((cmd, data[offset:offset+payload_len]))
+        offset += payload_len
+    return more, frames
+
+def decode_message(sock, version=PROTOCOL_V1):
+    # Read one frame straight into preallocated buffers (used by clients that read a frame at a time)
+    if version >= PROTOCOL_V2:
+        # The varint length is read a byte at a time, up to its last byte
+        header = bytearray(1)
+        recv_exact(sock, memoryview(header), "Connection closed while reading header.")
+        cmd = header[0]
+        length = bytearray()
+        while not length or length[-1] & 0x80:
+            if len(length) >= MAX_VARINT_LEN:
+                raise ValueError("Frame length varint too long.")
+            recv_exact(sock, memoryview(header), "Connection closed while reading header.")
+            length += header
+        payload_len = unpack_varint(length, 0)[0]
+        if payload_len > MAX_PAYLOAD_V2:
+            raise ValueError("Frame too large.")
+    else:
+        header = bytearray(HEADER_SIZE)
+        recv_exact(sock, memoryview(header), "Connection closed while reading header.")
+        cmd, payload_len = struct.unpack(HEADER_FORMAT, header)
+
     # Read the payload based on the length specified in the header
-    payload = b""
-    while len(payload) < payload_len:
-        # Receive remaining payload bytes from the socket
-        chunk = sock.recv(payload_len - len(payload))
-        if not chunk:
-            raise Exception("Connection closed while reading payload.")
-        payload += chunk
+    payload = bytearray(payload_len)
+    recv_exact(sock, memoryview(payload), "Connection closed while reading payload.")
     return cmd, payload
+
+def recv_exact(sock, view, closed_msg):
+    # Fill the whole view from the socket, one recv_into per chunk the kernel hands back
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n:
+            raise Exception(closed_msg)
+        got += n
+
+RECV_BUFFER_SIZE = 65536
+
+class FrameReader:
+    # Buffered reader for one connection: recv_into a reusable bytearray and parse as many frames
+    # as each read delivered. Payloads are memoryviews into that buffer, valid only until the next
+    # read or next_frame call, so handlers must decode (copy) whatever they keep.
+    # version can be raised mid-stream once the connection negotiates v2 framing.
+    def __init__(self, sock, bufsize=RECV_BUFFER_SIZE, version=PROTOCOL_V1):
+        self.sock = sock
+        self.version = version
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def fill(self):
+        # One recv_into the free tail of the buffer; returns the byte count, 0 meaning the peer closed
+        if self.end == len(self.buf):
+            self.compact()
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def compact(self, need=0):
+        # Slide the unparsed bytes to the front; grow only when a single frame is bigger than the buffer
+        pending = self.end - self.start
+        if need > len(self.buf):
+            buf = bytearray(max(need, 2 * len(self.buf)))
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        elif self.start:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def next_frame(self):
+        # Return the next complete buffered frame as (cmd, payload view), or None if more bytes are needed
+        available = self.end - self.start
+        header = unpack_header(self.buf, self.start, self.end, self.version)
+        if header is None:
+            return None
+        cmd, payload_len, header_len = header
+        frame_len = header_len + payload_len
+        if available < frame_len:
+            if self.start + frame_len > len(self.buf):
+                self.compact(frame_len)
+            return None
+        payload = self.view[self.start + header_len:self.start + frame_len]
+        self.start += frame_len
+        if self.start == self.end:
+            self.start = self.end = 0
+        return cmd, payload
+
+    def read_frame(self):
+        # Blocking read of the next frame; only touches the socket when the buffer has no complete frame
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.fill():
+                if self.end > self.start:
+                    raise Exception("Connection closed while reading payload.")
+                raise Exception("Connection closed while reading header.")
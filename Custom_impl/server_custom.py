@@ -1,241 +1,645 @@
 import socket
+import sys
 import struct
-import fnmatch
+import selectors
+import time
+from collections import deque
 import threading
-import datetime
 import hashlib
+import os
+
+# The store, write-ahead log and outbox are shared with the JSON implementation and live in ../shared
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
 
 from protocol_custom import (
     HEADER_SIZE,
     CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_READ,
     CMD_DELETE_MSG, CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_CHAT, CMD_LIST, CMD_READ_ACK,
-    encode_message, decode_message,
-    pack_short_string, pack_long_string,
-    unpack_short_string, unpack_long_string
+    CMD_CHAT, CMD_LIST, CMD_READ_ACK, CMD_BATCH, CMD_HELLO, CMD_HISTORY, CMD_DIRECTORY,
+    CMD_PRESENCE, PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_VERSION,
+    encode_message, encode_batch, unpack_batch, MAX_BATCH_BODY, FrameReader,
+    pack_short_string, pack_long_string, chat_fits, MAX_PAYLOAD_V1,
+    pack_uint, unpack_short_string, unpack_long_string, unpack_uint, unpack_varint,
+    pack_history_record, pack_history, pack_history_error, MAX_HISTORY_BODY_V1, MAX_VARINT_LEN,
+    pack_directory_reply, DIRECTORY_PAGE_V1, pack_varint, pack_name_list, encode_presence_events
 )
 
+from outbox import Outbox, OUTBOX_DEPTH, SEND_DEADLINE, IOV_MAX, advance_views, return_push
+from store import ChatStore, format_timestamp
+from sqlite_store import SqliteStore
+from wal import WriteAheadLog
+
 CMD_DELETE = CMD_DELETE_ACC 
 
-# Data stores for user info, active connections, and conversation history
-users = {}         
-active_users = {} 
-conversations = {} 
-next_message_id = 1
+# Data store for user info, active connections, and conversation history, shared by every handler thread
+store = ChatStore()
 
-def get_matching_users(wildcard="*"):
-    # Return list of usernames matching the given wildcard pattern
-    return fnmatch.filter(list(users.keys()), wildcard)
+class ReactorConnection:
+    # Non-blocking connection owned by the selectors loop; sendall only queues, the loop drains it
+    def __init__(self, sock, addr, selector, max_depth=OUTBOX_DEPTH, send_deadline=SEND_DEADLINE):
+        self.sock = sock
+        self.addr = addr
+        self.selector = selector
+        self.reader = FrameReader(sock)
+        # Frames waiting for the socket as (data, deadline, on_drop); replies have no deadline
+        self.pending = deque()
+        # Views of frames already picked for the socket, possibly partially written, and the on_drop of each
+        self.outgoing = []
+        self.outgoing_drops = []
+        # Whether the selector is watching for writability
+        self.write_wanted = False
+        self.max_depth = max_depth
+        self.send_deadline = send_deadline
+        self.closed = False
+        self.version = PROTOCOL_V1
+        # Largest payload a v1 frame to this connection can carry
+        self.payload_limit = MAX_PAYLOAD_V1
 
-def handle_client(conn, addr):
-    global next_message_id
-    print(f"[NEW CONNECTION] {addr} connected.")
+    def sendall(self, data):
+        # Replies are only queued here; the reactor flushes once the whole command has been handled
+        if self.closed:
+            raise OSError("Connection is closed")
+        self.pending.append((data, None, None))
+
+    def push(self, data, on_drop):
+        # Live delivery for another user: bounded, and handed back through on_drop rather than queued forever
+        if self.closed or len(self.pending) >= self.max_depth:
+            on_drop()
+            return False
+        self.pending.append((data, time.monotonic() + self.send_deadline, on_drop))
+        # Not written yet: the loop flushes it once the round that produced it has been committed
+        if not self.write_wanted:
+            self.selector.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+            self.write_wanted = True
+        return True
+
+    def flush(self):
+        # Gather queued frames into sendmsg calls until the socket is full, then watch for writability
+        # only if something is left. Deadlines are checked when a frame is picked for a write, so
+        # pushes that waited too long behind a slow reader go to the mailbox instead.
+        if self.closed:
+            return
+        try:
+            while True:
+                if not self.outgoing:
+                    now = time.monotonic()
+                    while self.pending and len(self.outgoing) < IOV_MAX:
+                        data, deadline, on_drop = self.pending.popleft()
+                        if deadline is not None and now > deadline:
+                            return_push(on_drop)
+                            continue
+                        self.outgoing.append(memoryview(data))
+                        self.outgoing_drops.append(on_drop)
+                    if not self.outgoing:
+                        break
+                sent = self.sock.sendmsg(self.outgoing)
+                advance_views(self.outgoing, sent)
+                del self.outgoing_drops[:len(self.outgoing_drops) - len(self.outgoing)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+            return
+        self.write_wanted = bool(self.outgoing or self.pending)
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.write_wanted else 0)
+        self.selector.modify(self.sock, events, self)
+
+    def on_readable(self):
+        try:
+            received = self.reader.fill()
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.close()
+            return
+        # Dispatch every complete frame this read delivered; a partial frame stays buffered for the next one
+        while not self.closed:
+            frame = self.reader.next_frame()
+            if frame is None:
+                break
+            cmd, payload = frame
+            if not handle_command(self, cmd, payload):
+                print(f"[DISCONNECT] {self.addr} requested close.")
+                self.close()
+                return
+            # A CMD_HELLO may have switched the framing for the frames that follow
+            self.reader.version = self.version
+        # Replies wait in pending until the loop has committed the log for this round of events, then it flushes
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Live pushes that never made it out, including any only partly written, go back to their recipients'
+        # mailboxes
+        for on_drop in self.outgoing_drops:
+            if on_drop is not None:
+                return_push(on_drop)
+        for data, deadline, on_drop in self.pending:
+            if on_drop is not None:
+                return_push(on_drop)
+        self.outgoing = []
+        self.outgoing_drops = []
+        self.pending.clear()
+        store.presence.unsubscribe(self)
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        print(f"Connection closed: {self.addr}")
+
+class BatchReplies:
+    # Stands in for the connection while a CMD_BATCH runs: replies are collected so the whole batch is
+    # answered at once, while live pushes (the session may log in inside the batch) go to the real connection
+    def __init__(self, conn):
+        self.conn = conn
+        self.frames = []
+        # A v1 reply has to fit in the batch frame along with its own header
+        self.payload_limit = MAX_BATCH_BODY - HEADER_SIZE
+
+    @property
+    def version(self):
+        return self.conn.version
+
+    def sendall(self, data):
+        if self.version < PROTOCOL_V2 and len(data) > MAX_BATCH_BODY:
+            data = encode_message(0, pack_short_string("Reply too long for a batch"))
+        self.frames.append(data)
+
+    def push(self, data, on_drop):
+        return self.conn.push(data, on_drop)
+
+class ClientOutbox(Outbox):
+    # Threaded-mode connection: the shared outbox plus the protocol version negotiated on this socket
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.version = PROTOCOL_V1
+        self.payload_limit = MAX_PAYLOAD_V1
+
+def serve_reactor(server_sock):
+    # Single-threaded event loop: one selector multiplexes the listening socket and every client
+    selector = selectors.DefaultSelector()
+    server_sock.setblocking(False)
+    selector.register(server_sock, selectors.EVENT_READ, None)
+    # Presence batches go out from this loop rather than a timer thread, since connections are not thread-safe.
+    # Starting a batch only writes to a wakeup socket so a blocked select() notices the new deadline.
+    waker_r, waker_w = socket.socketpair()
+    waker_r.setblocking(False)
+    waker_w.setblocking(False)
+    selector.register(waker_r, selectors.EVENT_READ, "wake")
+    def wake(delay, callback):
+        try:
+            waker_w.send(b"\0")
+        except OSError:
+            pass
+    store.presence.schedule = wake
     try:
         while True:
-            # Decode the incoming command and its payload from the client
-            cmd, payload = decode_message(conn)
+            store.presence.flush_due()
+            # Connections with something to write this round: replies, or pushes from other connections' commands.
+            # Nothing is written until the round's log records are committed.
+            ready = []
+            for key, mask in selector.select(store.presence.time_until_due()):
+                if key.data == "wake":
+                    try:
+                        waker_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                if key.data is None:
+                    try:
+                        conn, addr = server_sock.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    print(f"[NEW CONNECTION] {addr} connected.")
+                    selector.register(conn, selectors.EVENT_READ, ReactorConnection(conn, addr, selector))
+                    continue
+                client = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        ready.append(client)
+                    if mask & selectors.EVENT_READ and not client.closed:
+                        client.on_readable()
+                        ready.append(client)
+                except Exception as e:
+                    print(f"Error handling client {client.addr}: {e}")
+                    client.close()
+            if ready:
+                try:
+                    store.commit()
+                except OSError as e:
+                    # Nothing from this round is durable, so none of its replies may go out
+                    print(f"Error committing the log: {e}")
+                    for client in ready:
+                        client.close()
+                    continue
+                for client in ready:
+                    client.flush()
+    finally:
+        selector.close()
+        waker_r.close()
+        waker_w.close()
+
+def get_matching_users(wildcard="*"):
+    # Return list of usernames matching the given wildcard pattern
+    return store.list_users(wildcard)
 
-            if cmd == CMD_LOGIN:
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                password, offset = unpack_short_string(payload, offset)
-                if username not in users:
+def push_presence(conn, events):
+    # Presence frames are best effort: one the connection cannot take is simply dropped
+    for frame in encode_presence_events(events, conn.version):
+        conn.push(frame, lambda: None)
+
+def format_conversation_line(msg):
+    return f"[ID {msg.id}] [{format_timestamp(msg.timestamp)}] {msg.sender}: {msg.message}\n"
+
+def handle_command(conn, cmd, payload):
+    # Run one decoded command and reply over conn; returns False once the client asks to close.
+    # Payloads are parsed and replies encoded in the protocol version negotiated on conn.
+    v = conn.version
+    if cmd == CMD_LOGIN:
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        password, offset = unpack_short_string(payload, offset, v)
+        stored_hash = store.password_hash(username)
+        if stored_hash is None:
+            resp = "Username does not exist"
+        else:
+            hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
+            if hashed != stored_hash:
+                resp = "Incorrect password"
+            else:
+                unread_count = store.login(username, conn)
+                if unread_count is None:
                     resp = "Username does not exist"
                 else:
-                    stored_hash = users[username]["password_hash"]
-                    hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
-                    if hashed != stored_hash:
-                        resp = "Incorrect password"
-                    else:
-                        active_users[username] = conn
-                        unread_count = len(users[username]["messages"])
-                        resp = f"Login successful. Unread messages: {unread_count}"
-                conn.sendall(encode_message(CMD_LOGIN, pack_short_string(resp)))
-
-            elif cmd == CMD_CREATE:
-                # Extract username and password and create new user if not exists
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                password, offset = unpack_short_string(payload, offset)
-                if username in users:
-                    resp = "Username already exists"
-                else:
-                    hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
-                    users[username] = {"password_hash": hashed, "messages": []}
-                    resp = "Account created"
-                conn.sendall(encode_message(CMD_CREATE, pack_short_string(resp)))
-
-            elif cmd == CMD_LIST:
-                offset = 0
-                wildcard = unpack_short_string(payload, offset)[0] if payload else "*"
-                matching = fnmatch.filter(list(users.keys()), wildcard)
-                matching_str = ",".join(matching)
-                conn.sendall(encode_message(CMD_LIST, pack_long_string(matching_str)))
-
-            elif cmd == CMD_SEND:
-                # Get sender, recipient, and message text
-                offset = 0
-                sender, offset = unpack_short_string(payload, offset)
-                recipient, offset = unpack_short_string(payload, offset)
-                msg_text, offset = unpack_long_string(payload, offset)
-                # Record message in conversation history with timestamp and unique ID
-                conv_key = tuple(sorted([sender, recipient]))
-                if conv_key not in conversations:
-                    conversations[conv_key] = []
-                timestamp = datetime.datetime.now().isoformat()
-                message_entry = {"id": next_message_id, "sender": sender, "message": msg_text, "timestamp": timestamp}
-                next_message_id += 1
-                conversations[conv_key].append(message_entry)
-                # If recipient exists and is active, deliver message immediately; otherwise, store as unread
-                if recipient not in users:
-                    resp = "Recipient not found"
-                else:
-                    if recipient in active_users:
-                        try:
-                            live_payload = pack_short_string(sender) + pack_long_string(msg_text)
-                            active_users[recipient].sendall(encode_message(CMD_CHAT, live_payload))
-                        except Exception:
-                            users[recipient]["messages"].append({"sender": sender, "message": msg_text})
-                    else:
-                        users[recipient]["messages"].append({"sender": sender, "message": msg_text})
-                    resp = "Message sent"
-                conn.sendall(encode_message(CMD_SEND, pack_short_string(resp)))
-
-            elif cmd == CMD_READ:
-                # Send unread messages to the user, up to an optional limit
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                limit = struct.unpack_from("!B", payload, offset)[0] if offset < len(payload) else 0
-                if username not in users:
-                    resp = "User not found"
-                    conn.sendall(encode_message(CMD_READ, pack_long_string(resp)))
-                else:
-                    msgs = users[username]["messages"]
-                    msgs_to_send = msgs[:limit] if limit > 0 else msgs
-                    users[username]["messages"] = msgs[limit:] if limit > 0 else []
-                    if not msgs_to_send:
-                        conn.sendall(encode_message(CMD_READ, pack_long_string("NO_MESSAGES")))
-                    else:
-                        for message in msgs_to_send:
-                            one_msg = pack_short_string(message["sender"]) + pack_long_string(message["message"])
-                            conn.sendall(encode_message(CMD_READ, one_msg))
-                        conn.sendall(encode_message(CMD_READ, pack_long_string("END_OF_MESSAGES")))
+                    resp = f"Login successful. Unread messages: {unread_count}"
+        conn.sendall(encode_message(CMD_LOGIN, pack_short_string(resp, v), v))
 
-            elif cmd == CMD_DELETE_MSG:
-                # Supports deleting from conversation or unread messages
-                try:
-                    offset = 0
-                    username, offset = unpack_short_string(payload, offset)
-                    if len(payload) - offset >= 1:
-                        potential_other_len = payload[offset]
-                        if potential_other_len != 0 and (len(payload) - offset >= 1 + potential_other_len):
-                            other_user, offset = unpack_short_string(payload, offset)
-                            if len(payload) - offset < 1:
-                                raise ValueError("Not enough bytes for count")
-                            count = struct.unpack_from("!B", payload, offset)[0]
-                            offset += 1
-                            if len(payload) - offset < count:
-                                raise ValueError("Not enough bytes for message IDs")
-                            ids_to_delete = [struct.unpack_from("!B", payload, offset + i)[0] for i in range(count)]
-                            offset += count
-                            conv_key = tuple(sorted([username, other_user]))
-                            if conv_key not in conversations:
-                                resp = "No conversation found"
-                            else:
-                                conv = conversations[conv_key]
-                                conversations[conv_key] = [msg for msg in conv if msg.get("id") not in ids_to_delete]
-                                resp = "Specified conversation messages deleted"
-                            conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-                            continue
+    elif cmd == CMD_CREATE:
+        # Extract username and password and create new user if not exists
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        password, offset = unpack_short_string(payload, offset, v)
+        hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        if not store.create_user(username, hashed):
+            resp = "Username already exists"
+        else:
+            resp = "Account created"
+        conn.sendall(encode_message(CMD_CREATE, pack_short_string(resp, v), v))
+
+    elif cmd == CMD_LIST:
+        offset = 0
+        wildcard, offset = unpack_short_string(payload, offset, v) if payload else ("*", 0)
+        if offset < len(payload):
+            # Paged listing: page size and the previous page's token follow the wildcard. The reply carries the
+            # token for the next page, empty on the last one.
+            limit, offset = unpack_varint(payload, offset)
+            after, offset = unpack_short_string(payload, offset, v)
+            matching, next_token = store.list_users_page(wildcard, after or None, limit)
+            if v < PROTOCOL_V2:
+                # Keep the names within one v1 long string and continue the listing from the last one kept
+                size = -1
+                for i, name in enumerate(matching):
+                    size += len(name.encode("utf-8")) + 1
+                    if size > 65535:
+                        matching = matching[:i]
+                        next_token = matching[-1] if matching else None
+                        break
+            reply = pack_long_string(",".join(matching), v) + pack_short_string(next_token or "", v)
+            conn.sendall(encode_message(CMD_LIST, reply, v))
+        else:
+            matching = store.list_users(wildcard)
+            matching_str = ",".join(matching)
+            conn.sendall(encode_message(CMD_LIST, pack_long_string(matching_str, v), v))
+
+    elif cmd == CMD_DIRECTORY:
+        # Usernames added and removed since the client's directory version. A client with no version, or one
+        # further behind than the server remembers, gets a reset and pages through every username instead.
+        offset = 0
+        since, offset = unpack_varint(payload, offset)
+        limit, offset = unpack_varint(payload, offset)
+        after, offset = unpack_short_string(payload, offset, v)
+        if v < PROTOCOL_V2:
+            # Keep the names within one v1 frame
+            limit = min(limit, DIRECTORY_PAGE_V1) if limit > 0 else DIRECTORY_PAGE_V1
+        delta = store.directory_changes(since, limit)
+        if delta is not None:
+            version, added, removed, more = delta
+            reply = pack_directory_reply(version, False, more, added, removed, "", v)
+        else:
+            # Read the version before listing so changes made during the listing come back in a later delta
+            version = store.directory_version
+            names, next_token = store.list_users_page("*", after or None, limit)
+            reply = pack_directory_reply(version, True, next_token is not None, names, [], next_token or "", v)
+        conn.sendall(encode_message(CMD_DIRECTORY, reply, v))
 
+    elif cmd == CMD_PRESENCE:
+        # Subscribe (1) or unsubscribe (0) this connection from pushed presence events. Inside a batch the
+        # subscription belongs to the real connection, not the stand-in collecting the batch's replies.
+        subscribe, _ = unpack_varint(payload, 0) if payload else (1, 0)
+        target = conn.conn if isinstance(conn, BatchReplies) else conn
+        if subscribe:
+            store.presence.subscribe(target, lambda events: push_presence(target, events))
+            # Who is online now, so the subscriber starts from a known state; a v1 reply holds the first names only
+            online = store.online_users()
+            if v < PROTOCOL_V2:
+                online = online[:DIRECTORY_PAGE_V1]
+            reply = pack_varint(1) + pack_name_list(online, v)
+        else:
+            store.presence.unsubscribe(target)
+            reply = pack_varint(0) + pack_name_list([], v)
+        conn.sendall(encode_message(CMD_PRESENCE, reply, v))
+
+    elif cmd == CMD_SEND:
+        # Get sender, recipient, and message text
+        offset = 0
+        sender, offset = unpack_short_string(payload, offset, v)
+        recipient, offset = unpack_short_string(payload, offset, v)
+        msg_text, offset = unpack_long_string(payload, offset, v)
+        # Record message in conversation history with timestamp and unique ID
+        message_entry = store.record_message(sender, recipient, msg_text)
+        # If recipient exists and is active, deliver message immediately; otherwise, store as unread
+        if not store.user_exists(recipient):
+            resp = "Recipient not found"
+        else:
+            recipient_conn = store.get_active(recipient)
+            rv = recipient_conn.version if recipient_conn is not None else None
+            if recipient_conn is not None and chat_fits(sender, msg_text, rv, recipient_conn.payload_limit):
+                # Queue on the recipient's connection; a backed-up recipient gets it in the unread mailbox instead
+                live_payload = pack_short_string(sender, rv) + pack_long_string(msg_text, rv)
+                recipient_conn.push(encode_message(CMD_CHAT, live_payload, rv),
+                                    lambda: store.append_unread(recipient, message_entry))
+            else:
+                # Offline, or a v1 session that cannot take a frame this long: it waits in the mailbox
+                store.append_unread(recipient, message_entry)
+            resp = "Message sent"
+        conn.sendall(encode_message(CMD_SEND, pack_short_string(resp, v), v))
+
+    elif cmd == CMD_READ:
+        # Send unread messages to the user, up to an optional limit
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        limit = unpack_uint(payload, offset, v)[0] if offset < len(payload) else 0
+        # Only messages that fit the reader's frames leave the mailbox; reading stops at the first that does not
+        fits = None
+        if v < PROTOCOL_V2:
+            fits = lambda message: chat_fits(message.sender, message.message, v, conn.payload_limit)
+        msgs_to_send = store.pop_unread(username, limit, fits)
+        if msgs_to_send is None:
+            resp = "User not found"
+            conn.sendall(encode_message(CMD_READ, pack_long_string(resp, v), v))
+        else:
+            if not msgs_to_send and fits is not None and store.unread_count(username):
+                resp = "Message too long for protocol v1"
+                conn.sendall(encode_message(CMD_READ, pack_long_string(resp, v), v))
+            elif not msgs_to_send:
+                conn.sendall(encode_message(CMD_READ, pack_long_string("NO_MESSAGES", v), v))
+            else:
+                for message in msgs_to_send:
+                    one_msg = pack_short_string(message.sender, v) + pack_long_string(message.message, v)
+                    conn.sendall(encode_message(CMD_READ, one_msg, v))
+                conn.sendall(encode_message(CMD_READ, pack_long_string("END_OF_MESSAGES", v), v))
+
+    elif cmd == CMD_DELETE_MSG:
+        # Supports deleting from conversation or unread messages
+        try:
+            offset = 0
+            username, offset = unpack_short_string(payload, offset, v)
+            if len(payload) - offset >= 1:
+                potential_other_len, len_end = unpack_uint(payload, offset, v)
+                if potential_other_len != 0 and (len(payload) - len_end >= potential_other_len):
+                    other_user, offset = unpack_short_string(payload, offset, v)
                     if len(payload) - offset < 1:
-                        raise ValueError("Not enough bytes for count in unread deletion")
-                    count = struct.unpack_from("!B", payload, offset)[0]
-                    offset += 1
-                    indices = [struct.unpack_from("!B", payload, offset + i)[0] for i in range(count)]
-                    offset += count
-                    if username not in users:
-                        resp = "User not found"
-                    else:
-                        current_msgs = users[username]["messages"]
-                        users[username]["messages"] = [msg for i, msg in enumerate(current_msgs) if i not in indices]
-                        resp = "Specified messages deleted"
-                    conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-                except Exception as e:
-                    print("Error in CMD_DELETE_MSG:", e)
-                    resp = "Error processing delete message command"
-                    conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-
-            elif cmd == CMD_VIEW_CONV:
-                # Return formatted conversation history between two users
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                other_user, offset = unpack_short_string(payload, offset)
-                if other_user not in users:
-                    resp = "User not found"
-                    conn.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(resp)))
-                else:
-                    conv_key = tuple(sorted([username, other_user]))
-                    conv = conversations.get(conv_key, [])
-                    if not conv:
-                        resp = "No conversation history found"
-                        conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(resp)))
+                        raise ValueError("Not enough bytes for count")
+                    count, offset = unpack_uint(payload, offset, v)
+                    if len(payload) - offset < count:
+                        raise ValueError("Not enough bytes for message IDs")
+                    # One byte per id in v1 (so only ids up to 255), a varint per id in v2
+                    ids_to_delete = []
+                    for _ in range(count):
+                        msg_id, offset = unpack_uint(payload, offset, v)
+                        ids_to_delete.append(msg_id)
+                    if not store.delete_conversation_messages(username, other_user, ids_to_delete):
+                        resp = "No conversation found"
                     else:
-                        formatted = ""
-                        for msg in conv:
-                            formatted += f"[ID {msg.get('id', '?')}] [{msg.get('timestamp', '')}] {msg.get('sender', '')}: {msg.get('message', '')}\n"
-                        conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(formatted)))
-
-            elif cmd == CMD_DELETE:
-                # Remove user from records and active users
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                if username not in users:
-                    resp = "User does not exist"
+                        resp = "Specified conversation messages deleted"
+                    conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp, v), v))
+                    return True
+
+            if len(payload) - offset < 1:
+                raise ValueError("Not enough bytes for count in unread deletion")
+            count, offset = unpack_uint(payload, offset, v)
+            indices = []
+            for _ in range(count):
+                index, offset = unpack_uint(payload, offset, v)
+                indices.append(index)
+            if not store.delete_unread_positions(username, indices):
+                resp = "User not found"
+            else:
+                resp = "Specified messages deleted"
+            conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp, v), v))
+        except Exception as e:
+            print("Error in CMD_DELETE_MSG:", e)
+            resp = "Error processing delete message command"
+            conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp, v), v))
+
+    elif cmd == CMD_VIEW_CONV:
+        # Return formatted conversation history between two users. In v2 the request may end with
+        # before id, after id and page size (0 meaning unset); the reply then carries one page followed by
+        # a more flag and the first and last ids shown, which are the cursors for the neighbouring pages.
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        other_user, offset = unpack_short_string(payload, offset, v)
+        paged = v >= PROTOCOL_V2 and offset < len(payload)
+        if not store.user_exists(other_user):
+            resp = "User not found"
+            conn.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(resp, v), v))
+        elif paged:
+            before, offset = unpack_uint(payload, offset, v)
+            after, offset = unpack_uint(payload, offset, v)
+            limit, offset = unpack_uint(payload, offset, v)
+            page, more = store.get_conversation_page(username, other_user, before or None, after or None, limit)
+            formatted = "".join(format_conversation_line(msg) for msg in page)
+            first_id = page[0].id if page else 0
+            last_id = page[-1].id if page else 0
+            reply = pack_long_string(formatted, v) + pack_uint(int(more), v) + pack_uint(first_id, v) + pack_uint(last_id, v)
+            conn.sendall(encode_message(CMD_VIEW_CONV, reply, v))
+        else:
+            conv = store.get_conversation(username, other_user)
+            if not conv:
+                resp = "No conversation history found"
+                conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(resp, v), v))
+            else:
+                lines = [format_conversation_line(msg) for msg in conv]
+                if v < PROTOCOL_V2:
+                    # A v1 frame stops at 64 KB: keep the newest lines that fit
+                    kept, size = [], 2
+                    for line in reversed(lines):
+                        size += len(line.encode("utf-8"))
+                        if size > conn.payload_limit:
+                            break
+                        kept.append(line)
+                    lines = kept[::-1]
+                if lines:
+                    conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string("".join(lines), v), v))
                 else:
-                    del users[username]
-                    if username in active_users:
-                        del active_users[username]
-                    resp = "Account deleted"
-                conn.sendall(encode_message(CMD_DELETE, pack_short_string(resp)))
-
-            elif cmd == CMD_LOGOFF:
-                # Log off the user
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                if username in active_users:
-                    del active_users[username]
-                resp = "User logged off"
-                conn.sendall(encode_message(CMD_LOGOFF, pack_short_string(resp)))
-
-            elif cmd == CMD_CLOSE:
-                print(f"[DISCONNECT] {addr} requested close.")
+                    resp = "Message too long for protocol v1"
+                    conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(resp, v), v))
+
+    elif cmd == CMD_HISTORY:
+        # Structured history page: username, other user, then before id, after id and page size as varints
+        # (0 meaning unset) in every protocol version. The reply is records rather than formatted text.
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        other_user, offset = unpack_short_string(payload, offset, v)
+        before, offset = unpack_varint(payload, offset)
+        after, offset = unpack_varint(payload, offset)
+        limit, offset = unpack_varint(payload, offset)
+        if not store.user_exists(other_user):
+            conn.sendall(encode_message(CMD_HISTORY, pack_history_error("User not found", v), v))
+            return True
+        page, more = store.get_conversation_page(username, other_user, before or None, after or None, limit)
+        store.clear_unread_from(username, other_user)
+        if v < PROTOCOL_V2:
+            # A v1 frame stops at 64 KB: keep the records nearest the cursor and report the rest as more. The
+            # size is checked before packing, since a long string over 64 KB cannot be packed at all.
+            forward = bool(after) and not before
+            ordered = page if forward else page[::-1]
+            kept, size = [], 0
+            for msg in ordered:
+                if not chat_fits(msg.sender, msg.message, v, MAX_HISTORY_BODY_V1 - size - MAX_VARINT_LEN - 8):
+                    more = True
+                    break
+                record = pack_history_record(msg.id, msg.timestamp, msg.sender, msg.message, v)
+                kept.append(record)
+                size += len(record)
+            if page and not kept:
+                conn.sendall(encode_message(CMD_HISTORY, pack_history_error("Message too long for protocol v1", v), v))
+                return True
+            records = kept if forward else kept[::-1]
+        else:
+            records = [pack_history_record(msg.id, msg.timestamp, msg.sender, msg.message, v) for msg in page]
+        conn.sendall(encode_message(CMD_HISTORY, pack_history(records, more, v), v))
+
+    elif cmd == CMD_DELETE:
+        # Remove user from records and active users
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        if not store.delete_user(username):
+            resp = "User does not exist"
+        else:
+            resp = "Account deleted"
+        conn.sendall(encode_message(CMD_DELETE, pack_short_string(resp, v), v))
+
+    elif cmd == CMD_LOGOFF:
+        # Log off the user
+        offset = 0
+        username, offset = unpack_short_string(payload, offset, v)
+        store.logoff(username)
+        resp = "User logged off"
+        conn.sendall(encode_message(CMD_LOGOFF, pack_short_string(resp, v), v))
+
+    elif cmd == CMD_BATCH:
+        # Run each sub-frame in order and answer with all of their replies in one aggregated CMD_BATCH reply
+        try:
+            more, frames = unpack_batch(payload, v)
+        except Exception as e:
+            print("Error in CMD_BATCH:", e)
+            conn.sendall(encode_message(0, pack_short_string("Malformed batch", v), v))
+            return True
+        replies = BatchReplies(conn)
+        keep_open = True
+        for sub_cmd, sub_payload in frames:
+            if sub_cmd in (CMD_BATCH, CMD_HELLO):
+                replies.sendall(encode_message(0, pack_short_string("Not allowed inside a batch", v), v))
+            elif not handle_command(replies, sub_cmd, sub_payload):
+                keep_open = False
                 break
+        for frame in encode_batch(replies.frames, v):
+            conn.sendall(frame)
+        return keep_open
 
-            else:
-                resp = "Unknown command"
-                conn.sendall(encode_message(0, pack_short_string(resp)))
+    elif cmd == CMD_HELLO:
+        # Version negotiation: reply, still in the current framing, with the highest version both sides
+        # speak; every later frame in either direction uses that version
+        requested = payload[0] if len(payload) else PROTOCOL_V1
+        agreed = max(PROTOCOL_V1, min(requested, PROTOCOL_VERSION))
+        conn.sendall(encode_message(CMD_HELLO, struct.pack("!B", agreed), v))
+        conn.version = agreed
+
+    elif cmd == CMD_CLOSE:
+        return False
+
+    else:
+        resp = "Unknown command"
+        conn.sendall(encode_message(0, pack_short_string(resp, v), v))
+    return True
+
+def handle_client(conn, addr):
+    print(f"[NEW CONNECTION] {addr} connected.")
+    # Replies and live pushes for this socket are written by its outbox thread; this thread only reads
+    outbox = ClientOutbox(conn)
+    reader = FrameReader(conn)
+    try:
+        while True:
+            # Decode the incoming command and its payload from the client
+            cmd, payload = reader.read_frame()
+            if not handle_command(outbox, cmd, payload):
+                print(f"[DISCONNECT] {addr} requested close.")
+                break
+            reader.version = outbox.version
+            # Nothing is acknowledged before it is durable; concurrent handlers share each fsync
+            store.commit()
+            # Everything the command produced (e.g. a whole CMD_READ mailbox) leaves in one gathered write
+            outbox.flush()
     except Exception as e:
         print(f"Error handling client {addr}: {e}")
     finally:
-        conn.close()
+        store.presence.unsubscribe(outbox)
+        outbox.close()
         print(f"Connection closed: {addr}")
 
-def main():
+def main(mode="threaded", port=56789, wal_path=None, db_path=None, history_dir=None):
+    global store
     HOST = "0.0.0.0"
-    PORT = 56789
+    PORT = port
+    # With a database file the state lives on disk instead, and only sessions are held in memory
+    if db_path:
+        store = SqliteStore(db_path)
+    # With a history directory, older messages and the mailboxes of users long away are kept on disk
+    elif history_dir:
+        store = ChatStore(history_dir=history_dir)
+    # With a log the state survives restarts: replay it now, and record every change from here on
+    if wal_path and not db_path:
+        store.recover(WriteAheadLog(wal_path))
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_sock.bind((HOST, PORT))
     server_sock.listen()
-    print(f"Server listening on {HOST}:{PORT}")
+    print(f"Server listening on {HOST}:{PORT} ({mode})")
     try:
-        while True:
-            conn, addr = server_sock.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        if mode == "reactor":
+            serve_reactor(server_sock)
+        else:
+            while True:
+                conn, addr = server_sock.accept()
+                # Replies are already batched per command, so Nagle would only hold pushes back behind delayed ACKs
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
         server_sock.close()
+        store.close()
 
 if __name__ == "__main__":
-    main()
+    # Pass --reactor to serve every client from one selectors loop instead of a thread each, and --wal PATH
+    # to keep accounts and messages across restarts, or --db PATH to keep them in a SQLite file instead of memory.
+    # --history DIR spills older conversation history and idle mailboxes to files in DIR.
+    args = sys.argv[1:]
+    wal_path = args[args.index("--wal") + 1] if "--wal" in args[:-1] else None
+    db_path = args[args.index("--db") + 1] if "--db" in args[:-1] else None
+    history_dir = args[args.index("--history") + 1] if "--history" in args[:-1] else None
+    main("reactor" if "--reactor" in args else "threaded", wal_path=wal_path, db_path=db_path, history_dir=history_dir)
@@ -6,15 +6,18 @@ import re
 from io import StringIO
 import contextlib
 import struct
+import datetime
+import selectors
 
-from server_custom import main as server_main
+from server_custom import main as server_main, ReactorConnection
 from protocol_custom import (
     CMD_CREATE, CMD_LOGIN, CMD_SEND, CMD_READ, CMD_DELETE_MSG,
     CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_LIST, CMD_READ_ACK,
-    encode_message, decode_message,
-    pack_short_string, pack_long_string,
-    unpack_short_string, unpack_long_string
+    CMD_LIST, CMD_READ_ACK, CMD_BATCH, CMD_HELLO, CMD_HISTORY, CMD_DIRECTORY, PROTOCOL_V1, PROTOCOL_V2,
+    encode_message, decode_message, FrameReader, encode_batch, unpack_batch,
+    pack_short_string, pack_long_string, pack_uint, pack_varint, pack_list, unpack_varint,
+    unpack_short_string, unpack_long_string, unpack_history, unpack_history_error, pack_directory_request, unpack_directory_reply,
+    CMD_CHAT, CMD_PRESENCE, CMD_PRESENCE_EVENTS, unpack_name_list, unpack_presence_events, timestamp_to_micros, micros_to_datetime
 )
 
 HOST = "127.0.0.1"
@@ -146,5 +149,369 @@ class CustomServerTests(unittest.TestCase):
         resp, _ = unpack_short_string(resp_payload, 0)
         self.assertIn("does not exist", resp)
 
+    def test_batch_send_and_read(self):
+        sender, recipient = "server_user12", "server_user13"
+        for user in (sender, recipient):
+            send_command(CMD_CREATE, pack_short_string(user) + pack_short_string("pass"))
+        sends = [encode_message(CMD_SEND, pack_short_string(sender) + pack_short_string(recipient) +
+                                pack_long_string(f"bulk {i}")) for i in range(50)]
+        sends.append(encode_message(CMD_READ, pack_short_string(recipient) + struct.pack("!B", 0)))
+        batch = encode_batch(sends)
+        self.assertEqual(len(batch), 1)
+        resp_cmd, resp_payload = send_command(CMD_BATCH, batch[0][3:])
+        self.assertEqual(resp_cmd, CMD_BATCH)
+        more, frames = unpack_batch(resp_payload)
+        self.assertEqual(more, 0)
+        # 50 send acks, then the 50 unread messages and the end marker from the nested read
+        self.assertEqual(len(frames), 101)
+        self.assertEqual({unpack_short_string(p, 0)[0] for c, p in frames[:50]}, {"Message sent"})
+        offset = unpack_short_string(frames[50][1], 0)[1]
+        self.assertEqual(unpack_long_string(frames[50][1], offset)[0], "bulk 0")
+        self.assertEqual(unpack_long_string(frames[-1][1], 0)[0], "END_OF_MESSAGES")
+
+    def test_v2_large_conversation_and_high_ids(self):
+        # After CMD_HELLO the connection uses varint framing: a >64 KB view is one frame and ids above 255 delete
+        v = PROTOCOL_V2
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, PORT))
+        s.sendall(encode_message(CMD_HELLO, struct.pack("!B", v)))
+        self.assertEqual(decode_message(s), (CMD_HELLO, bytearray([v])))
+        user1, user2 = "server_user14", "server_user15"
+        for user in (user1, user2):
+            s.sendall(encode_message(CMD_CREATE, pack_short_string(user, v) + pack_short_string("pass", v), v))
+            decode_message(s, v)
+        text = "w" * 40000
+        for _ in range(3):
+            send = pack_short_string(user1, v) + pack_short_string(user2, v) + pack_long_string(text, v)
+            s.sendall(encode_message(CMD_SEND, send, v))
+            self.assertEqual(unpack_short_string(decode_message(s, v)[1], 0, v)[0], "Message sent")
+        s.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(user1, v) + pack_short_string(user2, v), v))
+        resp_cmd, resp_payload = decode_message(s, v)
+        self.assertEqual(resp_cmd, CMD_VIEW_CONV)
+        conv_str, _ = unpack_long_string(resp_payload, 0, v)
+        self.assertGreater(len(conv_str), 120000)
+        msg_id = int(re.findall(r"\[ID (\d+)\]", conv_str)[-1])
+        for _ in range(max(0, 300 - msg_id)):
+            send = pack_short_string(user1, v) + pack_short_string(user2, v) + pack_long_string("filler", v)
+            s.sendall(encode_message(CMD_SEND, send, v))
+            decode_message(s, v)
+        s.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(user1, v) + pack_short_string(user2, v), v))
+        conv_str, _ = unpack_long_string(decode_message(s, v)[1], 0, v)
+        msg_id = int(re.findall(r"\[ID (\d+)\]", conv_str)[-1])
+        self.assertGreater(msg_id, 255)
+        delete = pack_short_string(user1, v) + pack_short_string(user2, v) + pack_uint(1, v) + pack_uint(msg_id, v)
+        s.sendall(encode_message(CMD_DELETE_MSG, delete, v))
+        resp, _ = unpack_short_string(decode_message(s, v)[1], 0, v)
+        self.assertIn("Specified conversation messages deleted", resp)
+        s.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(user1, v) + pack_short_string(user2, v), v))
+        conv_str, _ = unpack_long_string(decode_message(s, v)[1], 0, v)
+        self.assertNotIn(f"[ID {msg_id}]", conv_str)
+        s.close()
+
+    def test_v2_view_conv_pages(self):
+        v = PROTOCOL_V2
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, PORT))
+        s.sendall(encode_message(CMD_HELLO, struct.pack("!B", v)))
+        decode_message(s)
+        user1, user2 = "server_user16", "server_user17"
+        for user in (user1, user2):
+            s.sendall(encode_message(CMD_CREATE, pack_short_string(user, v) + pack_short_string("pass", v), v))
+            decode_message(s, v)
+        for i in range(5):
+            send = pack_short_string(user1, v) + pack_short_string(user2, v) + pack_long_string(f"page {i}", v)
+            s.sendall(encode_message(CMD_SEND, send, v))
+            decode_message(s, v)
+        def view(before, limit):
+            request = pack_short_string(user2, v) + pack_short_string(user1, v)
+            request += pack_uint(before, v) + pack_uint(0, v) + pack_uint(limit, v)
+            s.sendall(encode_message(CMD_VIEW_CONV, request, v))
+            payload = decode_message(s, v)[1]
+            text, offset = unpack_long_string(payload, 0, v)
+            more, offset = unpack_varint(payload, offset)
+            first_id, offset = unpack_varint(payload, offset)
+            return text, more, first_id
+        text, more, first_id = view(0, 2)
+        self.assertEqual(re.findall(r"page \d", text), ["page 3", "page 4"])
+        self.assertEqual(more, 1)
+        text, more, _ = view(first_id, 10)
+        self.assertEqual(re.findall(r"page \d", text), ["page 0", "page 1", "page 2"])
+        self.assertEqual(more, 0)
+        s.close()
+
+    def test_history_records(self):
+        user1, user2 = "server_user18", "server_user19"
+        for user in (user1, user2):
+            send_command(CMD_CREATE, pack_short_string(user) + pack_short_string("pass"))
+        for i in range(4):
+            send_command(CMD_SEND, pack_short_string(user1) + pack_short_string(user2) + pack_long_string(f"rec {i}"))
+        for v in (PROTOCOL_V1, PROTOCOL_V2):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((HOST, PORT))
+            if v == PROTOCOL_V2:
+                s.sendall(encode_message(CMD_HELLO, struct.pack("!B", v)))
+                decode_message(s)
+            def history(before, limit):
+                request = pack_short_string(user2, v) + pack_short_string(user1, v)
+                request += pack_varint(before) + pack_varint(0) + pack_varint(limit)
+                s.sendall(encode_message(CMD_HISTORY, request, v))
+                cmd, payload = decode_message(s, v)
+                self.assertEqual(cmd, CMD_HISTORY)
+                return unpack_history(payload, v)
+            records, more = history(0, 3)
+            self.assertEqual([r["message"] for r in records], ["rec 1", "rec 2", "rec 3"])
+            self.assertEqual({r["sender"] for r in records}, {user1})
+            self.assertTrue(more)
+            records, more = history(records[0]["id"], 3)
+            self.assertEqual([r["message"] for r in records], ["rec 0"])
+            self.assertFalse(more)
+            self.assertLess(abs(micros_to_datetime(records[0]["timestamp_us"]) - datetime.datetime.now()),
+                            datetime.timedelta(minutes=5))
+            # An error answers with the same command, flagged, so the client can tie it to its request
+            request = pack_short_string(user2, v) + pack_short_string("history_nobody", v) + pack_varint(0) * 3
+            s.sendall(encode_message(CMD_HISTORY, request, v))
+            cmd, payload = decode_message(s, v)
+            self.assertEqual(cmd, CMD_HISTORY)
+            self.assertEqual(unpack_history_error(payload, v), "User not found")
+            s.close()
+
+    def test_v1_reader_keeps_messages_too_long_for_its_frames(self):
+        # A v2 client can send more than a v1 frame holds; the v1 recipient must not lose it, nor the sender
+        # its connection
+        v = PROTOCOL_V2
+        sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sender.connect((HOST, PORT))
+        sender.sendall(encode_message(CMD_HELLO, struct.pack("!B", v)))
+        decode_message(sender)
+        user1, user2 = "server_user30", "server_user31"
+        for user in (user1, user2):
+            sender.sendall(encode_message(CMD_CREATE, pack_short_string(user, v) + pack_short_string("pass", v), v))
+            decode_message(sender, v)
+        reader = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        reader.connect((HOST, PORT))
+        reader.sendall(encode_message(CMD_LOGIN, pack_short_string(user2) + pack_short_string("pass")))
+        decode_message(reader)
+        long_text = "x" * 70000
+        for text in (long_text, "short"):
+            send = pack_short_string(user1, v) + pack_short_string(user2, v) + pack_long_string(text, v)
+            sender.sendall(encode_message(CMD_SEND, send, v))
+            self.assertEqual(unpack_short_string(decode_message(sender, v)[1], 0, v)[0], "Message sent")
+        # Only the short one could be pushed live; the long one waits in the mailbox
+        cmd, payload = decode_message(reader)
+        self.assertEqual(cmd, CMD_CHAT)
+        self.assertEqual(unpack_long_string(payload, unpack_short_string(payload, 0)[1])[0], "short")
+        reader.sendall(encode_message(CMD_READ, pack_short_string(user2)))
+        self.assertEqual(unpack_long_string(decode_message(reader)[1], 0)[0], "Message too long for protocol v1")
+        reader.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(user2) + pack_short_string(user1)))
+        conv_str, _ = unpack_long_string(decode_message(reader)[1], 0)
+        self.assertIn(": short", conv_str)
+        self.assertNotIn(long_text, conv_str)
+        # A v2 session still gets it
+        sender.sendall(encode_message(CMD_READ, pack_short_string(user2, v), v))
+        payload = decode_message(sender, v)[1]
+        self.assertEqual(unpack_long_string(payload, unpack_short_string(payload, 0, v)[1], v)[0], long_text)
+        sender.close()
+        request = pack_short_string(user2) + pack_short_string(user1) + pack_varint(0) * 3
+        reader.sendall(encode_message(CMD_HISTORY, request))
+        records, more = unpack_history(decode_message(reader)[1])
+        self.assertEqual(([r["message"] for r in records], more), (["short"], True))
+        reader.close()
+
+    def test_list_pages(self):
+        for user in ("listpage1", "listpage2", "listpage3"):
+            send_command(CMD_CREATE, pack_short_string(user) + pack_short_string("pass"))
+        cmd, payload = send_command(CMD_LIST, pack_list("listpage*", limit=2))
+        names, offset = unpack_long_string(payload, 0)
+        token, _ = unpack_short_string(payload, offset)
+        self.assertEqual((names, token), ("listpage1,listpage2", "listpage2"))
+        cmd, payload = send_command(CMD_LIST, pack_list("listpage*", limit=2, after=token))
+        names, offset = unpack_long_string(payload, 0)
+        token, _ = unpack_short_string(payload, offset)
+        self.assertEqual((names, token), ("listpage3", ""))
+
+    def test_directory_sync(self):
+        sync = unpack_directory_reply(send_command(CMD_DIRECTORY, pack_directory_request(0))[1])
+        self.assertFalse(sync["reset"])
+        version = sync["version"]
+        for user in ("diruser1", "diruser2"):
+            send_command(CMD_CREATE, pack_short_string(user) + pack_short_string("pass"))
+        send_command(CMD_DELETE_ACC, pack_short_string("diruser1"))
+        sync = unpack_directory_reply(send_command(CMD_DIRECTORY, pack_directory_request(version, 2))[1])
+        self.assertEqual((sync["added"], sync["removed"], sync["more"]), (["diruser1", "diruser2"], [], True))
+        sync = unpack_directory_reply(send_command(CMD_DIRECTORY, pack_directory_request(sync["version"]))[1])
+        self.assertEqual((sync["added"], sync["removed"], sync["more"]), ([], ["diruser1"], False))
+        self.assertEqual(sync["version"], version + 3)
+
+class BatchFramingTests(unittest.TestCase):
+    def test_large_batches_are_split_with_more_flag(self):
+        frames = [encode_message(CMD_SEND, pack_long_string("z" * 1000)) for _ in range(200)]
+        batch = encode_batch(frames)
+        self.assertGreater(len(batch), 1)
+        received = []
+        for i, frame in enumerate(batch):
+            cmd, payload_len = struct.unpack_from("!BH", frame, 0)
+            self.assertEqual(cmd, CMD_BATCH)
+            more, sub_frames = unpack_batch(frame[3:])
+            self.assertEqual(more, 1 if i < len(batch) - 1 else 0)
+            received.extend(sub_frames)
+        self.assertEqual(len(received), 200)
+        self.assertEqual(unpack_long_string(received[-1][1], 0)[0], "z" * 1000)
+
+class HistoryRecordTests(unittest.TestCase):
+    def test_timestamp_round_trip(self):
+        stamp = "2025-02-12T09:30:15.123456"
+        micros = timestamp_to_micros(stamp)
+        self.assertEqual(micros_to_datetime(micros).isoformat(), stamp)
+
+class VarintTests(unittest.TestCase):
+    def test_round_trip(self):
+        for n in (0, 1, 127, 128, 255, 300, 65535, 65536, 2 ** 40):
+            data = pack_varint(n)
+            self.assertEqual(unpack_varint(data, 0), (n, len(data)))
+        self.assertEqual(len(pack_varint(127)), 1)
+        self.assertEqual(len(pack_varint(128)), 2)
+        with self.assertRaises(ValueError):
+            unpack_varint(b"\x80\x80", 0)
+
+class FrameReaderTests(unittest.TestCase):
+    def test_several_frames_from_one_recv(self):
+        a, b = socket.socketpair()
+        a.sendall(b"".join(encode_message(CMD_LOGIN, pack_short_string(f"user{i}")) for i in range(4)))
+        reader = FrameReader(b)
+        self.assertGreater(reader.fill(), 0)
+        names = []
+        while True:
+            frame = reader.next_frame()
+            if frame is None:
+                break
+            cmd, payload = frame
+            self.assertIsInstance(payload, memoryview)
+            names.append(unpack_short_string(payload, 0)[0])
+        self.assertEqual(names, ["user0", "user1", "user2", "user3"])
+        a.close()
+        b.close()
+
+    def test_frame_larger_than_buffer(self):
+        a, b = socket.socketpair()
+        text = "y" * 50000
+        a.sendall(encode_message(CMD_SEND, pack_long_string(text)) + encode_message(CMD_CLOSE, b""))
+        reader = FrameReader(b, bufsize=64)
+        cmd, payload = reader.read_frame()
+        self.assertEqual((cmd, unpack_long_string(payload, 0)[0]), (CMD_SEND, text))
+        cmd, payload = reader.read_frame()
+        self.assertEqual((cmd, len(payload)), (CMD_CLOSE, 0))
+        a.close()
+        with self.assertRaises(Exception):
+            reader.read_frame()
+        b.close()
+
+    def test_v2_frames_split_mid_header(self):
+        a, b = socket.socketpair()
+        v = PROTOCOL_V2
+        text = "v" * 70000
+        data = encode_message(CMD_SEND, pack_long_string(text, v), v) + encode_message(CMD_CLOSE, b"", v)
+        reader = FrameReader(b, bufsize=64, version=v)
+        a.sendall(data[:2])
+        self.assertGreater(reader.fill(), 0)
+        self.assertIsNone(reader.next_frame())
+        a.sendall(data[2:])
+        cmd, payload = reader.read_frame()
+        self.assertEqual((cmd, unpack_long_string(payload, 0, v)[0]), (CMD_SEND, text))
+        self.assertEqual(reader.read_frame()[0], CMD_CLOSE)
+        a.close()
+        b.close()
+
+REACTOR_PORT = 56791
+
+class ReactorServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server_thread = threading.Thread(target=server_main, args=("reactor", REACTOR_PORT), daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, REACTOR_PORT))
+        return s
+
+    def test_create_and_login(self):
+        s = self.connect()
+        creds = pack_short_string("reactor_user1") + pack_short_string("pw")
+        s.sendall(encode_message(CMD_CREATE, creds))
+        resp, _ = unpack_short_string(decode_message(s)[1], 0)
+        self.assertEqual(resp, "Account created")
+        s.sendall(encode_message(CMD_LOGIN, creds))
+        resp, _ = unpack_short_string(decode_message(s)[1], 0)
+        self.assertIn("Login successful", resp)
+        s.close()
+
+    def test_pipelined_frames_in_one_write(self):
+        # Several frames arriving in a single segment must all be parsed and answered in order
+        s = self.connect()
+        frames = b"".join(
+            encode_message(CMD_CREATE, pack_short_string(f"reactor_pipe{i}") + pack_short_string("pw"))
+            for i in range(3)
+        )
+        s.sendall(frames[:5])
+        time.sleep(0.1)
+        s.sendall(frames[5:])
+        for _ in range(3):
+            resp_cmd, resp_payload = decode_message(s)
+            self.assertEqual(resp_cmd, CMD_CREATE)
+            self.assertEqual(unpack_short_string(resp_payload, 0)[0], "Account created")
+        s.close()
+
+    def test_presence_events_pushed(self):
+        watcher, other = self.connect(), self.connect()
+        watcher.sendall(encode_message(CMD_PRESENCE, pack_varint(1)))
+        cmd, payload = decode_message(watcher)
+        self.assertEqual(cmd, CMD_PRESENCE)
+        creds = pack_short_string("reactor_presence") + pack_short_string("pw")
+        for request in (CMD_CREATE, CMD_LOGIN):
+            other.sendall(encode_message(request, creds))
+            decode_message(other)
+        cmd, payload = decode_message(watcher)
+        self.assertEqual(cmd, CMD_PRESENCE_EVENTS)
+        # Created and then logged in within one window: only the latest event is sent
+        self.assertEqual(unpack_presence_events(payload), [("reactor_presence", "online")])
+        # A new subscriber is told who is online already
+        other.sendall(encode_message(CMD_PRESENCE, pack_varint(1)))
+        online, _ = unpack_name_list(decode_message(other)[1], 1)
+        self.assertIn("reactor_presence", online)
+        watcher.close()
+        other.close()
+
+class ReactorConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.selector = selectors.DefaultSelector()
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.peer.setblocking(False)
+        self.conn = ReactorConnection(self.sock, "test", self.selector)
+        self.selector.register(self.sock, selectors.EVENT_READ, self.conn)
+        self.addCleanup(self.selector.close)
+        self.addCleanup(self.peer.close)
+
+    def test_push_waits_for_the_loop_to_flush(self):
+        self.conn.push(b"push", lambda: self.fail("push should not be dropped"))
+        # Only marked for writing: the loop flushes after committing the round
+        with self.assertRaises(BlockingIOError):
+            self.peer.recv(16)
+        self.assertTrue(self.selector.get_key(self.sock).events & selectors.EVENT_WRITE)
+        self.conn.flush()
+        self.assertEqual(self.peer.recv(16), b"push")
+        self.conn.close()
+
+    def test_close_drops_partly_written_pushes(self):
+        # The peer never reads, so the gathered write stops part way through the first frame
+        dropped = []
+        for i in range(3):
+            self.conn.push(b"x" * (4 << 20), lambda i=i: dropped.append(i))
+        self.conn.flush()
+        self.assertTrue(self.conn.outgoing)
+        self.conn.close()
+        self.assertEqual(dropped, [0, 1, 2])
+
 if __name__ == "__main__":
     unittest.main()
@@ -5,8 +5,11 @@ import time
 import sys
 import os
 import datetime
+from framing import LineFramer
 
 MSGLEN = 409600  # Maximum message length for socket communication
+CONV_PAGE_SIZE = 50  # Messages fetched per view_conv page
+USER_PAGE_SIZE = 200  # Usernames fetched per list page
 
 # Print error messages to stderr
 def eprint(*args, **kwargs):
@@ -54,9 +57,10 @@ class ChatClient:
         else:
             self.sock.sendall(create_msg("send", src=self.username, to=recipient, body=message))
 
-    # Request a list of accounts that match a wildcard pattern
-    def list_accounts(self, wildcard):
-        self.sock.sendall(create_msg("list", src=self.username, body=wildcard))
+    # Request one page of the accounts that match a wildcard pattern, continuing after a previous page's token
+    def list_accounts(self, wildcard, after=None, limit=USER_PAGE_SIZE):
+        page = {"after": after, "limit": limit}
+        self.sock.sendall(create_msg("list", src=self.username, body=wildcard, extra_fields=page))
 
     # Request to read a specified number of undelivered messages
     def read_messages(self, limit=""):
@@ -70,9 +74,10 @@ class ChatClient:
             indices_str = str(indices)
         self.sock.sendall(create_msg("delete_msg", src=self.username, body=indices_str))
 
-    # Request to view the conversation with a specific user
-    def view_conversation(self, other_user):
-        self.sock.sendall(create_msg("view_conv", src=self.username, to=other_user))
+    # Request one page of the conversation with a specific user: the newest messages, or those before a message id
+    def view_conversation(self, other_user, before=None, limit=CONV_PAGE_SIZE):
+        page = {"before": before, "limit": limit}
+        self.sock.sendall(create_msg("view_conv", src=self.username, to=other_user, extra_fields=page))
 
     # Request deletion of the current account
     def delete_account(self):
@@ -136,7 +141,8 @@ def handle_user():
                 client.read_messages(limit)
             elif choice == "3":
                 wildcard = input("Enter a matching wildcard (optional, default '*'): ")
-                client.list_accounts(wildcard)
+                after = input("Continue after account (leave blank for the first page): ").strip()
+                client.list_accounts(wildcard, after or None)
             elif choice == "4":
                 indices = input("Enter message indices to delete (comma separated): ")
                 client.delete_messages(indices)
@@ -146,26 +152,30 @@ def handle_user():
                 client.log_off()
             elif choice == "7":
                 other_user = input("Enter the username to view conversation with: ")
-                client.view_conversation(other_user)
+                before = input("Show messages before ID (leave blank for the newest): ").strip()
+                client.view_conversation(other_user, int(before) if before.isdigit() else None)
             else:
                 print("Invalid command. Please try again.")
 
 # Function to handle incoming messages from the server
 def handle_message():
-    buffer = ""
+    framer = LineFramer()
     while True:
         try:
-            data = client.sock.recv(MSGLEN).decode()
+            data = client.sock.recv(MSGLEN)
         except Exception as e:
             eprint("Error receiving data:", e)
             break
         if not data:
             break
-        buffer += data
+        try:
+            lines = framer.feed(data)
+        except ValueError as e:
+            eprint("Error receiving data:", e)
+            break
 
         # Process each complete JSON message (delimited by newline)
-        while "\n" in buffer:
-            msg_str, buffer = buffer.split("\n", 1)
+        for msg_str in lines:
             if not msg_str:
                 continue
             try:
@@ -227,6 +237,8 @@ def handle_message():
             elif cmd == "list":
                 print("Matching accounts:")
                 print(msg.get("body", ""))
+                if msg.get("next"):
+                    print(f"(More accounts match; list again continuing after {msg['next']} to see them)")
             # Handle send message response
             elif cmd == "send":
                 if msg.get("error", False):
@@ -240,6 +252,8 @@ def handle_message():
                     display_text = "Conversation:\n"
                     for m in conv:
                         display_text += f"[ID {m['id']}] {m['sender']} ({m['timestamp']}): {m['message']}\n"
+                    if msg.get("more") and conv:
+                        display_text += f"(Older messages exist; view again with ID {conv[0]['id']} to see them)\n"
                     print(display_text)
                 except Exception as e:
                     print(f"Error parsing conversation history: {e}")
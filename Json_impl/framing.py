@@ -0,0 +1,32 @@
+# Largest line a receiver will buffer before giving up on the connection
+MAX_LINE = 16 * 1024 * 1024
+
+class LineTooLong(ValueError):
+    pass
+
+class LineFramer:
+    # Turns a TCP byte stream into newline-delimited messages.
+    # Bytes stay in one bytearray; each feed scans only the bytes it has not looked at yet and
+    # drops consumed lines in a single slice, and only complete lines are decoded, so a UTF-8
+    # character split across two recvs is never decoded half-way.
+    def __init__(self, max_line=MAX_LINE):
+        self.buf = bytearray()
+        self.scanned = 0
+        self.max_line = max_line
+
+    def feed(self, data):
+        # Add received bytes and return the list of complete lines (without the newline)
+        self.buf += data
+        lines = []
+        start = 0
+        nl = self.buf.find(b"\n", self.scanned)
+        while nl >= 0:
+            lines.append(self.buf[start:nl].decode("utf-8", errors="replace"))
+            start = nl + 1
+            nl = self.buf.find(b"\n", start)
+        if start:
+            del self.buf[:start]
+        self.scanned = len(self.buf)
+        if self.scanned > self.max_line:
+            raise LineTooLong(f"Message exceeds {self.max_line} bytes without a newline")
+        return lines
@@ -6,9 +6,13 @@ import json
 import time
 import datetime
 import sys
+import bisect
+from framing import LineFramer
 
 PORT = 12345
 MSGLEN = 409600
+CONV_PAGE_SIZE = 50  # Messages fetched per conversation page
+USER_PAGE_SIZE = 200  # Usernames fetched per list request
 
 def create_msg(cmd, src="", to="", body="", extra_fields=None):
   
@@ -46,18 +50,17 @@ class ChatClient:
         self.sock.close()
 
     def receive_loop(self, callback):
-        buffer = ""
+        framer = LineFramer()
         while self.running:
             try:
-                data = self.sock.recv(MSGLEN).decode()
+                data = self.sock.recv(MSGLEN)
+                lines = framer.feed(data)
             except Exception as e:
                 print("Error receiving data:", e, file=sys.stderr)
                 break
             if not data:
                 break
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
+            for line in lines:
                 if line:
                     msg = parse_msg(line)
                     if msg:
@@ -70,7 +73,15 @@ class ChatGUI:
         self.master = master
         self.master.title("Chat Client")
         self.client = None
-        self.user_list = []  # Will store the list of available users
+        self.user_list = []  # Will store the sorted list of other users
+        # Directory version the user list is in sync with, and the version a re-listing started from while one runs
+        self.directory_version = 0
+        self.relist_version = None
+        # Users the presence feed reports as online; their menu entries are marked
+        self.online = set()
+        # Conversation being paged through and the oldest message id shown from it
+        self.conv_user = None
+        self.conv_oldest_id = None
 
         # Create three frames: login_frame, chat_frame, command_frame.
         self.login_frame = tk.Frame(master)
@@ -142,6 +153,9 @@ class ChatGUI:
         self.view_conv_button = tk.Button(self.command_frame, text="View", command=self.view_conversation)
         self.view_conv_button.grid(row=1, column=2, padx=5, pady=5)
 
+        self.older_button = tk.Button(self.command_frame, text="Older Messages", command=self.view_older)
+        self.older_button.grid(row=2, column=2, padx=5, pady=5)
+
         self.delete_acc_button = tk.Button(self.command_frame, text="Delete Account", command=self.delete_account)
         self.delete_acc_button.grid(row=0, column=2, padx=5, pady=5)
 
@@ -180,11 +194,74 @@ class ChatGUI:
             menu.add_command(label=option, command=lambda value=option: self.view_conv_var.set(value))
         self.view_conv_var.set(options[0] if options else "Select User")
 
-    def refresh_users(self):
-        # Request a full list of users from the server.
+    def refresh_users(self, after=None):
+        # Ask for the accounts added and removed since the directory version we already have
         if self.client:
-            list_msg = {"cmd": "list", "from": self.username_entry.get().strip(), "body": "*"}
-            self.client.send_message(list_msg)
+            sync_msg = {"cmd": "directory", "from": self.username_entry.get().strip(),
+                        "since": self.directory_version, "after": after, "limit": USER_PAGE_SIZE}
+            self.client.send_message(sync_msg)
+
+    def apply_directory(self, added, removed):
+        # Insert or delete only the changed names, in the sorted user list and in both menus
+        me = self.username_entry.get().strip()
+        menus = [(self.recipient_menu["menu"], self.recipient_var), (self.view_conv_menu["menu"], self.view_conv_var)]
+        for name in removed:
+            i = bisect.bisect_left(self.user_list, name)
+            if i < len(self.user_list) and self.user_list[i] == name:
+                del self.user_list[i]
+                # Index 0 of each menu is its "All" / "Select User" entry
+                for menu, _ in menus:
+                    menu.delete(i + 1)
+        for name in added:
+            i = bisect.bisect_left(self.user_list, name)
+            if name == me or (i < len(self.user_list) and self.user_list[i] == name):
+                continue
+            self.user_list.insert(i, name)
+            for menu, var in menus:
+                menu.insert_command(i + 1, label=self.user_label(name), command=lambda value=name, var=var: var.set(value))
+
+    def user_label(self, name):
+        return f"{name} (online)" if name in self.online else name
+
+    def relabel_user(self, name):
+        i = bisect.bisect_left(self.user_list, name)
+        if i < len(self.user_list) and self.user_list[i] == name:
+            for menu in (self.recipient_menu["menu"], self.view_conv_menu["menu"]):
+                menu.entryconfigure(i + 1, label=self.user_label(name))
+
+    def handle_presence(self, events):
+        # Pushed account and session changes, already coalesced to each user's latest event
+        for name, event in events:
+            if event == "deleted":
+                self.online.discard(name)
+                self.apply_directory([], [name])
+                continue
+            if event == "online":
+                self.online.add(name)
+            else:
+                self.online.discard(name)
+            self.apply_directory([name], [])
+            self.relabel_user(name)
+
+    def handle_directory(self, msg):
+        if msg.get("reset"):
+            # The server no longer has our changes: start over from an empty list and page through every account
+            if self.relist_version is None:
+                self.relist_version = msg.get("version", 0)
+                self.user_list = []
+                self.update_recipient_menu()
+                self.update_view_conv_menu()
+            self.apply_directory(msg.get("added", []), [])
+            if msg.get("more"):
+                self.refresh_users(msg.get("next"))
+            else:
+                self.directory_version = self.relist_version
+                self.relist_version = None
+        else:
+            self.apply_directory(msg.get("added", []), msg.get("removed", []))
+            self.directory_version = msg.get("version", self.directory_version)
+            if msg.get("more"):
+                self.refresh_users()
 
     def login(self):
         server_ip = self.server_ip_entry.get().strip()
@@ -239,7 +316,8 @@ class ChatGUI:
         wildcard = simpledialog.askstring("List Accounts", "Enter wildcard (leave blank for all):", parent=self.master)
         if wildcard is None:
             return
-        list_msg = {"cmd": "list", "from": self.username_entry.get().strip(), "body": wildcard}
+        list_msg = {"cmd": "list", "from": self.username_entry.get().strip(), "body": wildcard,
+                    "limit": USER_PAGE_SIZE}
         self.client.send_message(list_msg)
 
     def delete_messages(self):
@@ -255,7 +333,19 @@ class ChatGUI:
         if other_user == "Select User":
             messagebox.showerror("Error", "Please select a valid user.")
             return
-        view_msg = {"cmd": "view_conv", "from": self.username_entry.get().strip(), "to": other_user}
+        # Only the newest page is fetched; "Older Messages" walks back from there
+        self.conv_user = other_user
+        self.conv_oldest_id = None
+        view_msg = {"cmd": "view_conv", "from": self.username_entry.get().strip(), "to": other_user,
+                    "limit": CONV_PAGE_SIZE}
+        self.client.send_message(view_msg)
+
+    def view_older(self):
+        if self.conv_user is None or self.conv_oldest_id is None:
+            messagebox.showinfo("Conversation", "No older messages to load.")
+            return
+        view_msg = {"cmd": "view_conv", "from": self.username_entry.get().strip(), "to": self.conv_user,
+                    "before": self.conv_oldest_id, "limit": CONV_PAGE_SIZE}
         self.client.send_message(view_msg)
 
     def read_messages(self):
@@ -306,12 +396,22 @@ class ChatGUI:
         cmd = msg.get("cmd", "")
         body = msg.get("body", "")
         if cmd == "list":
-            self.append_text("Matching accounts:\n" + body)
-            # Update user list from comma-separated body.
-            accounts = [x.strip() for x in body.split(",") if x.strip()]
-            self.user_list = accounts
-            self.update_recipient_menu()
-            self.update_view_conv_menu()
+            text = "Matching accounts:\n" + body
+            if msg.get("next"):
+                text += f"\n(Showing the first {USER_PAGE_SIZE}; narrow the wildcard to find others)"
+            self.append_text(text)
+        elif cmd == "presence":
+            if not msg.get("error", False) and "online" in msg:
+                self.online = set(msg["online"])
+                for name in self.online:
+                    self.relabel_user(name)
+        elif cmd == "presence_events":
+            self.handle_presence(msg.get("events", []))
+        elif cmd == "directory":
+            if msg.get("error", False):
+                self.append_text("Refresh failed: " + body)
+            else:
+                self.handle_directory(msg)
         elif cmd == "login":
             if msg.get("error", False):
                 messagebox.showerror("Login Failed", body)
@@ -328,6 +428,16 @@ class ChatGUI:
                 self.chat_frame.pack()
                 self.command_frame.pack()
                 self.append_text(body)
+                # The user list leaves out whoever is logged in, so a new login syncs it from scratch
+                self.user_list = []
+                self.directory_version = 0
+                self.relist_version = None
+                self.online = set()
+                self.update_recipient_menu()
+                self.update_view_conv_menu()
+                # Presence pushes keep the menus current from here on; the sync fills them in once
+                self.client.send_message({"cmd": "presence", "from": msg.get("to", ""), "body": "subscribe"})
+                self.refresh_users()
 
 
         elif cmd == "create":
@@ -371,7 +481,25 @@ class ChatGUI:
         elif cmd == "delete_msg":
             self.append_text(body)
         elif cmd == "view_conv":
-            self.append_text("Conversation:\n" + body)
+            if "more" not in msg:
+                self.append_text("Conversation:\n" + body)
+                return
+            # A page of history, oldest first
+            try:
+                page = json.loads(body)
+            except json.JSONDecodeError:
+                self.append_text("Conversation:\n" + body)
+                return
+            text = "Conversation:\n"
+            for m in page:
+                text += f"[ID {m['id']}] [{m['timestamp']}] {m['sender']}: {m['message']}\n"
+            if page:
+                self.conv_oldest_id = page[0]["id"]
+            if msg.get("more"):
+                text += "(Press Older Messages for earlier history)"
+            else:
+                self.conv_oldest_id = None
+            self.append_text(text)
         elif cmd == "delete":
             self.append_text(body)
             self.username_entry.delete(0, tk.END)
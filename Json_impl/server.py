@@ -1,16 +1,83 @@
 import socket
+import sys
 import json
-import fnmatch
+import asyncio
 import threading
 import hashlib
-import datetime
-from collections import OrderedDict
+import time
+import os
+
+# The store, write-ahead log and outbox are shared with the custom implementation and live in ../shared
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+
+from store import ChatStore, format_timestamp
+from sqlite_store import SqliteStore
+from framing import LineFramer, LineTooLong
+from outbox import Outbox, OUTBOX_DEPTH, SEND_DEADLINE, return_push
+from wal import WriteAheadLog
+
+# Socket-like wrapper around an asyncio StreamWriter so handle_command can reply the same way in both modes
+class AsyncConnection:
+    def __init__(self, writer, max_depth=OUTBOX_DEPTH, send_deadline=SEND_DEADLINE):
+        self.writer = writer
+        self.send_deadline = send_deadline
+        self.batch = []
+        # Live pushes from other users wait here for this connection's writer task
+        self.pushes = asyncio.Queue(maxsize=max_depth)
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    def send(self, data):
+        # Replies for the current request are collected and handed to the transport together by flush()
+        self.batch.append(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.batch.append(data)
+
+    def flush(self):
+        if self.batch:
+            self.writer.writelines(self.batch)
+            self.batch = []
+
+    def push(self, data, on_drop):
+        # Same contract as Outbox.push: never waits, and on_drop gets the frame back on overflow or timeout
+        if self.writer.is_closing():
+            on_drop()
+            return False
+        try:
+            self.pushes.put_nowait((data, time.monotonic() + self.send_deadline, on_drop))
+        except asyncio.QueueFull:
+            on_drop()
+            return False
+        return True
+
+    async def write_loop(self):
+        while True:
+            data, deadline, on_drop = await self.pushes.get()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.writer.is_closing():
+                return_push(on_drop)
+                continue
+            self.writer.write(data)
+            try:
+                # Hold further pushes until this recipient's socket keeps up
+                await asyncio.wait_for(self.writer.drain(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            except ConnectionError:
+                break
+
+    def close(self):
+        self.writer_task.cancel()
+        while not self.pushes.empty():
+            self.pushes.get_nowait()[2]()
+        self.writer.close()
 
 class ChatServer:
     MSGLEN = 409600
 
     # Create a JSON message, add a newline delimiter, and encode to bytes
-    def create_msg(self, cmd, src="", to="", body="", err=False):
+    def create_msg(self, cmd, src="", to="", body="", err=False, extra_fields=None):
         msg = {
             "cmd": cmd,
             "from": src,
@@ -18,264 +85,376 @@ class ChatServer:
             "body": body,
             "error": err
         }
+        if extra_fields:
+            msg.update(extra_fields)
         return (json.dumps(msg) + "\n").encode()
 
-    def __init__(self, host='localhost', port=12345):
+    def __init__(self, host='localhost', port=12345, mode="threaded", wal_path=None, db_path=None, history_dir=None):
         self.host = socket.gethostbyname(socket.gethostname())
         self.port = port
-        # Maps usernames to their data (password hash and unread messages)
-        self.users = OrderedDict()     
-        # Maps usernames to their active connection objects
-        self.active_users = {}         
-        # Maps a sorted tuple of two usernames to a list of message entries (conversation history)
-        self.conversations = {}        
+        # Accounts, unread mailboxes, active connections and conversation history, safe to share across threads
+        # With a database file the state lives on disk instead, and only sessions are held in memory
+        # With a history directory, older messages and the mailboxes of users long away are kept on disk
+        self.store = SqliteStore(db_path) if db_path else ChatStore(history_dir=history_dir)
+        # With a log the state survives restarts: replay it now, and record every change from here on
+        if wal_path and not db_path:
+            self.store.recover(WriteAheadLog(wal_path))
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind(('0.0.0.0', port))
         self.running = True
-        self.next_msg_id = 1  # Global counter for assigning unique message IDs
+        # "threaded" runs one thread per connection, "asyncio" serves every connection from one event loop
+        if mode not in ("threaded", "asyncio"):
+            raise ValueError(f"Unknown server mode: {mode}")
+        self.mode = mode
+        self.loop = None
+        self.async_server = None
 
     def start(self):
         # Start listening for incoming client connections
         self.server.listen()
-        print(f"[LISTENING] Server is listening on {self.host}:{self.port}")
+        print(f"[LISTENING] Server is listening on {self.host}:{self.port} ({self.mode})")
+        if self.mode == "asyncio":
+            asyncio.run(self.serve_async())
+            return
         while self.running:
-            conn, addr = self.server.accept()
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                if not self.running:
+                    break
+                raise
+            # Replies are already batched per request, so Nagle would only hold pushes back behind delayed ACKs
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             thread = threading.Thread(target=self.handle_client, args=(conn, addr))
             thread.start()
 
     def stop(self):
         self.running = False
-        self.server.close()
+        if self.loop is not None:
+            # The listening socket belongs to the event loop, so close it from the loop's thread
+            self.loop.call_soon_threadsafe(self.async_server.close)
+        else:
+            # shutdown() wakes a thread blocked in accept(); close() alone leaves the port bound until it returns
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server.close()
+        self.store.close()
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        # Presence batches are flushed by the loop, since AsyncConnection.push must run on its thread
+        self.store.presence.schedule = self.loop.call_later
+        self.async_server = await asyncio.start_server(self.handle_client_async, sock=self.server, limit=ChatServer.MSGLEN)
+        async with self.async_server:
+            try:
+                await self.async_server.serve_forever()
+            except asyncio.CancelledError:
+                pass
 
     def read_messages(self, conn):
-        buffer = ""
+        # Requests are small, so anything longer than MSGLEN without a newline ends the connection
+        framer = LineFramer(ChatServer.MSGLEN)
         while True:
             try:
-                data = conn.recv(ChatServer.MSGLEN).decode()
+                data = conn.recv(ChatServer.MSGLEN)
             except Exception as e:
                 print("Error reading from connection:", e)
                 break
             if not data:
                 break
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                yield line
+            try:
+                lines = framer.feed(data)
+            except LineTooLong as e:
+                print("Error reading from connection:", e)
+                break
+            yield from lines
         return
 
     # Hash a password using SHA256
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
 
+    # Parse one JSON request and run it, replying over conn; returns False when the client asked to close
+    def handle_command(self, conn, raw_msg):
+        try:
+            parts = json.loads(raw_msg)
+        except json.JSONDecodeError:
+            conn.send(self.create_msg("error", body="Invalid JSON", err=True))
+            return True
+
+        cmd = parts.get("cmd")
+        username = parts.get("from")
+
+        # Ceck credentials and add user to active_users if valid
+        if cmd == "login":
+            password = parts.get("password", "")
+            stored_hash = self.store.password_hash(username)
+            if stored_hash is None:
+                conn.send(self.create_msg(cmd, body="Username does not exist", err=True))
+            elif stored_hash != self.hash_password(password):
+                conn.send(self.create_msg(cmd, body="Incorrect password", err=True))
+            else:
+                unread_count = self.store.login(username, conn, exclusive=True)
+                if unread_count is None:
+                    conn.send(self.create_msg(cmd, body="Already logged in elsewhere", err=True))
+                else:
+                    conn.send(self.create_msg(cmd, body=f"Login successful. Unread messages: {unread_count}", to=username))
+
+        # Register a new account if the username is not already taken
+        elif cmd == "create":
+            password = parts.get("password", "")
+            if not self.store.create_user(username, self.hash_password(password)):
+                conn.send(self.create_msg(cmd, body="Username already exists", err=True))
+            else:
+                conn.send(self.create_msg(cmd, body="Account created", to=username))
+
+        # Ccomma-separated list of usernames matching the wildcard
+        elif cmd == "list":
+            wildcard = parts.get("body", "*")
+            if "limit" in parts or "after" in parts:
+                # Paged listing: "after" is the token from the previous page, "next" is "" on the last page
+                try:
+                    limit = int(parts.get("limit") or 0)
+                except (TypeError, ValueError):
+                    conn.send(self.create_msg(cmd, body="Invalid page size", err=True))
+                    return True
+                matching_users, next_token = self.store.list_users_page(wildcard, parts.get("after") or None, limit)
+                conn.send(self.create_msg(cmd, body=",".join(matching_users), extra_fields={"next": next_token or ""}))
+            else:
+                matching_users = self.store.list_users(wildcard)
+                matching_str = ",".join(matching_users)
+                conn.send(self.create_msg(cmd, body=matching_str))
+
+        # Usernames added and removed since the client's directory version. A client with no version, or one
+        # further behind than the server remembers, gets "reset" and pages through every username instead
+        elif cmd == "directory":
+            try:
+                since = int(parts.get("since") or 0)
+                limit = int(parts.get("limit") or 0)
+            except (TypeError, ValueError):
+                conn.send(self.create_msg(cmd, body="Invalid directory version", err=True))
+                return True
+            delta = self.store.directory_changes(since, limit)
+            if delta is not None:
+                version, added, removed, more = delta
+                sync = {"version": version, "reset": False, "added": added, "removed": removed, "more": more, "next": ""}
+            else:
+                # Read the version before listing so changes made during the listing come back in a later delta
+                version = self.store.directory_version
+                names, next_token = self.store.list_users_page("*", parts.get("after") or None, limit)
+                sync = {"version": version, "reset": True, "added": names, "removed": [],
+                        "more": next_token is not None, "next": next_token or ""}
+            conn.send(self.create_msg(cmd, extra_fields=sync))
+
+        # Subscribe this connection to pushed presence events ("presence_events"), or unsubscribe with body
+        # "unsubscribe". The reply lists who is online right now so the subscriber starts from a known state
+        elif cmd == "presence":
+            if parts.get("body") == "unsubscribe":
+                self.store.presence.unsubscribe(conn)
+                conn.send(self.create_msg(cmd, body="Unsubscribed"))
+            else:
+                self.store.presence.subscribe(conn, lambda events: conn.push(
+                    self.create_msg("presence_events", extra_fields={"events": events}), lambda: None))
+                conn.send(self.create_msg(cmd, body="Subscribed", extra_fields={"online": self.store.online_users()}))
+
+        # Send a message from one user to another and record it in conversation history
+        elif cmd == "send":
+            recipient = parts.get("to")
+            message = parts.get("body")
+            message_entry = self.store.record_message(username, recipient, message)
+
+            if not self.store.user_exists(recipient):
+                conn.send(self.create_msg(cmd, body="Recipient not found", err=True))
+            else:
+                recipient_conn = self.store.get_active(recipient)
+                if recipient_conn is not None:
+                    # Hand the message to the recipient's writer; if it is backed up it lands in the unread mailbox instead
+                    payload = json.dumps([{
+                        "id": message_entry.id,
+                        "sender": message_entry.sender,
+                        "message": message_entry.message,
+                        "timestamp": format_timestamp(message_entry.timestamp)
+                    }])
+                    recipient_conn.push(self.create_msg("chat", src=username, body=payload),
+                                        lambda: self.store.append_unread(recipient, message_entry))
+                else:
+                    self.store.append_unread(recipient, message_entry)
+                conn.send(self.create_msg(cmd, body="Message sent"))
+
+        # Return unread messages for a user, optionally limited by a count
+        elif cmd == "read":
+            limit = 0
+            body_field = parts.get("body", "")
+            if body_field:
+                try:
+                    limit = int(body_field)
+                except ValueError:
+                    limit = 0
+            messages_to_view = self.store.pop_unread(username, limit)
+            if messages_to_view is None:
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            else:
+                msgs_with_index = []
+                for msg_entry in messages_to_view:
+                    msgs_with_index.append({
+                        "id": msg_entry.id,
+                        "sender": msg_entry.sender,
+                        "message": msg_entry.message
+                    })
+                composite_body = json.dumps(msgs_with_index, indent=2)
+                conn.send(self.create_msg(cmd, body=composite_body))
+
+        # Delete messages by their IDs from unread and conversation histories
+        elif cmd == "delete_msg":
+            if not self.store.user_exists(username):
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            else:
+                raw_ids = parts.get("body", "")
+                if not raw_ids.strip():
+                    conn.send(self.create_msg(cmd, body="No message ID provided", err=True))
+                    return True
+                try:
+                    ids_to_delete = [int(x.strip()) for x in raw_ids.split(",") if x.strip().isdigit()]
+                except Exception as e:
+                    conn.send(self.create_msg(cmd, body="Invalid message IDs", err=True))
+                    return True
+                if not ids_to_delete:
+                    conn.send(self.create_msg(cmd, body="No valid message IDs provided", err=True))
+                    return True
+
+                if not self.store.delete_user_messages(username, ids_to_delete):
+                    conn.send(self.create_msg(cmd, body="No matching message found to delete", err=True))
+                    return True
+                conn.send(self.create_msg(cmd, body="Specified messages deleted"))
+
+        # Show the conversation history between two users, one page at a time when the request carries a
+        # cursor ("before"/"after" message id) or a "limit"
+        elif cmd == "view_conv":
+            other_user = parts.get("to", "")
+            if not self.store.user_exists(other_user):
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            elif any(key in parts for key in ("before", "after", "limit")):
+                try:
+                    before = int(parts["before"]) if parts.get("before") is not None else None
+                    after = int(parts["after"]) if parts.get("after") is not None else None
+                    limit = int(parts.get("limit") or 0)
+                except (TypeError, ValueError):
+                    conn.send(self.create_msg(cmd, body="Invalid page cursor", err=True))
+                    return True
+                page, more = self.store.get_conversation_page(username, other_user, before, after, limit)
+                self.store.clear_unread_from(username, other_user)
+                page_body = json.dumps([{
+                    "id": msg_entry.id,
+                    "sender": msg_entry.sender,
+                    "message": msg_entry.message,
+                    "timestamp": format_timestamp(msg_entry.timestamp)
+                } for msg_entry in page])
+                conn.send(self.create_msg(cmd, to=other_user, body=page_body, extra_fields={"more": more}))
+            else:
+                conversation = self.store.get_conversation(username, other_user)
+                # Mark unread messages from the other user as read
+                self.store.clear_unread_from(username, other_user)
+                if not conversation:
+                    conn.send(self.create_msg(cmd, body="No conversation history found"))
+                else:
+                    conv_with_index = []
+                    for msg_entry in conversation:
+                        conv_with_index.append({
+                            "id": msg_entry.id,
+                            "sender": msg_entry.sender,
+                            "message": msg_entry.message,
+                            "timestamp": format_timestamp(msg_entry.timestamp)
+                        })
+                    conv_str = json.dumps(conv_with_index, indent=2)
+                    conn.send(self.create_msg(cmd, to=other_user, body=conv_str))
+
+        # Delete a user account 
+        elif cmd == "delete":
+            if not self.store.delete_user(username):
+                conn.send(self.create_msg(cmd, body="User does not exist", err=True))
+            else:
+                conn.send(self.create_msg(cmd, body="Account deleted"))
+
+        elif cmd == "logoff":
+            self.store.logoff(username)
+            conn.send(self.create_msg(cmd, body="User logged off"))
+
+        # Disconnect the client
+        elif cmd == "close":
+            return False
+        else:
+            conn.send(self.create_msg("error", body="Unknown command", err=True))
+        return True
+
     # Main function to handle a connected client
     def handle_client(self, conn, addr):
         print(f"[NEW CONNECTION] {addr} connected.")
+        # All writes to this socket go through its outbox; the handler thread only ever reads
+        outbox = Outbox(conn)
         try:
             for raw_msg in self.read_messages(conn):
                 if not raw_msg:
                     continue
-                try:
-                    parts = json.loads(raw_msg)
-                except json.JSONDecodeError:
-                    conn.send(self.create_msg("error", body="Invalid JSON", err=True))
-                    continue
-
-                cmd = parts.get("cmd")
-                username = parts.get("from")
+                if not self.handle_command(outbox, raw_msg):
+                    print(f"[DISCONNECT] {addr} disconnected.")
+                    break
+                # Nothing is acknowledged before it is durable; concurrent handlers share each fsync
+                self.store.commit()
+                outbox.flush()
+        except Exception as e:
+            print(f"[ERROR] Exception handling client {addr}: {e}")
+        finally:
+            self.store.presence.unsubscribe(outbox)
+            outbox.close()
+            print(f"[DISCONNECT] {addr} connection closed.")
 
-                # Ceck credentials and add user to active_users if valid
-                if cmd == "login":
-                    password = parts.get("password", "")
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="Username does not exist", err=True))
-                    else:
-                        stored_hash = self.users[username]["password_hash"]
-                        if stored_hash != self.hash_password(password):
-                            conn.send(self.create_msg(cmd, body="Incorrect password", err=True))
-                        elif username in self.active_users:
-                            conn.send(self.create_msg(cmd, body="Already logged in elsewhere", err=True))
-                        else:
-                            self.active_users[username] = conn
-                            unread_count = len(self.users[username]["messages"])
-                            conn.send(self.create_msg(cmd, body=f"Login successful. Unread messages: {unread_count}", to=username))
-
-                # Register a new account if the username is not already taken
-                elif cmd == "create":
-                    password = parts.get("password", "")
-                    if username in self.users:
-                        conn.send(self.create_msg(cmd, body="Username already exists", err=True))
-                    else:
-                        self.users[username] = {"password_hash": self.hash_password(password), "messages": []}
-                        conn.send(self.create_msg(cmd, body="Account created", to=username))
-
-                # Ccomma-separated list of usernames matching the wildcard
-                elif cmd == "list":
-                    wildcard = parts.get("body", "*")
-                    matching_users = fnmatch.filter(list(self.users.keys()), wildcard)
-                    matching_str = ",".join(matching_users)
-                    conn.send(self.create_msg(cmd, body=matching_str))
-
-                # Send a message from one user to another and record it in conversation history
-                elif cmd == "send":
-                    recipient = parts.get("to")
-                    message = parts.get("body")
-                    timestamp = datetime.datetime.now().isoformat()
-                    conv_key = tuple(sorted([username, recipient]))
-                    if conv_key not in self.conversations:
-                        self.conversations[conv_key] = []
-                    msg_id = self.next_msg_id
-                    self.next_msg_id += 1
-                    message_entry = {
-                        "id": msg_id,
-                        "sender": username,
-                        "message": message,
-                        "timestamp": timestamp
-                    }
-                    self.conversations[conv_key].append(message_entry)
-
-                    if recipient not in self.users:
-                        conn.send(self.create_msg(cmd, body="Recipient not found", err=True))
-                    else:
-                        if recipient in self.active_users:
-                            try:
-                                # Immediately push the message if the recipient is online
-                                payload = json.dumps([message_entry])
-                                self.active_users[recipient].send(self.create_msg("chat", src=username, body=payload))
-                            except Exception as e:
-                                print(f"Error sending to active user {recipient}: {e}")
-                                self.users[recipient]["messages"].append(message_entry)
-                        else:
-                            self.users[recipient]["messages"].append(message_entry)
-                        conn.send(self.create_msg(cmd, body="Message sent"))
-
-                # Return unread messages for a user, optionally limited by a count
-                elif cmd == "read":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        limit = None
-                        body_field = parts.get("body", "")
-                        if body_field:
-                            try:
-                                limit = int(body_field)
-                            except ValueError:
-                                limit = None
-                        user_messages = self.users[username]["messages"]
-                        if limit is not None and limit > 0:
-                            messages_to_view = user_messages[:limit]
-                            self.users[username]["messages"] = user_messages[limit:]
-                        else:
-                            messages_to_view = user_messages
-                            self.users[username]["messages"] = []
-                        msgs_with_index = []
-                        for msg_entry in messages_to_view:
-                            msgs_with_index.append({
-                                "id": msg_entry["id"],
-                                "sender": msg_entry["sender"],
-                                "message": msg_entry["message"]
-                            })
-                        composite_body = json.dumps(msgs_with_index, indent=2)
-                        conn.send(self.create_msg(cmd, body=composite_body))
-
-                # Delete messages by their IDs from unread and conversation histories
-                elif cmd == "delete_msg":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        raw_ids = parts.get("body", "")
-                        if not raw_ids.strip():
-                            conn.send(self.create_msg(cmd, body="No message ID provided", err=True))
-                            continue
-                        try:
-                            ids_to_delete = [int(x.strip()) for x in raw_ids.split(",") if x.strip().isdigit()]
-                        except Exception as e:
-                            conn.send(self.create_msg(cmd, body="Invalid message IDs", err=True))
-                            continue
-                        if not ids_to_delete:
-                            conn.send(self.create_msg(cmd, body="No valid message IDs provided", err=True))
-                            continue
-
-                        message_exists = False
-                        for msg in self.users[username]["messages"]:
-                            if msg["id"] in ids_to_delete:
-                                message_exists = True
-                                break
-                        if not message_exists:
-                            for conv_key in self.conversations:
-                                if username in conv_key:
-                                    for msg in self.conversations[conv_key]:
-                                        if msg["id"] in ids_to_delete:
-                                            message_exists = True
-                                            break
-                                    if message_exists:
-                                        break
-                        if not message_exists:
-                            conn.send(self.create_msg(cmd, body="No matching message found to delete", err=True))
-                            continue
-
-                        current_unread = self.users[username]["messages"]
-                        self.users[username]["messages"] = [msg for msg in current_unread if msg["id"] not in ids_to_delete]
-                        for conv_key in self.conversations:
-                            if username in conv_key:
-                                conv = self.conversations[conv_key]
-                                self.conversations[conv_key] = [msg for msg in conv if msg["id"] not in ids_to_delete]
-                        conn.send(self.create_msg(cmd, body="Specified messages deleted"))
-
-                # Show the full conversation history between two users
-                elif cmd == "view_conv":
-                    other_user = parts.get("to", "")
-                    if other_user not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        conv_key = tuple(sorted([username, other_user]))
-                        conversation = self.conversations.get(conv_key, [])
-                        # Mark unread messages from the other user as read
-                        if username in self.users:
-                            current_unread = self.users[username]["messages"]
-                            self.users[username]["messages"] = [msg for msg in current_unread if msg["sender"] != other_user]
-                        if not conversation:
-                            conn.send(self.create_msg(cmd, body="No conversation history found"))
-                        else:
-                            conv_with_index = []
-                            for msg_entry in conversation:
-                                conv_with_index.append({
-                                    "id": msg_entry["id"],
-                                    "sender": msg_entry["sender"],
-                                    "message": msg_entry["message"],
-                                    "timestamp": msg_entry["timestamp"]
-                                })
-                            conv_str = json.dumps(conv_with_index, indent=2)
-                            conn.send(self.create_msg(cmd, to=other_user, body=conv_str))
-
-                # Delete a user account 
-                elif cmd == "delete":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User does not exist", err=True))
+    # Event loop counterpart of handle_client: same commands, but one coroutine per connection instead of a thread
+    async def handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        conn = AsyncConnection(writer)
+        print(f"[NEW CONNECTION] {addr} connected.")
+        framer = LineFramer(ChatServer.MSGLEN)
+        try:
+            while True:
+                data = await reader.read(ChatServer.MSGLEN)
+                if not data:
+                    break
+                closing = False
+                for raw_msg in framer.feed(data):
+                    if raw_msg and not self.handle_command(conn, raw_msg):
+                        closing = True
+                        break
+                    if self.store.wal is not None:
+                        # Wait for the group fsync off the loop so other connections keep being served meanwhile
+                        await asyncio.get_running_loop().run_in_executor(None, self.store.commit)
                     else:
-                        del self.users[username]
-                        if username in self.active_users:
-                            del self.active_users[username]
-                        conn.send(self.create_msg(cmd, body="Account deleted"))
-
-                elif cmd == "logoff":
-                    if username in self.active_users:
-                        del self.active_users[username]
-                    conn.send(self.create_msg(cmd, body="User logged off"))
-
-                # Disconnect the client
-                elif cmd == "close":
+                        self.store.commit()
+                    conn.flush()
+                if closing:
                     print(f"[DISCONNECT] {addr} disconnected.")
                     break
-                else:
-                    conn.send(self.create_msg("error", body="Unknown command", err=True))
+                await writer.drain()
         except Exception as e:
             print(f"[ERROR] Exception handling client {addr}: {e}")
         finally:
+            self.store.presence.unsubscribe(conn)
             conn.close()
             print(f"[DISCONNECT] {addr} connection closed.")
 
 if __name__ == "__main__":
-    server = ChatServer(host='localhost', port=12345)
+    # Pass --asyncio to serve all clients from a single event loop, and --wal PATH to keep state across restarts.
+    # --db PATH keeps the state in a SQLite file instead of in memory, and --history DIR spills old messages
+    # and idle mailboxes there.
+    args = sys.argv[1:]
+    mode = "asyncio" if "--asyncio" in args else "threaded"
+    wal_path = args[args.index("--wal") + 1] if "--wal" in args[:-1] else None
+    db_path = args[args.index("--db") + 1] if "--db" in args[:-1] else None
+    history_dir = args[args.index("--history") + 1] if "--history" in args[:-1] else None
+    server = ChatServer(host='localhost', port=12345, mode=mode, wal_path=wal_path, db_path=db_path,
+                        history_dir=history_dir)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -7,7 +7,13 @@ import re
 from io import StringIO
 import contextlib
 import struct
+import os
+import shutil
+import sqlite3
+import tempfile
 from server import ChatServer
+from outbox import Outbox, sendmsg_all
+from framing import LineFramer, LineTooLong
 
 MSGLEN = 409600
 TEST_HOST = '127.0.0.1'
@@ -91,6 +97,31 @@ class TestChatServer(unittest.TestCase):
         self.assertIn("user3", body)
         self.assertIn("user4", body)
 
+    def test_list_accounts_pages(self):
+        for username in ["pageuser1", "pageuser2", "pageuser3"]:
+            msg_create = {"cmd": "create", "from": username, "to": "", "body": "", "password": "pass"}
+            self.send_and_recv(msg_create)
+        msg_list = {"cmd": "list", "from": "", "to": "", "body": "pageuser*", "limit": 2}
+        resp_list = self.send_and_recv(msg_list)
+        self.assertEqual(resp_list["body"], "pageuser1,pageuser2")
+        self.assertEqual(resp_list["next"], "pageuser2")
+        msg_list["after"] = resp_list["next"]
+        resp_list = self.send_and_recv(msg_list)
+        self.assertEqual(resp_list["body"], "pageuser3")
+        self.assertEqual(resp_list["next"], "")
+
+    def test_directory_sync(self):
+        resp = self.send_and_recv({"cmd": "directory", "from": "", "since": 0, "limit": 0})
+        self.assertFalse(resp["reset"])
+        version = resp["version"]
+        for username in ["diruser1", "diruser2"]:
+            self.send_and_recv({"cmd": "create", "from": username, "to": "", "body": "", "password": "pass"})
+        self.send_and_recv({"cmd": "delete", "from": "diruser1", "to": "", "body": ""})
+        resp = self.send_and_recv({"cmd": "directory", "from": "", "since": version, "limit": 0})
+        self.assertEqual((resp["added"], resp["removed"]), (["diruser2"], ["diruser1"]))
+        self.assertEqual(resp["version"], version + 3)
+        self.assertFalse(resp["more"])
+
     def test_send_and_read_message(self):
         for username, password in [("sender", "pass"), ("receiver", "pass")]:
             msg_create = {"cmd": "create", "from": username, "to": "", "body": "", "password": password}
@@ -184,6 +215,9 @@ class TestChatServer(unittest.TestCase):
                 break
         msg_send1 = {"cmd": "send", "from": "conv_user1", "to": "conv_user2", "body": "Hello from conv_user1"}
         user1_sock.sendall((json.dumps(msg_send1) + "\n").encode())
+        data_sent = ""
+        while "\n" not in data_sent:
+            data_sent += user1_sock.recv(MSGLEN).decode()
         data_chat = ""
         while "\n" not in data_chat:
             data_chat += user2_sock.recv(MSGLEN).decode()
@@ -204,6 +238,10 @@ class TestChatServer(unittest.TestCase):
         msg_id_to_delete = conv_history[0]["id"]
         msg_delete = {"cmd": "delete_msg", "from": "conv_user1", "to": "", "body": str(msg_id_to_delete)}
         user1_sock.sendall((json.dumps(msg_delete) + "\n").encode())
+        data_deleted = ""
+        while "\n" not in data_deleted:
+            data_deleted += user1_sock.recv(MSGLEN).decode()
+        self.assertIn("Specified messages deleted", json.loads(data_deleted.strip().split("\n")[0]).get("body", ""))
         user1_sock.sendall((json.dumps(msg_view) + "\n").encode())
         data_conv2 = ""
         while "\n" not in data_conv2:
@@ -212,12 +250,28 @@ class TestChatServer(unittest.TestCase):
         resp_conv2 = json.loads(first_line_conv2)
         conv_history2 = json.loads(resp_conv2.get("body", "[]"))
         ids = [msg["id"] for msg in conv_history2]
-        self.assertNotIn(msg_id_to_delete, [1])
+        self.assertNotIn(msg_id_to_delete, ids)
         user1_sock.sendall((json.dumps({"cmd": "logoff", "from": "conv_user1", "to": "", "body": ""}) + "\n").encode())
         user2_sock.sendall((json.dumps({"cmd": "logoff", "from": "conv_user2", "to": "", "body": ""}) + "\n").encode())
         user1_sock.close()
         user2_sock.close()
 
+    def test_view_conv_pages(self):
+        for user in ("page_user1", "page_user2"):
+            self.send_and_recv({"cmd": "create", "from": user, "to": "", "body": "", "password": "pass"})
+        for i in range(5):
+            self.send_and_recv({"cmd": "send", "from": "page_user1", "to": "page_user2", "body": f"m{i}"})
+        view = {"cmd": "view_conv", "from": "page_user2", "to": "page_user1", "body": "", "limit": 2}
+        resp = self.send_and_recv(view)
+        page = json.loads(resp["body"])
+        self.assertEqual([m["message"] for m in page], ["m3", "m4"])
+        self.assertTrue(resp["more"])
+        resp = self.send_and_recv(dict(view, before=page[0]["id"], limit=10))
+        self.assertEqual([m["message"] for m in json.loads(resp["body"])], ["m0", "m1", "m2"])
+        self.assertFalse(resp["more"])
+        resp = self.send_and_recv(dict(view, before="x"))
+        self.assertTrue(resp["error"])
+
     def test_delete_account(self):
         username = "delete_user"
         msg_create = {"cmd": "create", "from": username, "to": "", "body": "", "password": "pass"}
@@ -252,5 +306,242 @@ class TestChatServer(unittest.TestCase):
         s.sendall((json.dumps(msg_close) + "\n").encode())
         s.close()
 
+class TestBatchedWrites(unittest.TestCase):
+    def test_request_replies_leave_in_one_sendmsg(self):
+        calls = []
+        class RecordingSocket:
+            def sendmsg(self, buffers):
+                calls.append(len(buffers))
+                return sum(len(b) for b in buffers)
+            def close(self):
+                pass
+        outbox = Outbox(RecordingSocket())
+        for i in range(500):
+            outbox.send(b"frame %d\n" % i)
+        outbox.flush()
+        outbox.close()
+        outbox.writer.join(timeout=2)
+        self.assertEqual(calls, [500])
+
+    def test_partial_sendmsg_is_resumed(self):
+        a, b = socket.socketpair()
+        a.setblocking(True)
+        frames = [bytes([65 + i % 26]) * 3000 for i in range(200)]
+        reader = threading.Thread(target=lambda: received.append(self.recv_all(b, sum(map(len, frames)))))
+        received = []
+        reader.start()
+        sendmsg_all(a, frames)
+        reader.join(timeout=5)
+        self.assertEqual(received[0], b"".join(frames))
+        a.close()
+        b.close()
+
+    @staticmethod
+    def recv_all(sock, n):
+        data = b""
+        while len(data) < n:
+            data += sock.recv(65536)
+        return data
+
+class TestLineFramer(unittest.TestCase):
+    def test_multibyte_character_split_across_reads(self):
+        framer = LineFramer()
+        data = (json.dumps({"body": "caf\u00e9 \u2603"}, ensure_ascii=False) + "\n").encode()
+        split = data.index("\u2603".encode()) + 1
+        self.assertEqual(framer.feed(data[:split]), [])
+        lines = framer.feed(data[split:])
+        self.assertEqual(json.loads(lines[0])["body"], "caf\u00e9 \u2603")
+
+    def test_burst_of_lines_and_partial_tail(self):
+        framer = LineFramer()
+        lines = framer.feed(b"".join(b'{"n": %d}\n' % i for i in range(1000)) + b'{"n": ')
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(framer.feed(b"1000}\n"), ['{"n": 1000}'])
+
+    def test_line_limit(self):
+        framer = LineFramer(max_line=16)
+        with self.assertRaises(LineTooLong):
+            framer.feed(b"x" * 17)
+
+class TestOutbox(unittest.TestCase):
+    def test_slow_receiver_overflows_to_fallback(self):
+        # The peer never reads, so the writer eventually stalls; pushes must still return immediately
+        a, b = socket.socketpair()
+        outbox = Outbox(a, max_depth=4, send_deadline=0.2)
+        dropped = []
+        frame = b"x" * 65536
+        start = time.monotonic()
+        for i in range(64):
+            outbox.push(frame, lambda i=i: dropped.append(i))
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertGreater(len(dropped), 0)
+        outbox.close()
+        b.close()
+
+    def test_failed_write_drops_only_unsent_pushes(self):
+        # The kernel takes the first push and part of the second before the connection fails, however the
+        # writer happens to group them
+        class FailingSocket:
+            room = 8
+            def sendmsg(self, buffers):
+                if not self.room:
+                    raise OSError("Connection reset")
+                sent = min(self.room, sum(len(b) for b in buffers))
+                self.room -= sent
+                return sent
+            def close(self):
+                pass
+        outbox = Outbox(FailingSocket())
+        dropped = []
+        for i in range(3):
+            outbox.push(b"push%d\n" % i, lambda i=i: dropped.append(i))
+        outbox.close()
+        outbox.writer.join(timeout=2)
+        self.assertEqual(dropped, [1, 2])
+
+    def test_flush_gives_up_on_a_peer_that_stopped_reading(self):
+        a, b = socket.socketpair()
+        outbox = Outbox(a, max_depth=1, send_deadline=0.2)
+        start = time.monotonic()
+        with self.assertRaises(OSError):
+            for i in range(64):
+                outbox.send(b"x" * 65536)
+                outbox.flush()
+        self.assertLess(time.monotonic() - start, 2.0)
+        outbox.close()
+        b.close()
+
+    def test_replies_and_pushes_arrive_in_order(self):
+        a, b = socket.socketpair()
+        outbox = Outbox(a)
+        outbox.send(b"reply\n")
+        outbox.flush()
+        outbox.push(b"push\n", lambda: self.fail("push should not be dropped"))
+        outbox.close()
+        data = b""
+        while True:
+            chunk = b.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(data, b"reply\npush\n")
+        b.close()
+
+ASYNC_TEST_PORT = 56790
+
+class TestAsyncChatServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ChatServer(host=TEST_HOST, port=ASYNC_TEST_PORT, mode="asyncio")
+        cls.server_thread = threading.Thread(target=cls.server.start, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server_thread.join(timeout=1)
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((TEST_HOST, ASYNC_TEST_PORT))
+        return s
+
+    def request(self, s, msg_dict):
+        s.sendall((json.dumps(msg_dict) + "\n").encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            data += s.recv(MSGLEN)
+        return json.loads(data.decode().strip())
+
+    def test_unknown_mode_rejected(self):
+        with self.assertRaises(ValueError):
+            ChatServer(host=TEST_HOST, port=ASYNC_TEST_PORT + 1, mode="forking")
+
+    def test_create_and_login(self):
+        s = self.connect()
+        resp = self.request(s, {"cmd": "create", "from": "async_user1", "to": "", "body": "", "password": "pw"})
+        self.assertIn("Account created", resp.get("body", ""))
+        resp = self.request(s, {"cmd": "login", "from": "async_user1", "to": "", "body": "", "password": "pw"})
+        self.assertIn("Login successful", resp.get("body", ""))
+        self.request(s, {"cmd": "logoff", "from": "async_user1", "to": "", "body": ""})
+        s.close()
+
+    def test_live_message_between_connections(self):
+        sender, receiver = self.connect(), self.connect()
+        for s, name in [(sender, "async_sender"), (receiver, "async_receiver")]:
+            self.request(s, {"cmd": "create", "from": name, "to": "", "body": "", "password": "pw"})
+            self.request(s, {"cmd": "login", "from": name, "to": "", "body": "", "password": "pw"})
+        resp = self.request(sender, {"cmd": "send", "from": "async_sender", "to": "async_receiver", "body": "Hi async"})
+        self.assertIn("Message sent", resp.get("body", ""))
+        data = b""
+        while not data.endswith(b"\n"):
+            data += receiver.recv(MSGLEN)
+        chat = json.loads(data.decode().strip())
+        self.assertEqual(chat.get("cmd"), "chat")
+        self.assertEqual(json.loads(chat["body"])[0]["message"], "Hi async")
+        sender.close()
+        receiver.close()
+
+    def test_presence_events_pushed(self):
+        watcher, other = self.connect(), self.connect()
+        resp = self.request(watcher, {"cmd": "presence", "from": "", "to": "", "body": "subscribe"})
+        self.assertEqual(resp.get("body"), "Subscribed")
+        self.request(other, {"cmd": "create", "from": "async_presence", "to": "", "body": "", "password": "pw"})
+        self.request(other, {"cmd": "login", "from": "async_presence", "to": "", "body": "", "password": "pw"})
+        data = b""
+        while not data.endswith(b"\n"):
+            data += watcher.recv(MSGLEN)
+        push = json.loads(data.decode().strip())
+        self.assertEqual(push.get("cmd"), "presence_events")
+        # Created and then logged in within one window: only the latest event is sent
+        self.assertEqual(push["events"], [["async_presence", "online"]])
+        watcher.close()
+        other.close()
+
+SQLITE_TEST_PORT = 56791
+
+class TestSqliteChatServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.server = ChatServer(host=TEST_HOST, port=SQLITE_TEST_PORT, mode="asyncio",
+                                db_path=os.path.join(cls.directory, "chat.db"))
+        cls.server_thread = threading.Thread(target=cls.server.start, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server_thread.join(timeout=1)
+        shutil.rmtree(cls.directory)
+
+    def request(self, s, msg_dict):
+        s.sendall((json.dumps(msg_dict) + "\n").encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            data += s.recv(MSGLEN)
+        return json.loads(data.decode().strip())
+
+    def test_offline_message_is_stored_and_read(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((TEST_HOST, SQLITE_TEST_PORT))
+        for name in ["db_sender", "db_receiver"]:
+            self.request(s, {"cmd": "create", "from": name, "to": "", "body": "", "password": "pw"})
+        self.request(s, {"cmd": "login", "from": "db_sender", "to": "", "body": "", "password": "pw"})
+        resp = self.request(s, {"cmd": "send", "from": "db_sender", "to": "db_receiver", "body": "Stored"})
+        self.assertIn("Message sent", resp.get("body", ""))
+        self.request(s, {"cmd": "logoff", "from": "db_sender", "to": "", "body": ""})
+        resp = self.request(s, {"cmd": "login", "from": "db_receiver", "to": "", "body": "", "password": "pw"})
+        self.assertIn("Login successful", resp.get("body", ""))
+        # Committed before the reply, so a second connection to the file sees it
+        other = sqlite3.connect(os.path.join(self.directory, "chat.db"))
+        self.assertEqual(other.execute("SELECT COUNT(*) FROM unread").fetchone()[0], 1)
+        other.close()
+        resp = self.request(s, {"cmd": "read", "from": "db_receiver", "to": "", "body": ""})
+        self.assertEqual([m["message"] for m in json.loads(resp["body"])], ["Stored"])
+        s.close()
+
 if __name__ == '__main__':
     unittest.main()
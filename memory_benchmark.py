@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared"))
+
+from store import ChatStore, Message, now_micros
+
+# WHOLE STORES
+
+def decoded_sender(name):
+    # A username as the server sees it: freshly decoded from each request, so never the same object twice
+    return json.loads(json.dumps(name))
+
+def reference_store(count, senders):
+    # The layout the first ChatStore used: one dict per message, with its own copy of the sender's name and an
+    # ISO timestamp, appended to a list per conversation (keyed by the sorted pair of names) and to the
+    # recipient's list of unread messages. There were no indexes.
+    users = {name: {"password_hash": "hash", "messages": []} for name in senders + ["reader"]}
+    conversations = {}
+    for i in range(count):
+        sender = decoded_sender(senders[i % len(senders)])
+        entry = {
+            "id": i + 1,
+            "sender": sender,
+            "message": f"message number {i}",
+            "timestamp": datetime.datetime.now().isoformat()
+        }
+        conversations.setdefault((sender, "reader") if sender <= "reader" else ("reader", sender), []).append(entry)
+        users["reader"]["messages"].append(entry)
+    return users, conversations
+
+def chat_store(count, senders):
+    # The current ChatStore through its own send path: each message is recorded in the conversation history
+    # (with the message index) and queued in the recipient's unread mailbox
+    store = ChatStore()
+    for name in senders + ["reader"]:
+        store.create_user(name, "hash")
+    for i in range(count):
+        entry = store.record_message(decoded_sender(senders[i % len(senders)]), "reader", f"message number {i}")
+        store.append_unread("reader", entry)
+    return store
+
+# RECORDS ALONE
+
+def dict_records(count, senders):
+    return [{"id": i + 1, "sender": decoded_sender(senders[i % len(senders)]), "message": f"message number {i}",
+             "timestamp": datetime.datetime.now().isoformat()} for i in range(count)]
+
+def message_records(count, senders):
+    return [Message(i + 1, decoded_sender(senders[i % len(senders)]), f"message number {i}", now_micros())
+            for i in range(count)]
+
+def measure(build, count, senders):
+    # Both stores create their accounts while traced; that fixed cost is spread over the messages
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(count, senders)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count, result
+
+def main():
+    count = 200000
+    senders = [f"user{i:03d}" for i in range(100)]
+    # The text strings are the same in every layout
+    text_bytes = sum(sys.getsizeof(f"message number {i}") for i in range(count)) / count
+
+    reference_bytes, _ = measure(reference_store, count, senders)
+    store_bytes, _ = measure(chat_store, count, senders)
+    dict_bytes, _ = measure(dict_records, count, senders)
+    message_bytes, records = measure(message_records, count, senders)
+
+    print(f"{count} messages from {len(senders)} senders to one reader, each kept in history and unread")
+    print("Reference Store (dict records in lists):")
+    print(f"Bytes per message: {reference_bytes:.1f}")
+    print(f"Excluding text: {reference_bytes - text_bytes:.1f}")
+    print()
+    print("ChatStore (history, unread mailbox and indexes):")
+    print(f"Bytes per message: {store_bytes:.1f}")
+    print(f"Excluding text: {store_bytes - text_bytes:.1f}")
+    print(f"Change: {(store_bytes - reference_bytes) / reference_bytes * 100:+.1f}%")
+    print()
+    print("Records alone:")
+    print(f"Dict record excluding text: {dict_bytes - text_bytes:.1f}")
+    print(f"Message record excluding text: {message_bytes - text_bytes:.1f}")
+    print(f"Size of one Message: {sys.getsizeof(records[0])} bytes")
+
+if __name__ == "__main__":
+    main()
+
+#*
+
+# run this file using: python3 memory_benchmark.py
+
+# 200000 messages from 100 senders to one reader, each kept in history and unread
+# Reference Store (dict records in lists):
+# Bytes per message: 432.7
+# Excluding text: 363.2
+
+# ChatStore (history, unread mailbox and indexes):
+# Bytes per message: 282.3
+# Excluding text: 212.9
+# Change: -34.8%
+
+# Records alone:
+# Dict record excluding text: 355.0
+# Message record excluding text: 140.1
+# Size of one Message: 64 bytes
+
+# The reference is the store as it first was: a dict per message in two plain lists, with no indexes. Almost
+# all of its 363 bytes besides the text are the record: a 184-byte hash table, a fresh copy of the sender's
+# name from every request and a 26-character ISO timestamp string. The lists add 16 bytes.
+# A slotted Message with an interned sender and an integer timestamp is 140 bytes besides the text. The
+# indexes the store has gained since (the message index, bisectable history and a mailbox with O(1) deletes
+# and per-sender clears) used to cost more than that saving: with an OrderedDict mailbox plus a set per
+# sender, a dict plus sorted id list per conversation and a dict for the message index, the whole store came
+# to 498 bytes per message, more than the reference. Those indexes now use flat structures. The message index
+# is one array slot per id. A conversation holds an id array and a parallel list of entries. A mailbox holds a
+# deque of entries, a set of unread ids and an id array per sender. Together they take about 73 bytes per
+# message, over half of it the unread set. The whole store now comes to 282 bytes per message, 35% less
+# than the reference (213 bytes besides the text, down from 363).
+#*
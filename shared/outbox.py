@@ -0,0 +1,186 @@
+import os
+import queue
+import socket
+import threading
+import time
+
+# Most frames that may wait for one connection's writer before live pushes fall back to the mailbox
+OUTBOX_DEPTH = 256
+# Seconds a live push may sit in the queue before it is handed back to the mailbox instead of sent
+SEND_DEADLINE = 5.0
+# Most buffers one sendmsg call may gather
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def advance_views(views, sent):
+    # Drop the first `sent` bytes from a list of memoryviews after a partial gathered write
+    while sent:
+        head = len(views[0])
+        if sent >= head:
+            sent -= head
+            del views[0]
+        else:
+            views[0] = views[0][sent:]
+            sent = 0
+
+def sendmsg_all(sock, buffers):
+    # Write every buffer with as few gathered sendmsg calls as possible, never joining the frames
+    sent, error = sendmsg_counted(sock, buffers)
+    if error is not None:
+        raise error
+
+def sendmsg_counted(sock, buffers):
+    # sendmsg_all that reports instead of raising: (bytes the kernel accepted, the OSError that stopped it or
+    # None). Without sendmsg nothing is known to have been written until sendall returns.
+    if not hasattr(sock, "sendmsg"):
+        data = b"".join(buffers)
+        try:
+            sock.sendall(data)
+        except OSError as e:
+            return 0, e
+        return len(data), None
+    views = [memoryview(b) for b in buffers if len(b)]
+    total = 0
+    while views:
+        try:
+            sent = sock.sendmsg(views[:IOV_MAX])
+        except OSError as e:
+            return total, e
+        total += sent
+        advance_views(views, sent)
+    return total, None
+
+def return_push(on_drop):
+    # Handing a push back to its mailbox is logged, which raises once the log has failed. The connection
+    # giving it back still has to shut down cleanly, so the error is reported rather than raised.
+    try:
+        on_drop()
+    except OSError as e:
+        print(f"Could not return a push to the mailbox: {e}")
+
+class Outbox:
+    # Per-connection outbound queue drained by a dedicated writer thread.
+    # Handler threads only ever enqueue, so a recipient with a full TCP window cannot stall whoever is sending to it.
+    # Replies produced while one request is handled are batched and leave in a single sendmsg at flush().
+    def __init__(self, sock, max_depth=OUTBOX_DEPTH, send_deadline=SEND_DEADLINE):
+        self.sock = sock
+        self.queue = queue.Queue(maxsize=max_depth)
+        self.send_deadline = send_deadline
+        self.closed = False
+        self.broken = False
+        self.lock = threading.Lock()
+        self.batch = []
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, data):
+        # Replies to this connection's own request are held until flush() so they go out together
+        if self.closed:
+            raise OSError("Connection is closed")
+        self.batch.append(data)
+        return len(data)
+
+    def flush(self):
+        # Queue the current request's replies as one item. Waits for room rather than dropping them, but no
+        # longer than a live push may wait: a peer that lets the queue sit full that long has stopped reading.
+        if self.batch:
+            batch, self.batch = self.batch, []
+            try:
+                self.queue.put((batch, None, None), timeout=self.send_deadline)
+            except queue.Full:
+                raise OSError("Peer stopped reading") from None
+
+    def sendall(self, data):
+        self.send(data)
+
+    def push(self, data, on_drop):
+        # Live delivery on behalf of another user; never blocks the caller.
+        # on_drop is called (now or later, from the writer) if the frame cannot reach the socket in time.
+        with self.lock:
+            if not self.closed:
+                try:
+                    self.queue.put_nowait((data, time.monotonic() + self.send_deadline, on_drop))
+                    return True
+                except queue.Full:
+                    pass
+        on_drop()
+        return False
+
+    def write_loop(self):
+        stop = False
+        while not stop:
+            try:
+                items = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                if self.closed:
+                    break
+                continue
+            # Coalesce whatever else is already queued into the same gathered write
+            while len(items) < IOV_MAX:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            buffers = []
+            # (end offset of the frame within this write, on_drop) for every live push in it
+            drops = []
+            size = 0
+            now = time.monotonic()
+            for item in items:
+                if item is None:
+                    stop = True
+                    break
+                data, deadline, on_drop = item
+                if self.broken or (deadline is not None and now > deadline):
+                    if on_drop is not None:
+                        return_push(on_drop)
+                    continue
+                if isinstance(data, list):
+                    buffers.extend(data)
+                    size += sum(len(b) for b in data)
+                else:
+                    buffers.append(data)
+                    size += len(data)
+                if on_drop is not None:
+                    drops.append((size, on_drop))
+            if not buffers:
+                continue
+            sent, error = sendmsg_counted(self.sock, buffers)
+            if error is not None:
+                self.broken = True
+                # Pushes the kernel took in full were delivered; only the rest go back to their mailboxes
+                for end, on_drop in drops:
+                    if end > sent:
+                        return_push(on_drop)
+        # Anything still queued never reached the socket, so give live pushes back to their mailboxes
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[2] is not None:
+                return_push(item[2])
+        self.sock.close()
+
+    def close(self):
+        # Let the writer finish queued replies, unless it is stuck on a peer that stopped reading
+        if self.batch and not self.broken:
+            try:
+                self.queue.put_nowait((self.batch, None, None))
+            except queue.Full:
+                pass
+            self.batch = []
+        with self.lock:
+            self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.broken = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
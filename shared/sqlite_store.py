@@ -0,0 +1,309 @@
+import fnmatch
+import itertools
+import sqlite3
+import threading
+
+from store import ChatStore, Message, conversation_key, literal_prefix, now_micros, stored_timestamp, INDEX_CHUNK
+
+# Users, conversations, messages and unread mailboxes live in tables; only sessions, the presence feed and the
+# recent directory changes stay in memory. A message that was deleted from its conversation but is still
+# unread somewhere keeps its row with conversation set to NULL until the last mailbox lets go of it.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    user_a TEXT NOT NULL,
+    user_b TEXT NOT NULL,
+    UNIQUE (user_a, user_b)
+);
+CREATE INDEX IF NOT EXISTS conversations_by_user_b ON conversations (user_b);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation INTEGER,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id);
+CREATE TABLE IF NOT EXISTS unread (
+    seq INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    message INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS unread_by_user ON unread (username, seq);
+CREATE INDEX IF NOT EXISTS unread_by_sender ON unread (username, sender);
+CREATE INDEX IF NOT EXISTS unread_by_message ON unread (message);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+ENTRY_COLUMNS = "m.id, m.sender, m.message, m.timestamp"
+
+def row_entry(row):
+    msg_id, sender, message, timestamp = row
+    return Message(msg_id, sender, message, stored_timestamp(timestamp))
+
+class SqliteStore(ChatStore):
+    # ChatStore kept in a local SQLite file instead of in memory, so memory use no longer grows with the
+    # history. History pages, deletes by id and per-sender unread lookups are index lookups. Every query uses
+    # a constant statement with parameters, so the connection's statement cache prepares each one only once.
+    # Changes collect in one open transaction that commit() ends, and the servers call commit() before they
+    # reply, so every request that finished in the meantime shares the same commit.
+    def __init__(self, path):
+        ChatStore.__init__(self, stripes=1)
+        # A single connection shared by every thread, used only under db_lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.RLock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL never corrupts the file; a power cut can only lose the last commits
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'directory_version'").fetchone()
+        self.directory_version = row[0] if row is not None else 0
+
+    def user_lock(self, username):
+        # Every change goes through the one connection, so inherited code that locks a user takes db_lock too
+        return self.db_lock
+
+    def conv_lock(self, conv_key):
+        return self.db_lock
+
+    def commit(self):
+        with self.db_lock:
+            if self.db.in_transaction:
+                self.db.commit()
+
+    def close(self):
+        with self.db_lock:
+            self.db.commit()
+            self.db.close()
+
+    def recover(self, wal):
+        raise ValueError("The SQLite store is durable on its own and does not replay a write-ahead log")
+
+    # Accounts
+
+    def create_user(self, username, password_hash):
+        with self.db_lock:
+            cur = self.db.execute("INSERT OR IGNORE INTO users (name, password_hash) VALUES (?, ?)",
+                                  (username, password_hash))
+            if cur.rowcount == 0:
+                return False
+            self.log_directory_change(username, True)
+            self.presence.publish(username, "created")
+            return True
+
+    def user_exists(self, username):
+        with self.db_lock:
+            return self.db.execute("SELECT 1 FROM users WHERE name = ?", (username,)).fetchone() is not None
+
+    def password_hash(self, username):
+        with self.db_lock:
+            row = self.db.execute("SELECT password_hash FROM users WHERE name = ?", (username,)).fetchone()
+            return row[0] if row is not None else None
+
+    def delete_user(self, username):
+        with self.db_lock:
+            if self.db.execute("DELETE FROM users WHERE name = ?", (username,)).rowcount == 0:
+                return False
+            ids = [row[0] for row in self.db.execute("SELECT message FROM unread WHERE username = ?", (username,))]
+            self.db.execute("DELETE FROM unread WHERE username = ?", (username,))
+            self.purge(ids)
+            self.active_users.pop(username, None)
+            self.log_directory_change(username, False)
+            self.presence.publish(username, "deleted")
+            return True
+
+    def list_users_page(self, wildcard="*", after=None, limit=0):
+        # Same contract as ChatStore.list_users_page: the primary key is walked from the wildcard's literal
+        # prefix a chunk at a time, so the connection is never held for a whole scan
+        prefix = literal_prefix(wildcard)
+        names = []
+        with self.db_lock:
+            if after is not None and after >= prefix:
+                query, cursor = "SELECT name FROM users WHERE name > ? ORDER BY name LIMIT ?", after
+            else:
+                query, cursor = "SELECT name FROM users WHERE name >= ? ORDER BY name LIMIT ?", prefix
+            chunk = [row[0] for row in self.db.execute(query, (cursor, INDEX_CHUNK))]
+        while chunk:
+            for name in chunk:
+                if not name.startswith(prefix):
+                    return names, None
+                if fnmatch.fnmatchcase(name, wildcard):
+                    if 0 < limit <= len(names):
+                        return names, names[-1]
+                    names.append(name)
+            with self.db_lock:
+                chunk = [row[0] for row in self.db.execute("SELECT name FROM users WHERE name > ? ORDER BY name LIMIT ?",
+                                                           (chunk[-1], INDEX_CHUNK))]
+        return names, None
+
+    def log_directory_change(self, username, added):
+        # The version is stored with the change, so clients keep syncing by delta across restarts
+        with self.names_lock:
+            ChatStore.log_directory_change(self, username, added)
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('directory_version', ?)",
+                            (self.directory_version,))
+
+    # Sessions
+
+    def login(self, username, conn, exclusive=False):
+        with self.db_lock:
+            if not self.user_exists(username) or (exclusive and username in self.active_users):
+                return None
+            self.active_users[username] = conn
+            self.presence.publish(username, "online")
+            return self.unread_count(username)
+
+    # Messages
+
+    def conversation_id(self, conv_key, create=False):
+        row = self.db.execute("SELECT id FROM conversations WHERE user_a = ? AND user_b = ?", conv_key).fetchone()
+        if row is not None:
+            return row[0]
+        if create:
+            return self.db.execute("INSERT INTO conversations (user_a, user_b) VALUES (?, ?)", conv_key).lastrowid
+        return None
+
+    def record_message(self, sender, recipient, text):
+        timestamp = now_micros()
+        with self.db_lock:
+            conv_id = self.conversation_id(conversation_key(sender, recipient), create=True)
+            msg_id = self.db.execute("INSERT INTO messages (conversation, sender, message, timestamp) VALUES (?, ?, ?, ?)",
+                                     (conv_id, sender, text, timestamp)).lastrowid
+        return Message(msg_id, sender, text, timestamp)
+
+    def append_unread(self, username, entry):
+        with self.db_lock:
+            if not self.user_exists(username):
+                return False
+            # The message may have been deleted from its conversation (and dropped) since it was recorded
+            self.db.execute("INSERT OR IGNORE INTO messages (id, conversation, sender, message, timestamp) VALUES (?, NULL, ?, ?, ?)",
+                            (entry.id, entry.sender, entry.message, entry.timestamp))
+            self.db.execute("INSERT INTO unread (username, sender, message) VALUES (?, ?, ?)",
+                            (username, entry.sender, entry.id))
+            return True
+
+    def unread_count(self, username):
+        with self.db_lock:
+            return self.db.execute("SELECT COUNT(*) FROM unread WHERE username = ?", (username,)).fetchone()[0]
+
+    def purge(self, ids):
+        # Drop rows of messages that are neither in a conversation nor unread anywhere any more
+        self.db.executemany("DELETE FROM messages WHERE id = ? AND conversation IS NULL "
+                            "AND NOT EXISTS (SELECT 1 FROM unread WHERE message = ?)", [(i, i) for i in ids])
+
+    def unread_rows(self, username, limit=0):
+        # (seq, entry) for the oldest limit unread messages, or all of them when limit <= 0
+        return [(row[0], row_entry(row[1:])) for row in self.db.execute(
+            f"SELECT u.seq, {ENTRY_COLUMNS} FROM unread u JOIN messages m ON m.id = u.message "
+            "WHERE u.username = ? ORDER BY u.seq LIMIT ?", (username, limit if limit > 0 else -1))]
+
+    def remove_unread(self, rows):
+        self.db.executemany("DELETE FROM unread WHERE seq = ?", [(seq,) for seq, _ in rows])
+        self.purge([entry.id for _, entry in rows])
+
+    def pop_unread(self, username, limit=0, fits=None):
+        with self.db_lock:
+            if not self.user_exists(username):
+                return None
+            rows = self.unread_rows(username, limit)
+            if fits is not None:
+                rows = list(itertools.takewhile(lambda row: fits(row[1]), rows))
+            self.remove_unread(rows)
+            return [entry for _, entry in rows]
+
+    def clear_unread_from(self, username, sender):
+        with self.db_lock:
+            ids = [row[0] for row in self.db.execute("SELECT message FROM unread WHERE username = ? AND sender = ?",
+                                                     (username, sender))]
+            if ids:
+                self.db.execute("DELETE FROM unread WHERE username = ? AND sender = ?", (username, sender))
+                self.purge(ids)
+
+    def delete_unread_positions(self, username, positions):
+        with self.db_lock:
+            if not self.user_exists(username):
+                return False
+            positions = set(positions)
+            if positions:
+                rows = self.unread_rows(username, max(positions) + 1)
+                self.remove_unread([row for i, row in enumerate(rows) if i in positions])
+            return True
+
+    def conversation_partners(self, username):
+        with self.db_lock:
+            if not self.user_exists(username):
+                return []
+            rows = self.db.execute("SELECT user_b FROM conversations WHERE user_a = ? "
+                                   "UNION SELECT user_a FROM conversations WHERE user_b = ?", (username, username))
+            return sorted(row[0] for row in rows)
+
+    def get_conversation(self, user_a, user_b):
+        return self.get_conversation_page(user_a, user_b)[0]
+
+    def get_conversation_page(self, user_a, user_b, before=None, after=None, limit=0):
+        # Same cursor rules as Conversation.page, answered from the (conversation, id) index. One row past the
+        # limit is fetched to learn whether more remain.
+        with self.db_lock:
+            conv_id = self.conversation_id(conversation_key(user_a, user_b))
+            if conv_id is None:
+                return [], False
+            fetch = limit + 1 if limit > 0 else -1
+            if after is not None and before is None:
+                rows = self.db.execute(f"SELECT {ENTRY_COLUMNS} FROM messages m WHERE m.conversation = ? AND m.id > ? "
+                                       "ORDER BY m.id LIMIT ?", (conv_id, after, fetch)).fetchall()
+            else:
+                rows = self.db.execute(f"SELECT {ENTRY_COLUMNS} FROM messages m WHERE m.conversation = ? AND m.id > ? "
+                                       "AND m.id < ? ORDER BY m.id DESC LIMIT ?",
+                                       (conv_id, after if after is not None else 0,
+                                        before if before is not None else 2 ** 63 - 1, fetch)).fetchall()
+                rows.reverse()
+        more = 0 < limit < len(rows)
+        if more:
+            rows = rows[:limit] if after is not None and before is None else rows[1:]
+        return [row_entry(row) for row in rows], more
+
+    def delete_conversation_messages(self, user_a, user_b, ids):
+        with self.db_lock:
+            conv_id = self.conversation_id(conversation_key(user_a, user_b))
+            if conv_id is None:
+                return False
+            self.drop_ids(conv_id, set(ids))
+            return True
+
+    def drop_ids(self, conv_id, ids):
+        # Take ids out of one conversation; those still unread somewhere keep their row until read
+        ids = list(ids)
+        self.db.executemany("UPDATE messages SET conversation = NULL WHERE id = ? AND conversation = ?",
+                            [(msg_id, conv_id) for msg_id in ids])
+        self.purge(ids)
+
+    def delete_user_messages(self, username, ids):
+        # Same contract as ChatStore.delete_user_messages; each id is one primary-key lookup
+        ids = set(ids)
+        with self.db_lock:
+            if not self.user_exists(username):
+                return False
+            owned = {}
+            for msg_id in ids:
+                row = self.db.execute("SELECT c.id FROM messages m JOIN conversations c ON c.id = m.conversation "
+                                      "WHERE m.id = ? AND (c.user_a = ? OR c.user_b = ?)",
+                                      (msg_id, username, username)).fetchone()
+                if row is not None:
+                    owned.setdefault(row[0], []).append(msg_id)
+            present = [row[0] for msg_id in ids for row in self.db.execute(
+                "SELECT seq FROM unread WHERE username = ? AND message = ?", (username, msg_id))]
+            if not owned and not present:
+                return False
+            self.db.executemany("DELETE FROM unread WHERE seq = ?", [(seq,) for seq in present])
+            for conv_id, conv_ids in owned.items():
+                self.drop_ids(conv_id, conv_ids)
+            self.purge(ids)
+            return True
@@ -0,0 +1,1238 @@
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+import threading
+import itertools
+import fnmatch
+import datetime
+import bisect
+import time
+from array import array
+from collections import OrderedDict, deque
+
+# Number of locks each family (users, conversations) is striped across
+LOCK_STRIPES = 64
+# Usernames copied out of the sorted index per lock hold while a listing scans it
+INDEX_CHUNK = 1024
+# Directory changes remembered for delta syncs; a client further behind than this re-lists everyone
+DIRECTORY_LOG_SIZE = 4096
+# Records logged to the current segment after which a background snapshot is taken
+SNAPSHOT_EVERY = 100000
+# Seconds presence events are gathered before subscribers are sent one coalesced batch
+PRESENCE_WINDOW = 0.2
+# With tiered history: bytes of messages kept in memory across all conversations, and the newest messages each
+# conversation keeps (it spills down to this many once it holds twice as many)
+HOT_BYTES = 64 * 1024 * 1024
+HOT_RECENT = 256
+# A cold history segment is closed and the next one started once it reaches this size
+COLD_SEGMENT_BYTES = 64 * 1024 * 1024
+# A cold location is the segment number shifted above the offset within it
+OFFSET_BITS = 40
+# Written into each spill subdirectory when it is created; only a directory holding it is ever cleared
+SPILL_MARKER = ".chat-spill"
+# Rough memory cost of one message besides its text: the Message, its int id and timestamp, and the text's
+# string header (the interned sender is shared)
+ENTRY_OVERHEAD = 180
+# With a spill directory, seconds a user must be away before their mailbox is parked on disk, and the least
+# time between two sweeps for such mailboxes
+PARK_AFTER = 600
+PARK_SWEEP = 30
+# A conversation key holds the smaller user id shifted above the larger one
+USER_ID_BITS = 32
+USER_ID_MASK = (1 << USER_ID_BITS) - 1
+# The message index's entry for an id not in any conversation, and the slots it grows by at a time
+NO_CONVERSATION = (1 << 64) - 1
+INDEX_GROWTH = 4096
+
+# Stores without a user registry (see sqlite_store) key history by the sorted pair of participants
+def conversation_key(user_a, user_b):
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+# The in-memory store packs the pair's two user ids into a single int, which hashes and compares as one word
+def pack_pair(id_a, id_b):
+    return (id_a << USER_ID_BITS) | id_b if id_a <= id_b else (id_b << USER_ID_BITS) | id_a
+
+# Timestamps are stored as integer microseconds since the Unix epoch and only turned into text for a reply
+def now_micros():
+    return time.time_ns() // 1000
+
+def format_timestamp(micros):
+    # Naive local time in ISO format, the text clients have always been sent
+    seconds, fraction = divmod(micros, 1000000)
+    return datetime.datetime.fromtimestamp(seconds).replace(microsecond=fraction).isoformat()
+
+def stored_timestamp(value):
+    # Logs, snapshots and databases written before timestamps were integers hold ISO text (and a TEXT column
+    # in an older database turns integers into digit strings)
+    if not isinstance(value, str):
+        return value
+    if value.isdigit():
+        return int(value)
+    moment = datetime.datetime.fromisoformat(value)
+    return int(moment.replace(microsecond=0).timestamp()) * 1000000 + moment.microsecond
+
+class Message:
+    # One stored message. The same object sits in its conversation's history and in every mailbox holding it
+    # unread. Slots take the place of a dict per message, and the sender is interned, so all of one user's
+    # messages point at a single copy of their name.
+    __slots__ = ("id", "sender", "message", "timestamp")
+
+    def __init__(self, msg_id, sender, message, timestamp):
+        self.id = msg_id
+        self.sender = sys.intern(sender)
+        self.message = message
+        self.timestamp = timestamp
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return (self.id, self.sender, self.message, self.timestamp) == (other.id, other.sender, other.message, other.timestamp)
+
+    def __repr__(self):
+        return f"Message({self.id!r}, {self.sender!r}, {self.message!r}, {self.timestamp!r})"
+
+def entry_size(entry):
+    return ENTRY_OVERHEAD + len(entry.message)
+
+def literal_prefix(wildcard):
+    # The part of a wildcard before its first metacharacter; every name it matches starts with this
+    for i, ch in enumerate(wildcard):
+        if ch in "*?[":
+            return wildcard[:i]
+    return wildcard
+
+class Mailbox:
+    # A user's unread messages in arrival order. The entries sit in a deque, oldest first, and the ids still
+    # unread in a set, so paging off the oldest k costs O(k), the unread count is len() of the set, and deleting
+    # by id only takes the id out of the set; the entry is skipped when it reaches the front. Each sender's ids
+    # are kept in an array alongside, so clearing one sender touches only that sender's messages. Skipped
+    # entries and ids already read are dropped once they outnumber the unread messages.
+    # While its owner is away the messages can be parked on disk as frames of ColdSegments, older than anything
+    # still in entries. New messages are still appended in memory, and len() stays exact; anything else that
+    # looks at the messages loads the parked ones back first.
+    def __init__(self):
+        self.entries = deque()
+        self.unread = set()
+        self.by_sender = {}
+        # Ids held across the by_sender arrays, including ones already read
+        self.sender_ids = 0
+        # (location, count) of each parked frame, oldest first, and where they are
+        self.parked = []
+        self.parked_count = 0
+        self.cold = None
+
+    def __len__(self):
+        return len(self.unread) + self.parked_count
+
+    def __iter__(self):
+        self.load()
+        return self.live()
+
+    def __contains__(self, msg_id):
+        self.load()
+        return msg_id in self.unread
+
+    def live(self):
+        return (entry for entry in self.entries if entry.id in self.unread)
+
+    def append(self, entry):
+        if entry.id in self.unread:
+            return
+        self.entries.append(entry)
+        self.unread.add(entry.id)
+        ids = self.by_sender.get(entry.sender)
+        if ids is None:
+            ids = self.by_sender[entry.sender] = array("Q")
+        ids.append(entry.id)
+        self.sender_ids += 1
+
+    def clear(self):
+        self.entries = deque()
+        self.unread = set()
+        self.by_sender = {}
+        self.sender_ids = 0
+
+    def tidy(self):
+        # Rebuild the deque and the sender arrays once what they hold that is no longer unread outweighs the rest
+        if len(self.entries) > 2 * len(self.unread):
+            self.entries = deque(self.live())
+        if self.sender_ids > 2 * len(self.unread):
+            self.by_sender = {}
+            for entry in self.live():
+                ids = self.by_sender.get(entry.sender)
+                if ids is None:
+                    ids = self.by_sender[entry.sender] = array("Q")
+                ids.append(entry.id)
+            self.sender_ids = len(self.unread)
+
+    def park(self, cold):
+        # Move the in-memory messages to disk as one frame
+        if not self.unread:
+            self.clear()
+            return
+        frame = json.dumps([[e.id, e.sender, e.message, e.timestamp] for e in self.live()],
+                           separators=(",", ":")).encode("utf-8")
+        self.parked.append((cold.append([frame])[0], len(self.unread)))
+        self.parked_count += len(self.unread)
+        self.cold = cold
+        self.clear()
+
+    def load(self):
+        # Bring parked messages back in front of the ones that arrived since
+        if not self.parked:
+            return
+        recent = list(self.live())
+        self.clear()
+        for entry in itertools.chain(self.read_parked(self.parked), recent):
+            self.append(entry)
+        self.discard_parked()
+
+    def read_parked(self, parked):
+        for location, _ in parked:
+            for msg_id, sender, message, timestamp in json.loads(self.cold.read_frame(location)):
+                yield Message(msg_id, sender, message, timestamp)
+
+    def discard_parked(self):
+        for location, _ in self.parked:
+            self.cold.release(location)
+        self.parked = []
+        self.parked_count = 0
+
+    def frozen(self, message_index):
+        # (entry, inline) for every message, for a snapshot: inline unless the entry is still in a conversation.
+        # Parked messages are read only when it is iterated, and always written inline, since by then they may
+        # have left their conversations. The caller must hold the ColdSegments until then.
+        current = [(entry, entry.id not in message_index) for entry in self.live()]
+        if not self.parked:
+            return current
+        return itertools.chain(((entry, True) for entry in self.read_parked(list(self.parked))), current)
+
+    def pop(self, limit=0, fits=None):
+        # Remove and return the oldest limit messages, or all of them when limit <= 0. With fits, stop before
+        # the first message it rejects.
+        self.load()
+        if fits is None and (limit <= 0 or limit >= len(self.unread)):
+            msgs = list(self.live())
+            self.clear()
+            return msgs
+        msgs = []
+        while self.entries and (limit <= 0 or len(msgs) < limit):
+            entry = self.entries[0]
+            if entry.id in self.unread:
+                if fits is not None and not fits(entry):
+                    break
+                self.unread.remove(entry.id)
+                msgs.append(entry)
+            self.entries.popleft()
+        self.tidy()
+        return msgs
+
+    def remove(self, ids):
+        # Drop the given ids; returns how many were present
+        self.load()
+        removed = 0
+        for msg_id in ids:
+            if msg_id in self.unread:
+                self.unread.remove(msg_id)
+                removed += 1
+        self.tidy()
+        return removed
+
+    def clear_sender(self, sender):
+        self.load()
+        ids = self.by_sender.pop(sender, ())
+        self.sender_ids -= len(ids)
+        for msg_id in ids:
+            self.unread.discard(msg_id)
+        self.tidy()
+
+    def remove_positions(self, positions):
+        # Positions count from the oldest unread message; only the entries up to the largest one are visited
+        positions = set(positions)
+        if not positions:
+            return
+        self.load()
+        last = max(positions)
+        ids = []
+        for i, entry in enumerate(self.live()):
+            if i > last:
+                break
+            if i in positions:
+                ids.append(entry.id)
+        self.remove(ids)
+
+class ColdSegments:
+    # Append-only segment files (DIR/PREFIX/PREFIX.1, PREFIX.2, ...) holding data spilled out of memory, one
+    # length-prefixed frame per item. A frame's location is its segment number and offset packed into one int,
+    # and reads go through a read-only memory map of the segment. The files are scratch space, cleared whenever
+    # a store starts. A segment is deleted once every frame in it has been released, unless a snapshot is still
+    # reading (see hold).
+    def __init__(self, directory, prefix, segment_bytes=COLD_SEGMENT_BYTES):
+        # The segments get a subdirectory of their own, marked when it is created. Startup only clears a marked
+        # subdirectory, and only of segment files, so a shared spill directory never loses anything else.
+        self.directory = os.path.join(directory, prefix)
+        marker = os.path.join(self.directory, SPILL_MARKER)
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(marker):
+            if os.listdir(self.directory):
+                raise ValueError(f"{self.directory} already holds files that were not spilled by a chat store")
+            open(marker, "w").close()
+        pattern = re.compile(re.escape(prefix) + r"\.\d+$")
+        for name in os.listdir(self.directory):
+            if pattern.match(name):
+                os.remove(os.path.join(self.directory, name))
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segment = 0
+        self.size = 0
+        self.file = None
+        # Memory map of each segment read so far; remapped when a read lands past its end
+        self.maps = {}
+        # Unreleased frames per segment, and segments left empty while held
+        self.live = {}
+        self.holds = 0
+        self.doomed = []
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{self.prefix}.{segment}")
+
+    def append(self, frames):
+        # Write the frames and return their locations in the same order
+        with self.lock:
+            if self.file is None or self.size >= self.segment_bytes:
+                if self.file is not None:
+                    self.file.close()
+                    if not self.live.get(self.segment):
+                        self.retire(self.segment)
+                self.segment += 1
+                self.file = open(self.segment_path(self.segment), "ab")
+                self.size = 0
+            locations = []
+            for frame in frames:
+                locations.append(self.segment << OFFSET_BITS | self.size)
+                self.size += 4 + len(frame)
+            self.file.write(b"".join(struct.pack("!I", len(frame)) + frame for frame in frames))
+            self.file.flush()
+            self.live[self.segment] = self.live.get(self.segment, 0) + len(frames)
+        return locations
+
+    def read_frame(self, location):
+        segment, offset = location >> OFFSET_BITS, location & ((1 << OFFSET_BITS) - 1)
+        with self.lock:
+            data = self.maps.get(segment)
+            if data is None or offset >= len(data):
+                if data is not None:
+                    data.close()
+                with open(self.segment_path(segment), "rb") as f:
+                    data = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            length = struct.unpack_from("!I", data, offset)[0]
+            return data[offset + 4:offset + 4 + length]
+
+    def write(self, entries):
+        # Spill history entries. The id is not stored, since the conversation keeps it next to the location.
+        return self.append([json.dumps([e.sender, e.message, e.timestamp], separators=(",", ":")).encode("utf-8")
+                            for e in entries])
+
+    def read(self, msg_id, location):
+        sender, message, timestamp = json.loads(self.read_frame(location))
+        return Message(msg_id, sender, message, timestamp)
+
+    def release(self, location):
+        # The frame will not be read again; a segment with nothing left in it is deleted. When that is the one
+        # being written, the next append starts a new segment.
+        segment = location >> OFFSET_BITS
+        with self.lock:
+            self.live[segment] -= 1
+            if self.live[segment] == 0:
+                if segment == self.segment and self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.retire(segment)
+
+    def retire(self, segment):
+        # Caller holds the lock
+        self.live.pop(segment, None)
+        if self.holds:
+            self.doomed.append(segment)
+        else:
+            self.remove_segment(segment)
+
+    def remove_segment(self, segment):
+        data = self.maps.pop(segment, None)
+        if data is not None:
+            data.close()
+        os.remove(self.segment_path(segment))
+
+    def hold(self):
+        # Keep every segment on disk until the matching unhold(), for a reader working from copied locations
+        with self.lock:
+            self.holds += 1
+
+    def unhold(self):
+        with self.lock:
+            self.holds -= 1
+            if not self.holds:
+                for segment in self.doomed:
+                    self.remove_segment(segment)
+                self.doomed = []
+
+class Conversation:
+    # One pair's history. The ids in memory sit in an array in send order (ids only grow, so it is sorted) with
+    # the entries in a parallel list, so an id or a page cursor is found by bisection and a message costs two
+    # 8-byte slots rather than a dict entry. A deleted entry is left as None until such holes make up half of
+    # the list, when both are rebuilt from the live entries.
+    # With ColdSegments attached, older entries can be spilled to it. They are then remembered only as two
+    # parallel arrays of ids and locations, all older than any entry still in memory; deleted cold ids are
+    # kept in cold_dead until they make up half of the arrays.
+    def __init__(self, cold=None):
+        self.ids = array("Q")
+        self.entries = []
+        # Entries in memory that have not been deleted
+        self.live = 0
+        self.cold = cold
+        self.cold_ids = array("Q")
+        self.cold_locations = array("Q")
+        self.cold_dead = set()
+        # Approximate bytes held by entries, tracked only when there is somewhere to spill them
+        self.hot_bytes = 0
+
+    def __len__(self):
+        return self.live + len(self.cold_ids) - len(self.cold_dead)
+
+    def append(self, entry):
+        self.ids.append(entry.id)
+        self.entries.append(entry)
+        self.live += 1
+        if self.cold is not None:
+            self.hot_bytes += entry_size(entry)
+
+    def hot_position(self, msg_id):
+        # Index of an id in memory, deleted or not, or None
+        i = bisect.bisect_left(self.ids, msg_id)
+        if i < len(self.ids) and self.ids[i] == msg_id:
+            return i
+        return None
+
+    def cold_position(self, msg_id):
+        # Index of a live cold id, or None
+        i = bisect.bisect_left(self.cold_ids, msg_id)
+        if i < len(self.cold_ids) and self.cold_ids[i] == msg_id and msg_id not in self.cold_dead:
+            return i
+        return None
+
+    def get(self, msg_id):
+        i = self.hot_position(msg_id)
+        if i is not None:
+            return self.entries[i]
+        i = self.cold_position(msg_id)
+        return self.cold.read(msg_id, self.cold_locations[i]) if i is not None else None
+
+    def remove(self, msg_id):
+        # Returns False when the id is not in this conversation
+        i = self.hot_position(msg_id)
+        if i is None:
+            return self.remove_cold(msg_id)
+        entry = self.entries[i]
+        if entry is None:
+            return False
+        self.entries[i] = None
+        self.live -= 1
+        if self.cold is not None:
+            self.hot_bytes -= entry_size(entry)
+        if self.live * 2 < len(self.entries):
+            self.keep_hot([entry for entry in self.entries if entry is not None])
+        return True
+
+    def keep_hot(self, entries):
+        self.entries = entries
+        self.ids = array("Q", (entry.id for entry in entries))
+
+    def remove_cold(self, msg_id):
+        i = self.cold_position(msg_id)
+        if i is None:
+            return False
+        # The frame is never read again, so a segment whose messages have all been deleted goes away
+        self.cold.release(self.cold_locations[i])
+        self.cold_dead.add(msg_id)
+        if len(self.cold_dead) * 2 >= len(self.cold_ids):
+            live = [i for i, cold_id in enumerate(self.cold_ids) if cold_id not in self.cold_dead]
+            self.cold_ids = array("Q", (self.cold_ids[i] for i in live))
+            self.cold_locations = array("Q", (self.cold_locations[i] for i in live))
+            self.cold_dead = set()
+        return True
+
+    def spill(self, keep=0):
+        # Move all but the newest keep entries to the cold history in one write; returns the bytes freed
+        if self.live <= keep:
+            return 0
+        hot = [entry for entry in self.entries if entry is not None]
+        old = hot[:len(hot) - keep]
+        freed = 0
+        for entry, location in zip(old, self.cold.write(old)):
+            self.cold_ids.append(entry.id)
+            self.cold_locations.append(location)
+            freed += entry_size(entry)
+        self.keep_hot(hot[len(old):])
+        self.live = len(self.entries)
+        self.hot_bytes -= freed
+        return freed
+
+    def frozen(self):
+        # Every entry, oldest first, as an iterable that stays valid after the caller's lock is released. Only
+        # the cold arrays are copied now; the cold entries themselves are read when it is iterated, which is
+        # safe because cold segments are never rewritten and the caller holds the ColdSegments until then.
+        hot = [entry for entry in self.entries if entry is not None]
+        if not self.cold_ids:
+            return hot
+        return itertools.chain(self.read_cold(self.cold_ids[:], self.cold_locations[:], set(self.cold_dead)), hot)
+
+    def read_cold(self, ids, locations, dead):
+        for msg_id, location in zip(ids, locations):
+            if msg_id not in dead:
+                yield self.cold.read(msg_id, location)
+
+    # Paging treats the cold ids followed by the ids in memory as one sorted sequence of positions
+
+    def position(self, msg_id, find):
+        return find(self.cold_ids, msg_id) + find(self.ids, msg_id)
+
+    def live_at(self, i):
+        n = len(self.cold_ids)
+        if i < n:
+            return self.cold_ids[i] not in self.cold_dead
+        return self.entries[i - n] is not None
+
+    def entry_at(self, i):
+        # The entry at position i, or None for a deleted id
+        n = len(self.cold_ids)
+        if i >= n:
+            return self.entries[i - n]
+        msg_id = self.cold_ids[i]
+        return None if msg_id in self.cold_dead else self.cold.read(msg_id, self.cold_locations[i])
+
+    def page(self, before=None, after=None, limit=0):
+        # Up to limit messages (all when limit <= 0) with after < id < before, oldest first, and whether more
+        # remain beyond the page. Without an after cursor the page is the newest part of the range, so paging
+        # back through history walks before=<oldest id shown>; with only after it is the oldest part, for
+        # catching up from the last id seen.
+        lo = self.position(after, bisect.bisect_right) if after is not None else 0
+        hi = self.position(before, bisect.bisect_left) if before is not None else len(self.cold_ids) + len(self.ids)
+        picked = []
+        if after is not None and before is None:
+            i = lo
+            while i < hi and (limit <= 0 or len(picked) < limit):
+                entry = self.entry_at(i)
+                if entry is not None:
+                    picked.append(entry)
+                i += 1
+            while i < hi and not self.live_at(i):
+                i += 1
+            return picked, i < hi
+        i = hi - 1
+        while i >= lo and (limit <= 0 or len(picked) < limit):
+            entry = self.entry_at(i)
+            if entry is not None:
+                picked.append(entry)
+            i -= 1
+        while i >= lo and not self.live_at(i):
+            i -= 1
+        picked.reverse()
+        return picked, i >= lo
+
+class MessageIndex:
+    # Maps message ids to the key of the conversation holding them. Ids are allocated densely from 1, so the
+    # keys sit in an array slot per id: 8 bytes a message, with no hash table entry or int object for the key.
+    # An id that was deleted (or never stored) holds NO_CONVERSATION. Slots are set under the conversation's
+    # lock; only growing the array takes the index's own lock.
+    def __init__(self):
+        self.keys = array("Q")
+        self.lock = threading.Lock()
+
+    def get(self, msg_id, default=None):
+        if 0 <= msg_id < len(self.keys):
+            conv_key = self.keys[msg_id]
+            if conv_key != NO_CONVERSATION:
+                return conv_key
+        return default
+
+    def __getitem__(self, msg_id):
+        conv_key = self.get(msg_id)
+        if conv_key is None:
+            raise KeyError(msg_id)
+        return conv_key
+
+    def __contains__(self, msg_id):
+        return self.get(msg_id) is not None
+
+    def __setitem__(self, msg_id, conv_key):
+        if msg_id >= len(self.keys):
+            with self.lock:
+                if msg_id >= len(self.keys):
+                    self.keys.extend(array("Q", [NO_CONVERSATION]) * (msg_id + INDEX_GROWTH - len(self.keys)))
+        self.keys[msg_id] = conv_key
+
+    def __delitem__(self, msg_id):
+        if msg_id not in self:
+            raise KeyError(msg_id)
+        self.keys[msg_id] = NO_CONVERSATION
+
+    def items(self):
+        return ((msg_id, conv_key) for msg_id, conv_key in enumerate(self.keys) if conv_key != NO_CONVERSATION)
+
+def start_timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+class PresenceFeed:
+    # Account and session events ("created", "online", "offline", "deleted") for subscribed connections.
+    # Events are gathered for a short window and then delivered as one batch that holds only each user's
+    # latest event, so a burst of logins costs every subscriber a single push.
+    def __init__(self, window=PRESENCE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        # Maps each subscribed connection to the callback that delivers a batch of (username, event) pairs to it
+        self.subscribers = {}
+        self.pending = OrderedDict()
+        # When the pending batch is due, or None while nothing is waiting
+        self.deadline = None
+        # Called as schedule(delay, callback) when a batch starts. A server loop that must deliver on its own
+        # thread can replace it with something that just wakes the loop, and call flush_due() from there.
+        self.schedule = start_timer
+
+    def subscribe(self, conn, deliver):
+        with self.lock:
+            self.subscribers[conn] = deliver
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            self.subscribers.pop(conn, None)
+
+    def publish(self, username, event):
+        with self.lock:
+            if not self.subscribers:
+                return
+            self.pending.pop(username, None)
+            self.pending[username] = event
+            if self.deadline is not None:
+                return
+            self.deadline = time.monotonic() + self.window
+            schedule = self.schedule
+        schedule(self.window, self.flush)
+
+    def time_until_due(self):
+        # Seconds until the pending batch should go out, or None when nothing is waiting
+        deadline = self.deadline
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    def flush_due(self):
+        if self.deadline is not None and self.deadline <= time.monotonic():
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            events = list(self.pending.items())
+            self.pending.clear()
+            self.deadline = None
+            deliveries = list(self.subscribers.values())
+        if events:
+            for deliver in deliveries:
+                deliver(events)
+
+class ChatStore:
+    # Shared server state: accounts with their unread mailboxes, live sessions and conversation history.
+    # Every compound update takes the lock stripe of the user or conversation it touches, so sends between
+    # unrelated users never wait on each other and there is no single lock serialising the server.
+    def __init__(self, stripes=LOCK_STRIPES, history_dir=None, hot_bytes=HOT_BYTES):
+        # Maps usernames to their data (password hash and unread Mailbox)
+        self.users = {}
+        # Maps usernames to their active connection objects
+        self.active_users = {}
+        # Dense integer id of every username seen so far, and the names by id. Ids are assigned when an account
+        # is created (or a name is first messaged) and never reused, so a deleted user's history keeps its key.
+        self.user_ids = {}
+        self.user_names = []
+        self.registry_lock = threading.Lock()
+        # Maps the packed ids of two users (see conv_key) to that pair's Conversation
+        self.conversations = {}
+        # Maps every live message id to the conversation holding it, so deletes never scan history
+        self.message_index = MessageIndex()
+        # Maps each username to the keys of the conversations they take part in. Entries outlive account
+        # deletion like the history does, so an account re-created under the same name finds its conversations.
+        self.user_conversations = {}
+        self.index_lock = threading.Lock()
+        # Every username in sorted order, so a wildcard with a literal prefix is a range scan
+        self.usernames = []
+        # Bumped on every account creation or deletion; the log holds the recent (version, username, added) changes
+        self.directory_version = 0
+        self.directory_log = deque(maxlen=DIRECTORY_LOG_SIZE)
+        self.names_lock = threading.Lock()
+        self.presence = PresenceFeed()
+        self.user_locks = [threading.Lock() for _ in range(stripes)]
+        self.conv_locks = [threading.Lock() for _ in range(stripes)]
+        self.id_counter = itertools.count(1)
+        self.id_lock = threading.Lock()
+        # Write-ahead log every mutation is recorded in, once recover() has attached one
+        self.wal = None
+        self.snapshot_every = SNAPSHOT_EVERY
+        # Held while a snapshot is being taken, so only one runs at a time
+        self.snapshot_lock = threading.Lock()
+        # With a history directory, only each conversation's newest messages are kept in memory, and no more
+        # than hot_bytes of them in all: least recently used conversations are spilled to disk past that
+        self.cold = ColdSegments(history_dir, "history") if history_dir else None
+        self.hot_budget = hot_bytes
+        self.hot_recent = HOT_RECENT
+        self.hot_bytes = 0
+        # Conversations with messages in memory, least recently used first
+        self.hot_conversations = OrderedDict()
+        self.hot_lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        # The same directory parks the mailboxes of users who have been away for park_after seconds
+        self.parking = ColdSegments(history_dir, "mailbox") if history_dir else None
+        self.park_after = PARK_AFTER
+        # Users not logged in, by when they left (or were created), oldest first; only kept while parking
+        self.idle_since = OrderedDict()
+        self.idle_lock = threading.Lock()
+        # Held by the thread sweeping idle_since
+        self.park_lock = threading.Lock()
+        self.next_sweep = 0
+
+    def user_lock(self, username):
+        return self.user_locks[hash(username) % len(self.user_locks)]
+
+    def conv_lock(self, conv_key):
+        # Mix both ids in; the low bits of the key alone belong to only one of the two users
+        return self.conv_locks[(conv_key ^ (conv_key >> USER_ID_BITS)) % len(self.conv_locks)]
+
+    # User registry
+
+    def user_id(self, username):
+        # The username's id, assigned the first time the name is seen
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            with self.registry_lock:
+                user_id = self.user_ids.get(username)
+                if user_id is None:
+                    username = sys.intern(username)
+                    user_id = len(self.user_names)
+                    self.user_names.append(username)
+                    self.user_ids[username] = user_id
+        return user_id
+
+    def conv_key(self, user_a, user_b, assign=True):
+        # Lookups pass assign=False and get None for a name never seen, so reads never grow the registry
+        id_a = self.user_ids.get(user_a)
+        id_b = self.user_ids.get(user_b)
+        if id_a is None or id_b is None:
+            if not assign:
+                return None
+            id_a, id_b = self.user_id(user_a), self.user_id(user_b)
+        return pack_pair(id_a, id_b)
+
+    def conv_users(self, conv_key):
+        # The two usernames behind a key, lower id first
+        return self.user_names[conv_key >> USER_ID_BITS], self.user_names[conv_key & USER_ID_MASK]
+
+    # Durability
+
+    def recover(self, wal):
+        # Rebuild the state from the latest snapshot and the log segments written after it, then log every
+        # later mutation. Startup cost is the snapshot load plus at most about snapshot_every records.
+        from_gen = 1
+        last_id = 0
+        for item in wal.read_snapshot():
+            if item[0] == "header":
+                _, from_gen, next_id, self.directory_version = item
+                last_id = next_id - 1
+            elif item[0] == "conversation":
+                _, (user_a, user_b), entries = item
+                conv_key = self.conv_key(user_a, user_b)
+                for msg_id, sender, text, timestamp in entries:
+                    self.add_entry(conv_key, Message(msg_id, sender, text, stored_timestamp(timestamp)))
+                self.evict()
+            else:
+                _, name, password_hash, unread = item
+                mailbox = Mailbox()
+                for fields in unread:
+                    # Unread messages still in a conversation are stored by id and share its entry
+                    if isinstance(fields, int):
+                        mailbox.append(self.conversations[self.message_index[fields]].get(fields))
+                    else:
+                        msg_id, sender, text, timestamp = fields
+                        mailbox.append(Message(msg_id, sender, text, stored_timestamp(timestamp)))
+                self.users[name] = {"password_hash": password_hash, "messages": mailbox}
+                self.user_id(name)
+                self.usernames.append(name)
+                self.mark_idle(name)
+        self.usernames.sort()
+        for record in wal.replay(from_gen):
+            kind = record[0]
+            if kind == "create":
+                self.create_user(record[1], record[2])
+            elif kind == "delete_user":
+                self.delete_user(record[1])
+            elif kind == "message":
+                _, msg_id, sender, recipient, text, timestamp = record
+                entry = Message(msg_id, sender, text, stored_timestamp(timestamp))
+                self.add_entry(self.conv_key(sender, recipient), entry)
+                self.evict()
+                last_id = max(last_id, msg_id)
+            elif kind == "unread":
+                conv_key = self.message_index.get(record[2])
+                if conv_key is not None:
+                    # Still in its conversation: share that entry, as a snapshot does
+                    self.append_unread(record[1], self.conversations[conv_key].get(record[2]))
+                elif len(record) > 3:
+                    _, name, msg_id, sender, text, timestamp = record
+                    self.append_unread(name, Message(msg_id, sender, text, stored_timestamp(timestamp)))
+            elif kind == "read":
+                self.pop_unread(record[1], record[2])
+            elif kind == "clear_unread":
+                self.clear_unread_from(record[1], record[2])
+            elif kind == "delete_positions":
+                self.delete_unread_positions(record[1], record[2])
+            elif kind == "unread_remove":
+                user = self.users.get(record[1])
+                if user is not None:
+                    user["messages"].remove(record[2])
+            elif kind == "drop":
+                self.drop_messages(self.conv_key(*record[1]), record[2])
+        self.id_counter = itertools.count(last_id + 1)
+        wal.remove_before(from_gen)
+        wal.open()
+        self.wal = wal
+
+    def snapshot(self):
+        # Write the whole state to the snapshot file and delete the log segments it covers. Updates are held
+        # off only while the log is rotated and the state is copied by reference; encoding and writing the
+        # snapshot happen after they resume.
+        locks = self.user_locks + self.conv_locks + [self.names_lock, self.id_lock]
+        for lock in locks:
+            lock.acquire()
+        try:
+            covers = self.wal.rotate()
+            next_id = next(self.id_counter)
+            self.id_counter = itertools.count(next_id)
+            directory_version = self.directory_version
+            conversations = [(self.conv_users(conv_key), conv.frozen()) for conv_key, conv in self.conversations.items()]
+            users = [(name, user["password_hash"], user["messages"].frozen(self.message_index))
+                     for name, user in self.users.items()]
+            # Spilled history and parked mailboxes are read while the snapshot is written, so their frames must
+            # stay on disk until then, even if the messages are deleted meanwhile
+            if self.cold is not None:
+                self.cold.hold()
+            if self.parking is not None:
+                self.parking.hold()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        try:
+            self.wal.write_snapshot(covers, next_id, directory_version, conversations, users)
+        finally:
+            if self.cold is not None:
+                self.cold.unhold()
+            if self.parking is not None:
+                self.parking.unhold()
+        self.wal.remove_before(covers)
+
+    def background_snapshot(self):
+        try:
+            self.snapshot()
+        except OSError as e:
+            print(f"Snapshot failed: {e}")
+        finally:
+            self.snapshot_lock.release()
+
+    def log(self, *record):
+        # Called under the lock that orders the change, so the log replays changes to one key in the same order
+        if self.wal is not None:
+            self.wal.append(record)
+            # Keep replay short: once the current segment is long enough, snapshot in the background
+            if self.wal.segment_records >= self.snapshot_every and self.snapshot_lock.acquire(blocking=False):
+                threading.Thread(target=self.background_snapshot, daemon=True).start()
+
+    def commit(self):
+        # Wait until everything logged so far is on disk; servers call this before replying
+        if self.wal is not None:
+            self.wal.commit()
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+
+    def next_message_id(self):
+        # Atomic allocator: every caller gets a distinct, increasing id
+        with self.id_lock:
+            return next(self.id_counter)
+
+    # Accounts
+
+    def create_user(self, username, password_hash):
+        with self.user_lock(username):
+            if username in self.users:
+                return False
+            self.users[username] = {"password_hash": password_hash, "messages": Mailbox()}
+            self.user_id(username)
+            self.mark_idle(username)
+            self.log("create", username, password_hash)
+            with self.names_lock:
+                bisect.insort(self.usernames, username)
+                self.log_directory_change(username, True)
+            # Published under the user's lock so one user's events reach the feed in the order they happened
+            self.presence.publish(username, "created")
+            return True
+
+    def user_exists(self, username):
+        return username in self.users
+
+    def password_hash(self, username):
+        user = self.users.get(username)
+        return user["password_hash"] if user is not None else None
+
+    def delete_user(self, username):
+        with self.user_lock(username):
+            user = self.users.pop(username, None)
+            if user is None:
+                return False
+            user["messages"].discard_parked()
+            self.log("delete_user", username)
+            self.active_users.pop(username, None)
+            with self.names_lock:
+                i = bisect.bisect_left(self.usernames, username)
+                if i < len(self.usernames) and self.usernames[i] == username:
+                    del self.usernames[i]
+                self.log_directory_change(username, False)
+            self.presence.publish(username, "deleted")
+            return True
+
+    def list_users(self, wildcard="*"):
+        return self.list_users_page(wildcard)[0]
+
+    def list_users_page(self, wildcard="*", after=None, limit=0):
+        # Up to limit usernames (all when limit <= 0) matching the wildcard, in sorted order and greater than
+        # after, plus a continuation token: the last name returned when more matches follow, otherwise None.
+        # Only the range of the index that starts with the wildcard's literal prefix is visited, and it is
+        # copied out a chunk at a time so account creation is never held up by a long scan.
+        prefix = literal_prefix(wildcard)
+        names = []
+        with self.names_lock:
+            start = bisect.bisect_left(self.usernames, prefix)
+            if after is not None:
+                start = max(start, bisect.bisect_right(self.usernames, after))
+            chunk = self.usernames[start:start + INDEX_CHUNK]
+        while chunk:
+            for name in chunk:
+                if not name.startswith(prefix):
+                    return names, None
+                if fnmatch.fnmatchcase(name, wildcard):
+                    if 0 < limit <= len(names):
+                        return names, names[-1]
+                    names.append(name)
+            cursor = chunk[-1]
+            with self.names_lock:
+                start = bisect.bisect_right(self.usernames, cursor)
+                chunk = self.usernames[start:start + INDEX_CHUNK]
+        return names, None
+
+    def log_directory_change(self, username, added):
+        # Caller holds names_lock
+        self.directory_version += 1
+        self.directory_log.append((self.directory_version, username, added))
+
+    def directory_changes(self, since, limit=0):
+        # Accounts added and removed after directory version since, as (version reached, added, removed, more).
+        # At most limit changes (all when limit <= 0) are folded in; more says whether later ones remain.
+        # Returns None when since is older than the log, and the caller must list the whole directory again.
+        with self.names_lock:
+            if since == self.directory_version:
+                return since, [], [], False
+            if since > self.directory_version or not self.directory_log or self.directory_log[0][0] > since + 1:
+                return None
+            # Versions in the log are consecutive, so the first change after since sits at a known offset
+            start = since + 1 - self.directory_log[0][0]
+            stop = start + limit if limit > 0 else None
+            changes = list(itertools.islice(self.directory_log, start, stop))
+            more = changes[-1][0] < self.directory_version
+        # Only each name's last change matters to a client applying them in order
+        latest = {}
+        for _, username, added in changes:
+            latest[username] = added
+        added = sorted(name for name, state in latest.items() if state)
+        removed = sorted(name for name, state in latest.items() if not state)
+        return changes[-1][0], added, removed, more
+
+    # Idle mailboxes
+
+    def mark_idle(self, username, restart=False):
+        # Start the user's idle clock, unless it is already running and restart is False
+        if self.parking is None:
+            return
+        with self.idle_lock:
+            if restart:
+                self.idle_since.pop(username, None)
+            elif username in self.idle_since:
+                return
+            self.idle_since[username] = time.monotonic()
+
+    def maybe_park(self):
+        # Start a background sweep at most every PARK_SWEEP seconds
+        if self.parking is None or time.monotonic() < self.next_sweep or not self.park_lock.acquire(blocking=False):
+            return
+        self.next_sweep = time.monotonic() + PARK_SWEEP
+        threading.Thread(target=self.background_park, daemon=True).start()
+
+    def background_park(self):
+        try:
+            self.park_idle()
+        except OSError as e:
+            print(f"Parking mailboxes failed: {e}")
+        finally:
+            self.park_lock.release()
+
+    def park_idle(self, now=None):
+        # Park the mailbox of every user who has been away for more than park_after seconds. Users leave
+        # idle_since oldest first, so a sweep only visits the ones it parks.
+        now = time.monotonic() if now is None else now
+        while True:
+            with self.idle_lock:
+                if not self.idle_since:
+                    return
+                username, since = next(iter(self.idle_since.items()))
+                if since > now - self.park_after:
+                    return
+                del self.idle_since[username]
+            with self.user_lock(username):
+                user = self.users.get(username)
+                if user is not None and username not in self.active_users:
+                    user["messages"].park(self.parking)
+
+    # Sessions
+
+    def login(self, username, conn, exclusive=False):
+        # Mark the user online; returns the unread count, or None if the account is gone or,
+        # when exclusive, the user is already online elsewhere
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None or (exclusive and username in self.active_users):
+                return None
+            self.active_users[username] = conn
+            if self.parking is not None:
+                with self.idle_lock:
+                    self.idle_since.pop(username, None)
+                user["messages"].load()
+            self.presence.publish(username, "online")
+            return len(user["messages"])
+
+    def logoff(self, username):
+        with self.user_lock(username):
+            if self.active_users.pop(username, None) is not None:
+                self.mark_idle(username, restart=True)
+                self.presence.publish(username, "offline")
+        self.maybe_park()
+
+    def online_users(self):
+        return sorted(self.active_users)
+
+    def get_active(self, username):
+        return self.active_users.get(username)
+
+    # Messages
+
+    def record_message(self, sender, recipient, text):
+        # Allocate an id and append the message to the pair's conversation history. The id is taken under the
+        # conversation lock so each conversation sees its ids in increasing order.
+        conv_key = self.conv_key(sender, recipient)
+        with self.conv_lock(conv_key):
+            entry = Message(self.next_message_id(), sender, text, now_micros())
+            self.add_entry(conv_key, entry)
+            self.log("message", entry.id, sender, recipient, text, entry.timestamp)
+        self.evict()
+        return entry
+
+    def add_entry(self, conv_key, entry):
+        # Caller holds the conversation's lock (or is replaying the log before the server starts)
+        conv = self.conversations.get(conv_key)
+        if conv is None:
+            conv = self.conversations[conv_key] = Conversation(self.cold)
+            with self.index_lock:
+                for user in self.conv_users(conv_key):
+                    self.user_conversations.setdefault(user, set()).add(conv_key)
+        before = conv.hot_bytes
+        conv.append(entry)
+        self.message_index[entry.id] = conv_key
+        if self.cold is not None:
+            if conv.live >= 2 * self.hot_recent:
+                conv.spill(self.hot_recent)
+            self.touch(conv_key, conv.hot_bytes - before)
+
+    # Tiered history
+
+    def touch(self, conv_key, grown=0):
+        # Mark a conversation as just used and account for the bytes it gained or freed in memory
+        with self.hot_lock:
+            self.hot_bytes += grown
+            self.hot_conversations[conv_key] = None
+            self.hot_conversations.move_to_end(conv_key)
+
+    def evict(self):
+        # Spill whole conversations, least recently used first, until the messages in memory fit the budget.
+        # Called with no lock held, since it takes each victim's conversation lock.
+        if self.cold is None or self.hot_bytes <= self.hot_budget or not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            while True:
+                with self.hot_lock:
+                    if self.hot_bytes <= self.hot_budget or not self.hot_conversations:
+                        return
+                    conv_key, _ = self.hot_conversations.popitem(last=False)
+                with self.conv_lock(conv_key):
+                    conv = self.conversations.get(conv_key)
+                    freed = conv.spill() if conv is not None else 0
+                with self.hot_lock:
+                    self.hot_bytes -= freed
+        finally:
+            self.evict_lock.release()
+
+    def append_unread(self, username, entry):
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None:
+                return False
+            user["messages"].append(entry)
+            # Logged in full: a push handed back late may queue a message its conversation has since deleted,
+            # and replay must still find it
+            self.log("unread", username, entry.id, entry.sender, entry.message, entry.timestamp)
+            if username not in self.active_users:
+                # A parked mailbox that gets new mail is parked again once that too has waited park_after
+                self.mark_idle(username)
+        self.maybe_park()
+        return True
+
+    def unread_count(self, username):
+        user = self.users.get(username)
+        return len(user["messages"]) if user is not None else 0
+
+    def pop_unread(self, username, limit=0, fits=None):
+        # Remove and return up to limit unread messages (all of them when limit <= 0); None if no such user.
+        # With fits, reading stops before the first message it rejects, which stays unread. The log records
+        # how many were taken, so replay needs no fits.
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None:
+                return None
+            msgs = user["messages"].pop(limit, fits)
+            if msgs:
+                self.log("read", username, len(msgs))
+            return msgs
+
+    def clear_unread_from(self, username, sender):
+        # Viewing a conversation marks everything the other user sent as read
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is not None:
+                self.log("clear_unread", username, sender)
+                user["messages"].clear_sender(sender)
+
+    def delete_unread_positions(self, username, positions):
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None:
+                return False
+            self.log("delete_positions", username, sorted(positions))
+            user["messages"].remove_positions(positions)
+            return True
+
+    def conversation_partners(self, username):
+        # Everyone the user has a conversation with, from the per-user index rather than a scan of all conversations
+        if username not in self.users:
+            return []
+        with self.index_lock:
+            conv_keys = list(self.user_conversations.get(username, ()))
+        partners = []
+        for conv_key in conv_keys:
+            user_a, user_b = self.conv_users(conv_key)
+            partners.append(user_b if user_a == username else user_a)
+        return sorted(partners)
+
+    def get_conversation(self, user_a, user_b):
+        # Snapshot of the history, safe to iterate while other threads keep appending
+        conv_key = self.conv_key(user_a, user_b, assign=False)
+        if conv_key is None:
+            return []
+        with self.conv_lock(conv_key):
+            conv = self.conversations.get(conv_key)
+            if conv is None:
+                return []
+            if self.cold is not None:
+                self.touch(conv_key)
+            return list(conv.frozen())
+
+    def get_conversation_page(self, user_a, user_b, before=None, after=None, limit=0):
+        # One page of history as (entries oldest first, more); see Conversation.page for the cursor rules
+        conv_key = self.conv_key(user_a, user_b, assign=False)
+        if conv_key is None:
+            return [], False
+        with self.conv_lock(conv_key):
+            conv = self.conversations.get(conv_key)
+            if conv is None:
+                return [], False
+            if self.cold is not None:
+                self.touch(conv_key)
+            return conv.page(before, after, limit)
+
+    def delete_conversation_messages(self, user_a, user_b, ids):
+        # Returns False when the two users have no conversation
+        conv_key = self.conv_key(user_a, user_b, assign=False)
+        if conv_key is None:
+            return False
+        with self.conv_lock(conv_key):
+            if conv_key not in self.conversations:
+                return False
+        self.drop_messages(conv_key, set(ids))
+        return True
+
+    def drop_messages(self, conv_key, ids):
+        # Remove ids from one conversation and from the index; ids that are not in it are ignored
+        with self.conv_lock(conv_key):
+            conv = self.conversations.get(conv_key)
+            if conv is None:
+                return
+            before = conv.hot_bytes
+            removed = [msg_id for msg_id in ids if conv.remove(msg_id)]
+            for msg_id in removed:
+                del self.message_index[msg_id]
+            if self.cold is not None:
+                with self.hot_lock:
+                    self.hot_bytes += conv.hot_bytes - before
+            if removed:
+                self.log("drop", self.conv_users(conv_key), removed)
+
+    def delete_user_messages(self, username, ids):
+        # Delete the given ids from the user's unread mailbox and from their conversations. Each id is
+        # looked up in the message index, so the cost depends on len(ids), not on the size of any history.
+        # Returns False (and deletes nothing) when none of the ids belong to the user.
+        ids = set(ids)
+        owned = {}
+        with self.index_lock:
+            my_convs = set(self.user_conversations.get(username, ()))
+        for msg_id in ids:
+            conv_key = self.message_index.get(msg_id)
+            if conv_key in my_convs:
+                owned.setdefault(conv_key, []).append(msg_id)
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None:
+                return False
+            if not owned and not any(msg_id in user["messages"] for msg_id in ids):
+                return False
+            present = [msg_id for msg_id in ids if msg_id in user["messages"]]
+            if present:
+                self.log("unread_remove", username, present)
+                user["messages"].remove(present)
+        for conv_key, conv_ids in owned.items():
+            self.drop_messages(conv_key, conv_ids)
+        return True
@@ -0,0 +1,709 @@
+import unittest
+import errno
+import threading
+import time
+import os
+import shutil
+import tempfile
+from wal import WriteAheadLog, read_records
+from store import (ChatStore, Mailbox, PresenceFeed, conversation_key, format_timestamp, stored_timestamp,
+                   DIRECTORY_LOG_SIZE)
+from sqlite_store import SqliteStore
+
+class TestChatStore(unittest.TestCase):
+    def setUp(self):
+        self.store = ChatStore()
+        for name in ["alice", "bob", "carol"]:
+            self.store.create_user(name, "hash")
+
+    def test_create_user_only_once(self):
+        self.assertFalse(self.store.create_user("alice", "other"))
+        self.assertEqual(self.store.password_hash("alice"), "hash")
+
+    def test_concurrent_sends_get_unique_ids(self):
+        # Many threads recording and queueing at once must not lose or reuse ids
+        def worker(sender, recipient):
+            for i in range(500):
+                entry = self.store.record_message(sender, recipient, f"msg {i}")
+                self.store.append_unread(recipient, entry)
+        threads = [threading.Thread(target=worker, args=pair) for pair in
+                   [("alice", "bob"), ("bob", "alice"), ("carol", "bob"), ("alice", "carol")] * 2]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [entry.id for conv in self.store.conversations.values() for entry in conv.frozen()]
+        self.assertEqual(len(ids), 4000)
+        self.assertEqual(len(set(ids)), 4000)
+        self.assertEqual(len(self.store.get_conversation("alice", "bob")), 2000)
+        self.assertEqual(self.store.unread_count("bob"), 2000)
+
+    def test_concurrent_deletes_and_sends(self):
+        entries = [self.store.record_message("alice", "bob", str(i)) for i in range(200)]
+        doomed = [e.id for e in entries[::2]]
+        def deleter():
+            for msg_id in doomed:
+                self.store.delete_user_messages("alice", [msg_id])
+        def sender():
+            for i in range(200):
+                self.store.record_message("bob", "alice", "late")
+        threads = [threading.Thread(target=deleter), threading.Thread(target=sender)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        remaining = {msg.id for msg in self.store.get_conversation("alice", "bob")}
+        self.assertEqual(len(remaining), 300)
+        self.assertFalse(remaining & set(doomed))
+
+    def test_delete_goes_through_message_index(self):
+        mine = self.store.record_message("alice", "bob", "hi")
+        theirs = self.store.record_message("bob", "carol", "private")
+        # An id from a conversation alice is not part of does not belong to her
+        self.assertFalse(self.store.delete_user_messages("alice", [theirs.id]))
+        self.assertTrue(self.store.delete_user_messages("alice", [mine.id, theirs.id]))
+        self.assertNotIn(mine.id, self.store.message_index)
+        self.assertEqual(self.store.get_conversation("alice", "bob"), [])
+        self.assertEqual(self.store.get_conversation("bob", "carol"), [theirs])
+        self.assertTrue(self.store.delete_conversation_messages("carol", "bob", [theirs.id]))
+        self.assertEqual(list(self.store.message_index.items()), [])
+
+    def test_user_conversation_index(self):
+        self.store.record_message("alice", "bob", "1")
+        self.store.record_message("carol", "alice", "2")
+        self.store.record_message("bob", "carol", "3")
+        self.assertEqual(self.store.conversation_partners("alice"), ["bob", "carol"])
+        self.assertEqual(self.store.conversation_partners("bob"), ["alice", "carol"])
+        self.store.delete_user("alice")
+        self.assertEqual(self.store.conversation_partners("alice"), [])
+        # Bob keeps his side of the conversation with the deleted account
+        self.assertEqual(self.store.conversation_partners("bob"), ["alice", "carol"])
+
+    def test_recreated_user_keeps_conversation_index(self):
+        self.store.record_message("alice", "bob", "before")
+        self.store.delete_user("bob")
+        self.store.create_user("bob", "hash")
+        entry = self.store.record_message("alice", "bob", "after")
+        self.assertEqual(self.store.conversation_partners("bob"), ["alice"])
+        self.assertTrue(self.store.delete_user_messages("bob", [entry.id]))
+        self.assertEqual([m.message for m in self.store.get_conversation("alice", "bob")], ["before"])
+
+    def test_conversation_pages(self):
+        ids = [self.store.record_message("alice", "bob", str(i)).id for i in range(10)]
+        page, more = self.store.get_conversation_page("bob", "alice", limit=3)
+        self.assertEqual([m.message for m in page], ["7", "8", "9"])
+        self.assertTrue(more)
+        self.store.delete_user_messages("alice", ids[3:7])
+        page, more = self.store.get_conversation_page("alice", "bob", before=ids[7], limit=3)
+        self.assertEqual([m.message for m in page], ["0", "1", "2"])
+        self.assertFalse(more)
+        page, more = self.store.get_conversation_page("alice", "bob", after=ids[0], limit=2)
+        self.assertEqual([m.message for m in page], ["1", "2"])
+        self.assertTrue(more)
+        page, more = self.store.get_conversation_page("alice", "bob", after=ids[1], before=ids[9])
+        self.assertEqual([m.message for m in page], ["2", "7", "8"])
+        self.assertFalse(more)
+        # Tombstones are compacted once they outnumber the live ids
+        self.store.delete_user_messages("bob", ids[7:9])
+        self.assertEqual(list(self.store.conversations[self.store.conv_key("alice", "bob")].ids), ids[:3] + ids[9:])
+
+    def test_list_users_pages_by_prefix(self):
+        for name in ["alan", "albert", "alice2", "zed", "al"]:
+            self.store.create_user(name, "hash")
+        self.assertEqual(self.store.list_users("al*"), ["al", "alan", "albert", "alice", "alice2"])
+        names, token = self.store.list_users_page("al*", limit=2)
+        self.assertEqual((names, token), (["al", "alan"], "alan"))
+        names, token = self.store.list_users_page("al*", after=token, limit=3)
+        self.assertEqual((names, token), (["albert", "alice", "alice2"], None))
+        # Patterns without a literal prefix fall back to filtering the whole index
+        self.assertEqual(self.store.list_users("*e*"), ["albert", "alice", "alice2", "zed"])
+        self.assertEqual(self.store.list_users_page("?ob", limit=1), (["bob"], None))
+        self.store.delete_user("alice")
+        self.assertNotIn("alice", self.store.usernames)
+        self.assertEqual(self.store.list_users("ali*"), ["alice2"])
+
+    def test_list_users_scans_past_a_chunk(self):
+        store = ChatStore()
+        for i in range(3000):
+            store.create_user(f"user{i:04d}", "hash")
+        names, token = store.list_users_page("user*9", limit=250)
+        self.assertEqual(len(names), 250)
+        self.assertEqual(token, "user2499")
+        names, token = store.list_users_page("user*9", after=token)
+        self.assertEqual(len(names), 50)
+        self.assertIsNone(token)
+
+    def test_directory_changes(self):
+        # setUp created three accounts
+        self.assertEqual(self.store.directory_changes(0), (3, ["alice", "bob", "carol"], [], False))
+        self.assertEqual(self.store.directory_changes(3), (3, [], [], False))
+        self.store.create_user("dave", "hash")
+        self.store.delete_user("bob")
+        self.store.create_user("erin", "hash")
+        self.store.delete_user("erin")
+        self.assertEqual(self.store.directory_changes(3, limit=2), (5, ["dave"], ["bob"], True))
+        self.assertEqual(self.store.directory_changes(5), (7, [], ["erin"], False))
+        self.assertIsNone(self.store.directory_changes(99))
+
+    def test_directory_changes_past_the_log(self):
+        for i in range(DIRECTORY_LOG_SIZE):
+            self.store.create_user(f"user{i}", "hash")
+        # The first creations have fallen out of the log, so a client that saw none of them must re-list
+        self.assertIsNone(self.store.directory_changes(0))
+        version, added, removed, more = self.store.directory_changes(3, limit=10)
+        self.assertEqual((version, len(added), more), (13, 10, True))
+
+    def test_presence_events_are_coalesced(self):
+        scheduled = []
+        delivered = []
+        self.store.presence.schedule = lambda delay, callback: scheduled.append(callback)
+        self.store.presence.subscribe("conn", delivered.append)
+        self.store.create_user("dave", "hash")
+        self.store.login("dave", object())
+        self.store.login("alice", object())
+        self.store.logoff("dave")
+        self.store.logoff("nobody")
+        # One batch for the whole burst, holding only each user's latest event
+        self.assertEqual(len(scheduled), 1)
+        scheduled[0]()
+        self.assertEqual(delivered, [[("alice", "online"), ("dave", "offline")]])
+        self.store.presence.unsubscribe("conn")
+        self.store.delete_user("dave")
+        self.assertEqual(len(scheduled), 1)
+
+    def test_presence_flush_due_without_a_timer(self):
+        feed = PresenceFeed(window=0)
+        delivered = []
+        feed.schedule = lambda delay, callback: None
+        feed.subscribe("conn", delivered.append)
+        feed.publish("alice", "online")
+        self.assertEqual(feed.time_until_due(), 0.0)
+        feed.flush_due()
+        self.assertEqual(delivered, [[("alice", "online")]])
+        self.assertIsNone(feed.time_until_due())
+
+    def test_pop_unread_with_limit(self):
+        for i in range(5):
+            self.store.append_unread("bob", self.store.record_message("alice", "bob", str(i)))
+        first = self.store.pop_unread("bob", 2)
+        self.assertEqual([m.message for m in first], ["0", "1"])
+        self.assertEqual(self.store.unread_count("bob"), 3)
+        self.assertIsNone(self.store.pop_unread("nobody"))
+
+    def test_mailbox_pages_and_clears(self):
+        for i in range(6):
+            sender = "alice" if i % 2 == 0 else "carol"
+            self.store.append_unread("bob", self.store.record_message(sender, "bob", str(i)))
+        self.store.clear_unread_from("bob", "carol")
+        self.assertEqual(self.store.unread_count("bob"), 3)
+        self.assertEqual([m.message for m in self.store.pop_unread("bob", 2)], ["0", "2"])
+        self.assertEqual([m.message for m in self.store.pop_unread("bob")], ["4"])
+        self.assertEqual(self.store.users["bob"]["messages"].by_sender, {})
+
+    def test_mailbox_remove_positions_and_ids(self):
+        box = Mailbox()
+        entries = [self.store.record_message("alice", "bob", str(i)) for i in range(5)]
+        for entry in entries:
+            box.append(entry)
+        box.remove_positions([0, 3])
+        self.assertEqual([m.message for m in box], ["1", "2", "4"])
+        self.assertEqual(box.remove([entries[2].id, entries[0].id]), 1)
+        self.assertEqual(len(box), 2)
+        self.assertEqual({sender: list(ids) for sender, ids in box.by_sender.items()}, {"alice": [entries[1].id, entries[4].id]})
+
+    def test_mailbox_drops_what_was_read(self):
+        box = Mailbox()
+        entries = [self.store.record_message("alice" if i % 2 else "carol", "bob", str(i)) for i in range(100)]
+        for entry in entries:
+            box.append(entry)
+        box.remove([entry.id for entry in entries[10:90]])
+        self.assertEqual(len(box.pop(5)), 5)
+        # Deleted entries and ids already read are not kept around once they outnumber the unread ones
+        self.assertEqual(len(box), 15)
+        self.assertLessEqual(len(box.entries), 30)
+        self.assertLessEqual(box.sender_ids, 30)
+        box.clear_sender("carol")
+        self.assertEqual([m.message for m in box], [str(i) for i in [5, 7, 9, 91, 93, 95, 97, 99]])
+        self.assertEqual(box.pop(), entries[5:10:2] + entries[91::2])
+
+    def test_pop_unread_stops_at_a_message_that_does_not_fit(self):
+        entries = [self.store.record_message("alice", "bob", text) for text in ["a", "b", "too long", "c"]]
+        for entry in entries:
+            self.store.append_unread("bob", entry)
+        fits = lambda entry: len(entry.message) < 5
+        self.assertEqual(self.store.pop_unread("bob", 0, fits), entries[:2])
+        self.assertEqual(self.store.pop_unread("bob", 0, fits), [])
+        self.assertEqual(self.store.unread_count("bob"), 2)
+        self.assertEqual(self.store.pop_unread("bob"), entries[2:])
+
+    def test_exclusive_login(self):
+        self.assertEqual(self.store.login("alice", object(), exclusive=True), 0)
+        self.assertIsNone(self.store.login("alice", object(), exclusive=True))
+        self.store.logoff("alice")
+        self.assertIsNone(self.store.get_active("alice"))
+
+    def test_message_records_are_shared(self):
+        # A sender decoded from a request is a fresh string; the stored record points at the interned one
+        entry = self.store.record_message("".join(["al", "ice"]), "bob", "hi")
+        self.store.append_unread("bob", entry)
+        self.assertIs(entry.sender, self.store.record_message("alice", "carol", "other").sender)
+        self.assertIs(next(iter(self.store.users["bob"]["messages"])),
+                      self.store.conversations[self.store.conv_key("alice", "bob")].get(entry.id))
+        self.assertFalse(hasattr(entry, "__dict__"))
+
+    def test_conversation_key_is_order_independent(self):
+        self.assertEqual(conversation_key("bob", "alice"), conversation_key("alice", "bob"))
+        self.assertEqual(self.store.conv_key("bob", "alice"), self.store.conv_key("alice", "bob"))
+
+    def test_timestamps_are_integer_micros(self):
+        before = time.time_ns() // 1000
+        entry = self.store.record_message("alice", "bob", "hi")
+        self.assertIsInstance(entry.timestamp, int)
+        self.assertLessEqual(before, entry.timestamp)
+        # Formatting for a reply and parsing the text back loses nothing
+        self.assertEqual(stored_timestamp(format_timestamp(entry.timestamp)), entry.timestamp)
+
+    def test_user_ids_are_dense_and_kept(self):
+        self.assertEqual([self.store.user_id(name) for name in ["alice", "bob", "carol"]], [0, 1, 2])
+        self.store.record_message("alice", "bob", "hi")
+        key = self.store.conv_key("alice", "bob")
+        self.assertEqual(self.store.conv_users(key), ("alice", "bob"))
+        # Reading never registers a name, and a deleted user's id (and history) stays put
+        self.assertEqual(self.store.get_conversation("alice", "nobody"), [])
+        self.assertNotIn("nobody", self.store.user_ids)
+        self.store.delete_user("alice")
+        self.store.create_user("dave", "hash")
+        self.assertEqual(self.store.user_id("dave"), 3)
+        self.assertEqual(self.store.conversation_partners("bob"), ["alice"])
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "chat.wal")
+
+    def open_store(self):
+        store = ChatStore()
+        store.recover(WriteAheadLog(self.path, group_ms=1))
+        return store
+
+    def named(self, store):
+        # Ids are assigned afresh on every start, so compare the indexes by the names behind the keys
+        index = {msg_id: sorted(store.conv_users(key)) for msg_id, key in store.message_index.items()}
+        conversations = {name: sorted(sorted(store.conv_users(key)) for key in keys)
+                         for name, keys in store.user_conversations.items()}
+        return index, conversations
+
+    def logged(self):
+        wal = WriteAheadLog(self.path)
+        return [record for _, path in wal.segments() for _, record in read_records(path)]
+
+    def test_replay_rebuilds_state(self):
+        store = self.open_store()
+        for name in ["alice", "bob", "carol"]:
+            store.create_user(name, "hash-" + name)
+        entries = [store.record_message("alice", "bob", str(i)) for i in range(5)]
+        for entry in entries:
+            store.append_unread("bob", entry)
+        store.append_unread("carol", store.record_message("bob", "carol", "hi carol"))
+        store.pop_unread("bob", 2)
+        store.delete_user_messages("alice", [entries[3].id])
+        store.delete_unread_positions("bob", [1])
+        store.delete_user("carol")
+        store.commit()
+        store.wal.close()
+
+        again = self.open_store()
+        self.assertEqual(again.list_users(), ["alice", "bob"])
+        self.assertEqual(again.password_hash("bob"), "hash-bob")
+        self.assertEqual(again.get_conversation("alice", "bob"), store.get_conversation("alice", "bob"))
+        self.assertEqual([m.message for m in again.users["bob"]["messages"]], ["2", "4"])
+        self.assertEqual(list(again.users["bob"]["messages"]), list(store.users["bob"]["messages"]))
+        self.assertEqual(self.named(again), self.named(store))
+        # New ids carry on after the ones already in the log
+        self.assertGreater(again.record_message("bob", "alice", "later").id, entries[-1].id + 1)
+        again.wal.close()
+
+    def test_replays_iso_timestamps(self):
+        # Logs written before timestamps were integers carry them as ISO text
+        wal = WriteAheadLog(self.path)
+        list(wal.replay())
+        wal.open()
+        for record in [["create", "alice", "hash"], ["create", "bob", "hash"],
+                       ["message", 1, "alice", "bob", "hi", "2024-05-01T12:30:00.250000"]]:
+            wal.append(record)
+        wal.close()
+        store = self.open_store()
+        entry = store.get_conversation("alice", "bob")[0]
+        self.assertEqual(format_timestamp(entry.timestamp), "2024-05-01T12:30:00.250000")
+        store.wal.close()
+
+    def test_torn_tail_is_dropped(self):
+        store = self.open_store()
+        store.create_user("alice", "hash")
+        store.create_user("bob", "hash")
+        store.commit()
+        store.wal.close()
+        path = store.wal.segment_path(store.wal.gen)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+        again = self.open_store()
+        self.assertEqual(again.list_users(), ["alice"])
+        again.create_user("carol", "hash")
+        again.commit()
+        again.wal.close()
+        self.assertEqual([record[1] for record in self.logged()], ["alice", "carol"])
+
+    def test_concurrent_commits_share_fsyncs(self):
+        wal = WriteAheadLog(self.path, group_ms=20)
+        list(wal.replay())
+        wal.open()
+        def worker(n):
+            for i in range(20):
+                wal.commit(wal.append(["create", f"user{n}-{i}", "hash"]))
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wal.close()
+        self.assertEqual(len(self.logged()), 160)
+
+    def test_restart_from_snapshot_and_tail(self):
+        store = self.open_store()
+        for name in ["alice", "bob", "carol"]:
+            store.create_user(name, "hash-" + name)
+        entries = [store.record_message("alice", "bob", str(i)) for i in range(4)]
+        for entry in entries:
+            store.append_unread("bob", entry)
+        store.delete_user_messages("alice", [entries[0].id])
+        store.snapshot()
+        # Only the segment started by the snapshot is left, and it is empty
+        self.assertEqual([gen for gen, _ in store.wal.segments()], [store.wal.gen])
+        store.append_unread("carol", store.record_message("bob", "carol", "after"))
+        store.delete_user("alice")
+        store.commit()
+        store.wal.close()
+        self.assertEqual([record[0] for record in self.logged()], ["message", "unread", "delete_user"])
+
+        again = self.open_store()
+        self.assertEqual(again.list_users(), ["bob", "carol"])
+        self.assertEqual(again.directory_version, store.directory_version)
+        self.assertEqual(again.get_conversation("alice", "bob"), store.get_conversation("alice", "bob"))
+        self.assertEqual(again.get_conversation("bob", "carol"), store.get_conversation("bob", "carol"))
+        # The deleted message is written out in full; the others share the conversation's entries
+        self.assertEqual(list(again.users["bob"]["messages"]), list(store.users["bob"]["messages"]))
+        unread = again.users["bob"]["messages"]
+        self.assertIs(next(m for m in unread if m.id == entries[1].id),
+                      again.conversations[again.conv_key("alice", "bob")].get(entries[1].id))
+        self.assertEqual(self.named(again), self.named(store))
+        self.assertGreater(again.record_message("bob", "carol", "later").id, entries[-1].id + 1)
+        # Segments the snapshot covered are gone for good, and this start wrote a fresh one
+        self.assertEqual(len(again.wal.segments()), 2)
+        again.wal.close()
+
+    def test_log_growth_triggers_snapshot(self):
+        store = self.open_store()
+        store.snapshot_every = 10
+        for i in range(12):
+            store.create_user(f"user{i}", "hash")
+        store.snapshot_lock.acquire()
+        store.snapshot_lock.release()
+        store.commit()
+        store.wal.close()
+        self.assertTrue(os.path.exists(store.wal.snapshot_path))
+        self.assertEqual(self.open_store().list_users(), sorted(f"user{i}" for i in range(12)))
+
+    def test_replays_unread_message_deleted_before_it_was_queued(self):
+        # A push handed back after its conversation deleted the message still leaves it unread
+        store = self.open_store()
+        store.create_user("alice", "hash")
+        store.create_user("bob", "hash")
+        entry = store.record_message("alice", "bob", "late")
+        store.delete_user_messages("alice", [entry.id])
+        store.append_unread("bob", entry)
+        store.commit()
+        store.wal.close()
+
+        again = self.open_store()
+        self.assertEqual(list(again.users["bob"]["messages"]), [entry])
+        self.assertEqual(again.get_conversation("alice", "bob"), [])
+        again.wal.close()
+
+    def test_failed_write_raises_instead_of_hanging(self):
+        class FullDisk:
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+        store = self.open_store()
+        store.create_user("alice", "hash")
+        store.commit()
+        real_file, store.wal.file = store.wal.file, FullDisk()
+        self.addCleanup(real_file.close)
+        store.create_user("bob", "hash")
+        outcome = []
+
+        def commit():
+            try:
+                store.commit()
+                outcome.append(None)
+            except OSError as e:
+                outcome.append(e.errno)
+
+        waiter = threading.Thread(target=commit)
+        waiter.start()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(outcome, [errno.ENOSPC])
+        # The log stays failed: later changes are refused rather than acknowledged without being durable
+        with self.assertRaises(OSError):
+            store.create_user("carol", "hash")
+
+class TestTieredHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = ChatStore(history_dir=os.path.join(self.directory, "history"), hot_bytes=3500)
+        self.store.hot_recent = 4
+        self.memory = ChatStore()
+        for store in (self.store, self.memory):
+            for name in ["alice", "bob", "carol"]:
+                store.create_user(name, "hash")
+
+    def plain(self, entries):
+        # Both stores stamp their own times, so compare everything else
+        return [(m.id, m.sender, m.message) for m in entries]
+
+    def send_both(self, sender, recipient, count):
+        for i in range(count):
+            self.store.record_message(sender, recipient, f"{sender} {i}")
+            self.memory.record_message(sender, recipient, f"{sender} {i}")
+
+    def test_old_messages_spill_and_page_back(self):
+        self.send_both("alice", "bob", 30)
+        conv = self.store.conversations[self.store.conv_key("alice", "bob")]
+        self.assertLess(conv.live, 8)
+        self.assertEqual(len(conv), 30)
+        ids = [m.id for m in self.memory.get_conversation("alice", "bob")]
+        doomed = ids[2:6] + ids[-2:]
+        for store in (self.store, self.memory):
+            store.delete_user_messages("alice", doomed)
+        for cursor in [{"limit": 5}, {"before": ids[10], "limit": 5}, {"after": ids[0], "limit": 3},
+                       {"after": ids[1], "before": ids[12]}, {"before": ids[7], "limit": 1}, {}]:
+            page, more = self.store.get_conversation_page("bob", "alice", **cursor)
+            expected, expected_more = self.memory.get_conversation_page("bob", "alice", **cursor)
+            self.assertEqual((self.plain(page), more), (self.plain(expected), expected_more))
+        self.assertEqual(self.plain(self.store.get_conversation("alice", "bob")),
+                         self.plain(self.memory.get_conversation("alice", "bob")))
+
+    def test_budget_evicts_least_recently_used(self):
+        self.send_both("alice", "bob", 6)
+        self.send_both("alice", "carol", 6)
+        self.store.get_conversation_page("alice", "bob", limit=1)
+        self.send_both("bob", "carol", 40)
+        self.assertLessEqual(self.store.hot_bytes, self.store.hot_budget)
+        # alice/carol was used least recently, so it went to disk before alice/bob
+        self.assertEqual(self.store.conversations[self.store.conv_key("alice", "carol")].live, 0)
+        self.assertEqual(self.store.conversations[self.store.conv_key("alice", "bob")].live, 6)
+        self.assertEqual(self.plain(self.store.get_conversation("carol", "alice")),
+                         self.plain(self.memory.get_conversation("carol", "alice")))
+        self.assertEqual(sum(conv.hot_bytes for conv in self.store.conversations.values()), self.store.hot_bytes)
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.store.cold.directory) if name.startswith("history."))
+
+    def test_deleted_cold_messages_free_their_segments(self):
+        self.store.cold.segment_bytes = 0
+        self.send_both("alice", "bob", 12)
+        conv = self.store.conversations[self.store.conv_key("alice", "bob")]
+        spilled = list(conv.cold_ids)
+        self.assertEqual(self.segment_files(), ["history.1", "history.2"])
+        # A segment goes once all of its messages are deleted, even the one still being written
+        self.store.delete_user_messages("alice", spilled[:4])
+        self.assertEqual(self.segment_files(), ["history.2"])
+        self.store.delete_user_messages("alice", spilled[4:])
+        self.assertEqual(self.segment_files(), [])
+        self.assertEqual(self.plain(self.store.get_conversation("alice", "bob")),
+                         self.plain(self.memory.get_conversation("alice", "bob"))[len(spilled):])
+
+    def test_spill_directory_is_owned(self):
+        # Other files in a shared directory survive a start; an unmarked subdirectory in the way is refused
+        shared = os.path.join(self.directory, "shared")
+        os.makedirs(shared)
+        with open(os.path.join(shared, "history.1"), "w") as f:
+            f.write("not ours")
+        ChatStore(history_dir=shared)
+        ChatStore(history_dir=shared)
+        self.assertTrue(os.path.exists(os.path.join(shared, "history.1")))
+        os.makedirs(os.path.join(self.directory, "taken", "history"))
+        with open(os.path.join(self.directory, "taken", "history", "notes"), "w") as f:
+            f.write("not ours")
+        with self.assertRaises(ValueError):
+            ChatStore(history_dir=os.path.join(self.directory, "taken"))
+
+    def test_snapshot_includes_cold_history(self):
+        self.send_both("alice", "bob", 20)
+        entry = self.store.get_conversation("alice", "bob")[0]
+        self.store.append_unread("bob", entry)
+        path = os.path.join(self.directory, "chat.wal")
+        self.store.recover(WriteAheadLog(path, group_ms=1))
+        self.store.snapshot()
+        self.store.wal.close()
+        again = ChatStore(history_dir=os.path.join(self.directory, "again"))
+        again.recover(WriteAheadLog(path, group_ms=1))
+        self.assertEqual(again.get_conversation("alice", "bob"), self.store.get_conversation("alice", "bob"))
+        self.assertEqual(list(again.users["bob"]["messages"]), [entry])
+        again.wal.close()
+
+class TestParkedMailboxes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = ChatStore(history_dir=self.directory)
+        for name in ["alice", "bob", "carol"]:
+            self.store.create_user(name, "hash")
+        self.entries = []
+        for i in range(4):
+            self.entries.append(self.store.record_message("alice" if i % 2 == 0 else "carol", "bob", str(i)))
+            self.store.append_unread("bob", self.entries[-1])
+
+    def parked_files(self):
+        return sorted(name for name in os.listdir(os.path.join(self.directory, "mailbox")) if name.startswith("mailbox."))
+
+    def test_idle_mailbox_is_parked_and_loaded_on_login(self):
+        self.store.login("alice", object())
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        box = self.store.users["bob"]["messages"]
+        self.assertEqual((len(box.entries), len(box), self.store.unread_count("bob")), (0, 4, 4))
+        # Online users keep their mailboxes
+        self.assertNotIn("alice", self.store.idle_since)
+        # Mail for a parked user queues in memory behind the parked messages
+        late = self.store.record_message("alice", "bob", "late")
+        self.store.append_unread("bob", late)
+        self.assertIn("bob", self.store.idle_since)
+        self.assertEqual(self.store.login("bob", object()), 5)
+        self.assertEqual(box.parked, [])
+        self.assertEqual(list(box), self.entries + [late])
+        self.assertEqual(list(box.by_sender["carol"]), [self.entries[1].id, self.entries[3].id])
+
+    def test_parked_mailbox_serves_reads_and_deletes(self):
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        self.store.clear_unread_from("bob", "carol")
+        self.assertEqual(self.store.pop_unread("bob", 1), [self.entries[0]])
+        self.store.login("bob", object())
+        self.store.logoff("bob")
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        self.assertEqual(len(self.store.users["bob"]["messages"].parked), 1)
+        self.assertTrue(self.store.delete_user_messages("bob", [self.entries[2].id]))
+        self.assertEqual(self.store.unread_count("bob"), 0)
+        # Every parked frame has been loaded back, so no segment is left on disk, not even the newest
+        self.assertEqual(self.parked_files(), [])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "mailbox", ".chat-spill")))
+
+    def test_snapshot_reads_parked_mailboxes(self):
+        path = os.path.join(self.directory, "chat.wal")
+        self.store.recover(WriteAheadLog(path, group_ms=1))
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        self.store.snapshot()
+        self.store.wal.close()
+        again = ChatStore()
+        again.recover(WriteAheadLog(path, group_ms=1))
+        self.assertEqual(list(again.users["bob"]["messages"]), self.entries)
+        again.wal.close()
+
+    def test_deleted_user_releases_parked_frames(self):
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        self.store.parking.segment_bytes = 0
+        self.store.delete_user("bob")
+        self.store.create_user("dave", "hash")
+        self.store.append_unread("dave", self.entries[0])
+        self.store.park_idle(now=time.monotonic() + self.store.park_after + 1)
+        self.assertEqual(self.parked_files(), ["mailbox.2"])
+
+class TestSqliteStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "chat.db")
+        self.store = self.open_store()
+        for name in ["alice", "bob", "carol"]:
+            self.store.create_user(name, "hash-" + name)
+
+    def open_store(self):
+        store = SqliteStore(self.path)
+        self.addCleanup(store.db.close)
+        return store
+
+    def test_accounts_and_listing(self):
+        self.assertFalse(self.store.create_user("alice", "other"))
+        self.assertEqual(self.store.password_hash("alice"), "hash-alice")
+        for name in ["alan", "albert", "al"]:
+            self.store.create_user(name, "hash")
+        names, token = self.store.list_users_page("al*", limit=2)
+        self.assertEqual((names, token), (["al", "alan"], "alan"))
+        self.assertEqual(self.store.list_users_page("al*", after=token), (["albert", "alice"], None))
+        self.assertEqual(self.store.list_users("*o*"), ["bob", "carol"])
+        self.store.delete_user("bob")
+        self.assertFalse(self.store.user_exists("bob"))
+        self.assertEqual(self.store.directory_changes(6, limit=1), (7, [], ["bob"], False))
+
+    def test_history_pages_match_memory_store(self):
+        memory = ChatStore()
+        for name in ["alice", "bob"]:
+            memory.create_user(name, "hash")
+        for store in (self.store, memory):
+            ids = [store.record_message("alice", "bob", str(i)).id for i in range(10)]
+            store.delete_user_messages("alice", ids[3:7])
+        for cursor in [{"limit": 3}, {"before": ids[7], "limit": 3}, {"after": ids[0], "limit": 2},
+                       {"after": ids[1], "before": ids[9]}, {}]:
+            page, more = self.store.get_conversation_page("bob", "alice", **cursor)
+            expected, expected_more = memory.get_conversation_page("bob", "alice", **cursor)
+            self.assertEqual([m.message for m in page], [m.message for m in expected])
+            self.assertEqual(more, expected_more)
+        self.assertEqual(self.store.conversation_partners("bob"), ["alice"])
+        self.assertFalse(self.store.delete_conversation_messages("bob", "carol", [1]))
+
+    def test_unread_mailbox(self):
+        entries = []
+        for i in range(6):
+            sender = "alice" if i % 2 == 0 else "carol"
+            entries.append(self.store.record_message(sender, "bob", str(i)))
+            self.store.append_unread("bob", entries[-1])
+        self.assertEqual(self.store.login("bob", object()), 6)
+        self.store.clear_unread_from("bob", "carol")
+        self.store.delete_unread_positions("bob", [1])
+        self.assertEqual(self.store.pop_unread("bob", 1), [entries[0]])
+        # A message deleted from the conversation is still delivered to whoever has not read it yet
+        self.assertTrue(self.store.delete_user_messages("alice", [entries[4].id]))
+        self.assertEqual([m.message for m in self.store.get_conversation("alice", "bob")], ["0", "2"])
+        self.assertEqual(self.store.pop_unread("bob"), [entries[4]])
+        self.assertEqual(self.store.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0], 5)
+        self.assertIsNone(self.store.pop_unread("nobody"))
+
+    def test_state_survives_reopen(self):
+        entry = self.store.record_message("alice", "bob", "kept")
+        self.store.append_unread("bob", entry)
+        self.store.commit()
+        self.store.db.close()
+        again = self.open_store()
+        self.assertEqual(again.list_users(), ["alice", "bob", "carol"])
+        self.assertEqual(again.directory_version, 3)
+        self.assertEqual(again.get_conversation("alice", "bob"), [entry])
+        self.assertEqual(again.pop_unread("bob"), [entry])
+        self.assertGreater(again.record_message("bob", "alice", "new").id, entry.id)
+
+    def test_concurrent_sends(self):
+        def worker(sender, recipient):
+            for i in range(200):
+                self.store.append_unread(recipient, self.store.record_message(sender, recipient, f"msg {i}"))
+                self.store.commit()
+        threads = [threading.Thread(target=worker, args=pair) for pair in [("alice", "bob"), ("carol", "bob")] * 2]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.store.get_conversation("alice", "bob")), 400)
+        self.assertEqual(self.store.unread_count("bob"), 800)
+
+if __name__ == '__main__':
+    unittest.main()
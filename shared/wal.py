@@ -0,0 +1,312 @@
+import os
+import re
+import json
+import mmap
+import struct
+import threading
+import zlib
+
+# Each record is its payload length and CRC32, then the payload (a compact JSON list: event name, then fields)
+RECORD_HEADER = "!II"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+# A group of records is written and fsynced once it has waited this long or grown this large
+GROUP_COMMIT_MS = 5
+GROUP_COMMIT_RECORDS = 512
+
+# The log is a series of numbered segment files, PATH.1, PATH.2, ..., next to one snapshot, PATH.snap.
+# A snapshot records the first segment it does not cover; older segments are deleted once it is on disk.
+SNAPSHOT_SUFFIX = ".snap"
+# Snapshot header: magic, first segment not covered, next message id, directory version,
+# then the number of conversations and of users that follow. Version 1 snapshots stored ISO timestamp text.
+SNAPSHOT_MAGIC = b"CHATSNP2"
+SNAPSHOT_MAGIC_V1 = b"CHATSNP1"
+SNAPSHOT_HEADER = "!8sIQQII"
+SNAPSHOT_HEADER_SIZE = struct.calcsize(SNAPSHOT_HEADER)
+
+def encode_record(record):
+    data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    return struct.pack(RECORD_HEADER, len(data), zlib.crc32(data)) + data
+
+def read_records(path):
+    # Yield every intact record in the log. Reading stops at the first short or corrupt record, which can only
+    # be a write torn by a crash; the caller truncates the file there (see WriteAheadLog.replay).
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER_SIZE <= len(data):
+        length, crc = struct.unpack_from(RECORD_HEADER, data, offset)
+        start = offset + RECORD_HEADER_SIZE
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        offset = start + length
+        yield offset, json.loads(payload)
+
+# Snapshot encoding: strings are a 2-byte (short) or 4-byte (text) length and UTF-8 bytes, ids are 8 bytes and
+# timestamps 8-byte epoch microseconds. A conversation is its two users, an entry count and the entries (id,
+# which of the two sent it, timestamp, text). A user is the name, password hash, unread count and the unread ids; an unread message that is no
+# longer in any conversation is written out in full after its id.
+
+def pack_str16(s):
+    b = s.encode("utf-8")
+    return struct.pack("!H", len(b)) + b
+
+def pack_str32(s):
+    b = s.encode("utf-8")
+    return struct.pack("!I", len(b)) + b
+
+def unpack_str(data, offset, fmt):
+    length = struct.unpack_from(fmt, data, offset)[0]
+    offset += struct.calcsize(fmt)
+    return str(data[offset:offset + length], "utf-8"), offset + length
+
+def unpack_timestamp(data, offset, legacy):
+    if legacy:
+        return unpack_str(data, offset, "!H")
+    return struct.unpack_from("!q", data, offset)[0], offset + 8
+
+def write_snapshot(path, covers, next_id, directory_version, conversations, users):
+    # conversations: (conv_key, entries) pairs; users: (name, password hash, (entry, inline) pairs). Both
+    # inner sequences may be any iterable, and are read one conversation or user at a time.
+    # Written to a temporary file and renamed into place, so a crash never leaves a half-written snapshot.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, covers, next_id, directory_version,
+                            len(conversations), len(users)))
+        for (user_a, user_b), entries in conversations:
+            entries = list(entries)
+            parts = [pack_str16(user_a), pack_str16(user_b), struct.pack("!I", len(entries))]
+            for entry in entries:
+                parts.append(struct.pack("!QBq", entry.id, entry.sender != user_a, entry.timestamp))
+                parts.append(pack_str32(entry.message))
+            f.write(b"".join(parts))
+        for name, password_hash, unread in users:
+            unread = list(unread)
+            parts = [pack_str16(name), pack_str16(password_hash), struct.pack("!I", len(unread))]
+            for entry, inline in unread:
+                parts.append(struct.pack("!QB", entry.id, inline))
+                if inline:
+                    parts += [pack_str16(entry.sender), struct.pack("!q", entry.timestamp), pack_str32(entry.message)]
+            f.write(b"".join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+def read_snapshot(path):
+    # Stream a snapshot back through a read-only memory map, so the file is never copied into one big buffer:
+    # ("header", covers, next_id, directory_version), then ("conversation", conv_key, entries) for each
+    # conversation, then ("user", name, password hash, unread) where unread holds ids of conversation
+    # messages and full entries for the rest. Entries are (id, sender, text, timestamp) tuples, with the
+    # timestamp as ISO text in a version 1 snapshot. Yields nothing when there is no snapshot.
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, covers, next_id, directory_version, conv_count, user_count = struct.unpack_from(SNAPSHOT_HEADER, data, 0)
+        if magic not in (SNAPSHOT_MAGIC, SNAPSHOT_MAGIC_V1):
+            raise ValueError(f"{path} is not a chat snapshot")
+        legacy = magic == SNAPSHOT_MAGIC_V1
+        yield "header", covers, next_id, directory_version
+        offset = SNAPSHOT_HEADER_SIZE
+        for _ in range(conv_count):
+            user_a, offset = unpack_str(data, offset, "!H")
+            user_b, offset = unpack_str(data, offset, "!H")
+            count = struct.unpack_from("!I", data, offset)[0]
+            offset += 4
+            entries = []
+            for _ in range(count):
+                msg_id, from_b = struct.unpack_from("!QB", data, offset)
+                timestamp, offset = unpack_timestamp(data, offset + 9, legacy)
+                text, offset = unpack_str(data, offset, "!I")
+                entries.append((msg_id, user_b if from_b else user_a, text, timestamp))
+            yield "conversation", (user_a, user_b), entries
+        for _ in range(user_count):
+            name, offset = unpack_str(data, offset, "!H")
+            password_hash, offset = unpack_str(data, offset, "!H")
+            count = struct.unpack_from("!I", data, offset)[0]
+            offset += 4
+            unread = []
+            for _ in range(count):
+                msg_id, inline = struct.unpack_from("!QB", data, offset)
+                offset += 9
+                if inline:
+                    sender, offset = unpack_str(data, offset, "!H")
+                    timestamp, offset = unpack_timestamp(data, offset, legacy)
+                    text, offset = unpack_str(data, offset, "!I")
+                    unread.append((msg_id, sender, text, timestamp))
+                else:
+                    unread.append(msg_id)
+            yield "user", name, password_hash, unread
+
+def fsync_dir(path):
+    # Make a rename or unlink in the log's directory durable
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class WriteAheadLog:
+    # Append-only log of store mutations with group commit. append() only buffers the record; a syncer thread
+    # writes whatever has accumulated and fsyncs once per group, and commit() waits for that, so many
+    # concurrent requests share a single fsync instead of paying for one each.
+    def __init__(self, path, group_ms=GROUP_COMMIT_MS, group_records=GROUP_COMMIT_RECORDS):
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.group_ms = group_ms
+        self.group_records = group_records
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.buffer = []
+        # Records handed to append() and records known to be on disk
+        self.appended = 0
+        self.durable = 0
+        # Records appended since the current segment was started
+        self.segment_records = 0
+        # Number of the segment being written
+        self.gen = 0
+        self.closed = False
+        # The OSError that stopped the syncer; once set, nothing more can be made durable
+        self.error = None
+        self.file = None
+        self.syncer = None
+
+    def segment_path(self, gen):
+        return f"{self.path}.{gen}"
+
+    def segments(self):
+        # (number, path) of every segment on disk, oldest first
+        directory = os.path.dirname(os.path.abspath(self.path))
+        pattern = re.compile(re.escape(os.path.basename(self.path)) + r"\.(\d+)$")
+        found = []
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(directory, name)))
+        return sorted(found)
+
+    def replay(self, from_gen=1):
+        # Records in segments from_gen onwards, oldest first. A torn tail is cut off so the segment ends on its
+        # last intact record. Must run before open().
+        self.gen = from_gen - 1
+        for gen, path in self.segments():
+            if gen < from_gen:
+                continue
+            end = 0
+            for end, record in read_records(path):
+                yield record
+            if os.path.getsize(path) > end:
+                os.truncate(path, end)
+            self.gen = gen
+
+    def open(self):
+        # Every start writes a fresh segment after the ones replayed
+        self.gen += 1
+        self.file = open(self.segment_path(self.gen), "ab")
+        self.syncer = threading.Thread(target=self.sync_loop, daemon=True)
+        self.syncer.start()
+
+    def append(self, record):
+        frame = encode_record(record)
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise OSError("Log is closed")
+            self.buffer.append(frame)
+            self.appended += 1
+            self.segment_records += 1
+            if len(self.buffer) == 1 or len(self.buffer) >= self.group_records:
+                self.changed.notify_all()
+            return self.appended
+
+    def commit(self, upto=None):
+        # Block until every record appended so far (or up to sequence number upto) is on disk
+        with self.lock:
+            target = self.appended if upto is None else upto
+            while self.durable < target and not self.closed and self.error is None:
+                self.changed.wait()
+            if self.durable < target and self.error is not None:
+                raise self.error
+
+    def rotate(self):
+        # Start a new segment and return its number. The caller must stop appends first (the store holds every
+        # lock), so the finished segment ends exactly where the state being snapshotted does.
+        self.commit()
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            self.file.close()
+            self.gen += 1
+            self.file = open(self.segment_path(self.gen), "ab")
+            self.segment_records = 0
+            return self.gen
+
+    def read_snapshot(self):
+        return read_snapshot(self.snapshot_path)
+
+    def write_snapshot(self, covers, next_id, directory_version, conversations, users):
+        write_snapshot(self.snapshot_path, covers, next_id, directory_version, conversations, users)
+
+    def remove_before(self, gen):
+        # Drop segments a snapshot has made redundant
+        for old_gen, path in self.segments():
+            if old_gen < gen:
+                os.remove(path)
+        fsync_dir(self.path)
+
+    def sync_loop(self):
+        while True:
+            with self.lock:
+                while not self.buffer and not self.closed:
+                    self.changed.wait()
+                if not self.buffer:
+                    return
+                # Let the group fill for a moment unless it is already full
+                if len(self.buffer) < self.group_records and not self.closed:
+                    self.changed.wait(self.group_ms / 1000)
+                batch, self.buffer = self.buffer, []
+                upto = self.appended
+                # Written under the lock so rotate() never swaps the file out from under a write
+                try:
+                    self.file.write(b"".join(batch))
+                    self.file.flush()
+                except OSError as e:
+                    self.fail(e)
+                    return
+                fd = self.file.fileno()
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                with self.lock:
+                    self.fail(e)
+                return
+            with self.lock:
+                self.durable = upto
+                self.changed.notify_all()
+
+    def fail(self, error):
+        # Called with the lock held. A failed write or fsync leaves the file in an unknown state, so the
+        # syncer stops for good and every waiting or later commit() and append() raises the error instead.
+        self.error = error
+        self.changed.notify_all()
+
+    def close(self):
+        # Write out what is buffered, then stop the syncer
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+        if self.syncer is not None:
+            self.syncer.join()
+            self.file.close()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared"))
+
+from store import ChatStore
+from wal import WriteAheadLog
+
+# STATE
+
+def fill_store(path, users, messages):
+    # Log a realistic mix of accounts, messages and unread mailboxes, then shut down cleanly
+    store = ChatStore()
+    store.snapshot_every = float("inf")
+    store.recover(WriteAheadLog(path))
+    names = [f"user{i}" for i in range(users)]
+    for name in names:
+        store.create_user(name, "0" * 64)
+    for i in range(messages):
+        sender, recipient = names[i % users], names[(i * 7 + 1) % users]
+        entry = store.record_message(sender, recipient, f"message number {i} from {sender}")
+        store.append_unread(recipient, entry)
+        if i % 3 == 0:
+            store.pop_unread(recipient, 1)
+    return store
+
+def measure_restart(path):
+    start = time.perf_counter()
+    store = ChatStore()
+    store.recover(WriteAheadLog(path))
+    elapsed = time.perf_counter() - start
+    store.wal.close()
+    return elapsed
+
+def main():
+    users = 1000
+    messages = 200000
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "chat.wal")
+        store = fill_store(path, users, messages)
+        store.commit()
+        log_size = sum(os.path.getsize(p) for _, p in store.wal.segments())
+
+        # Log only: every record since the first start is replayed
+        store.wal.close()
+        log_time = measure_restart(path)
+
+        # Snapshot: load the snapshot, then replay only the records written after it
+        store = ChatStore()
+        store.recover(WriteAheadLog(path))
+        start = time.perf_counter()
+        store.snapshot()
+        snapshot_time = time.perf_counter() - start
+        store.wal.close()
+        snapshot_size = os.path.getsize(store.wal.snapshot_path)
+        restart_time = measure_restart(path)
+
+        print(f"{users} users, {messages} messages")
+        print("Log Only:")
+        print(f"Log size: {log_size} bytes")
+        print(f"Restart: {log_time:.6f} seconds")
+        print()
+        print("Snapshot + Log Tail:")
+        print(f"Snapshot size: {snapshot_size} bytes")
+        print(f"Taking the snapshot: {snapshot_time:.6f} seconds")
+        print(f"Restart: {restart_time:.6f} seconds")
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
+
+#*
+
+# run this file using: python3 startup_benchmark.py
+
+# 1000 users, 200000 messages
+# Log Only:
+# Log size: 30932905 bytes
+# Restart: 4.575690 seconds
+
+# Snapshot + Log Tail:
+# Snapshot size: 16167498 bytes
+# Taking the snapshot: 0.858654 seconds
+# Restart: 1.005131 seconds
+
+# Without a snapshot, a restart replays every record the server has ever logged, so startup time grows
+# with the server's whole history (here 4.58 seconds for about 31 MB of log) and never shrinks. With a
+# snapshot, the restart reads one compact file holding only the current state (unread deliveries that
+# were since read are simply not in it) and then replays the short tail written since, which took 1.01 seconds,
+# about 4.5 times faster. Since the store snapshots itself whenever the current segment reaches
+# snapshot_every records, the tail never exceeds that bound and restart time follows the size of the
+# live state rather than the age of the server. Most of the 0.86 seconds spent taking the snapshot is
+# encoding and writing the file, which happens after the store's locks are released; clients are only
+# held up while the log is rotated and the state is copied by reference.
+#*